@@ -0,0 +1,95 @@
+"""
+Callback plugin writing the timing of each task on each host as JSON lines
+"""
+
+import json
+import os
+import time
+
+from ansible.plugins.callback import CallbackBase
+
+DOCUMENTATION = r"""
+name: qesap_timings
+type: aggregate
+short_description: Write the timing of each task on each host as JSON lines
+description:
+  - Write one JSON line for each task executed on each host,
+    with playbook, play, role, task, action, host, start, end, duration and status.
+  - The file is the one in the QESAP_TIMINGS_FILE environment variable,
+    default is ansible.timing.jsonl in the current directory.
+    It is overwritten at the beginning of each playbook.
+  - Used by 'qesap.py ansible --timings' and aggregated by 'qesap.py report timings'.
+requirements:
+  - enable in configuration
+"""
+
+
+class CallbackModule(CallbackBase):
+    """
+    Per-task, per-host timing in JSON lines format
+    """
+
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = "aggregate"
+    CALLBACK_NAME = "qesap_timings"
+    CALLBACK_NEEDS_ENABLED = True
+
+    def __init__(self, display=None):
+        super().__init__(display=display)
+        self._output = os.environ.get("QESAP_TIMINGS_FILE", "ansible.timing.jsonl")
+        self._playbook = None
+        self._play = None
+        # Start time of each task, and of each task on each host
+        self._task_start = {}
+        self._host_start = {}
+
+    def v2_playbook_on_start(self, playbook):
+        self._playbook = os.path.basename(playbook._file_name)
+        with open(self._output, "w", encoding="utf-8"):
+            pass
+
+    def v2_playbook_on_play_start(self, play):
+        self._play = play.get_name()
+
+    def v2_playbook_on_task_start(self, task, is_conditional):
+        self._task_start[task._uuid] = time.time()
+
+    def v2_playbook_on_handler_task_start(self, task):
+        self._task_start[task._uuid] = time.time()
+
+    def v2_runner_on_start(self, host, task):
+        self._host_start[(task._uuid, host.get_name())] = time.time()
+
+    def _record(self, result, status):
+        end = time.time()
+        task = result._task
+        host = result._host.get_name()
+        start = self._host_start.pop(
+            (task._uuid, host), self._task_start.get(task._uuid, end)
+        )
+        record = {
+            "playbook": self._playbook,
+            "play": self._play,
+            "role": task._role.get_name() if task._role else None,
+            "task": task.get_name(),
+            "action": task.action,
+            "host": host,
+            "start": round(start, 3),
+            "end": round(end, 3),
+            "duration": round(end - start, 3),
+            "status": status,
+        }
+        with open(self._output, "a", encoding="utf-8") as file:
+            file.write(json.dumps(record) + "\n")
+
+    def v2_runner_on_ok(self, result):
+        self._record(result, "changed" if result._result.get("changed") else "ok")
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        self._record(result, "ignored" if ignore_errors else "failed")
+
+    def v2_runner_on_skipped(self, result):
+        self._record(result, "skipped")
+
+    def v2_runner_on_unreachable(self, result):
+        self._record(result, "unreachable")
@@ -0,0 +1,475 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Ansible module to download many large files concurrently,
+resuming partial downloads and verifying the checksums
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+DOCUMENTATION = r"""
+---
+module: qesap_download
+short_description: Download files concurrently, resuming partial downloads
+description:
+  - Download a list of files from the same base URL, like the blobs of a storage container.
+  - Up to I(max_concurrent) files are downloaded at the same time.
+  - If the server supports HTTP range requests, files bigger than I(chunk_size)
+    are split in chunks downloaded in parallel, and partial downloads are resumed.
+  - Data is written in a C(.part) file, renamed to the final name only when
+    complete and verified. The progress of the chunks is in a C(.part.json) file.
+  - Checksums are calculated while the data is downloaded.
+  - A file already present with the same size, and checksum if provided, is not downloaded again.
+    If the server does not report the size, only a file with the right checksum is kept.
+options:
+  base_url:
+    description: URL of the folder with the files, without query string.
+    type: str
+    required: true
+  names:
+    description: Path of each file, relative to I(base_url). The local file only uses the last part.
+    type: list
+    elements: str
+    required: true
+  query:
+    description: Query string added to each URL, like an Azure SAS token. It is never logged.
+    type: str
+    default: ""
+  dest:
+    description: Folder where to write the files.
+    type: path
+    required: true
+  checksums:
+    description: Expected checksum, as C(<algorithm>:<hex digest>) like C(sha256:1a2b...), for some of the I(names).
+    type: dict
+    default: {}
+  max_concurrent:
+    description: Max number of files downloaded at the same time.
+    type: int
+    default: 4
+  chunk_size:
+    description: Size in bytes of each chunk downloaded with a range request.
+    type: int
+    default: 134217728
+  chunk_concurrency:
+    description: Max number of chunks of the same file downloaded at the same time.
+    type: int
+    default: 4
+  timeout:
+    description: Timeout in seconds of each request.
+    type: int
+    default: 30
+  retries:
+    description: Number of retries of each failed request, resuming from where it stopped.
+    type: int
+    default: 5
+  retry_delay:
+    description: Seconds between two attempts of the same request.
+    type: int
+    default: 10
+extends_documentation_fragment:
+  - files
+"""
+
+EXAMPLES = r"""
+- name: Download HANA media
+  qesap_download:
+    base_url: "https://{{ az_storage_account_name }}.blob.core.windows.net/{{ az_container_name }}"
+    names: "{{ az_blobs }}"
+    query: "{{ az_sas_token }}"
+    dest: /hana/shared/install
+    mode: "0600"
+"""
+
+RETURN = r"""
+files:
+  description: Result of each file
+  returned: always
+  type: list
+  elements: dict
+  contains:
+    name: {description: the name in I(names), type: str}
+    dest: {description: local file path, type: str}
+    size: {description: size in bytes, type: int}
+    changed: {description: true if the file has been downloaded, type: bool}
+    resumed: {description: bytes already present from a previous partial download, type: int}
+    elapsed: {description: seconds needed to download the file, type: float}
+"""
+
+# Size of each read from the HTTP responses and of each checksum update
+BLOCK_SIZE = 1024 * 1024
+
+
+class DownloadError(Exception):
+    """Unrecoverable error downloading a file"""
+
+
+def parse_checksum(checksum):
+    """Split a checksum in algorithm and expected hex digest
+
+    Args:
+        checksum (str): like 'sha256:1a2b...', None for no checksum
+
+    Returns:
+        tuple: (algorithm, digest), (None, None) for no checksum
+    """
+    if not checksum:
+        return (None, None)
+    algorithm, _, digest = checksum.partition(":")
+    if not digest or algorithm not in hashlib.algorithms_available:
+        raise DownloadError(f"Invalid checksum {checksum}")
+    return (algorithm, digest.lower())
+
+
+def file_digest(path, algorithm, size=None):
+    """Calculate the digest of the first `size` bytes of a file, all of it if None"""
+    hasher = hashlib.new(algorithm)
+    with open(path, "rb") as file:
+        remaining = size
+        while remaining is None or remaining > 0:
+            block = file.read(
+                BLOCK_SIZE if remaining is None else min(BLOCK_SIZE, remaining)
+            )
+            if not block:
+                break
+            hasher.update(block)
+            if remaining is not None:
+                remaining -= len(block)
+    return hasher
+
+
+def _open(url, timeout, start=None, end=None, method="GET"):
+    request = urllib.request.Request(url, method=method)
+    if start is not None:
+        request.add_header("Range", f"bytes={start}-{'' if end is None else end}")
+    return urllib.request.urlopen(request, timeout=timeout)  # nosec B310
+
+
+class Download:
+    """Download of one file"""
+
+    def __init__(
+        self,
+        url,
+        dest,
+        checksum=None,
+        chunk_size=134217728,
+        chunk_concurrency=4,
+        timeout=30,
+        retries=5,
+        retry_delay=10,
+    ):
+        self.url = url
+        self.dest = dest
+        self.part = dest + ".part"
+        self.state = dest + ".part.json"
+        self.algorithm, self.expected = parse_checksum(checksum)
+        self.chunk_size = chunk_size
+        self.chunk_concurrency = chunk_concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.hasher = None
+        self.resumed = 0
+
+    def _retry(self, attempt):
+        for retry in range(self.retries + 1):
+            try:
+                return attempt()
+            except urllib.error.HTTPError as exc:
+                # Client errors, like an expired token, are not transient
+                if 400 <= exc.code < 500 and exc.code not in (408, 429):
+                    raise DownloadError(f"HTTP error {exc.code} {exc.reason}") from exc
+                if retry == self.retries:
+                    raise DownloadError(f"HTTP error {exc.code} {exc.reason}") from exc
+            except (OSError, DownloadError) as exc:
+                if retry == self.retries:
+                    raise DownloadError(str(exc)) from exc
+            time.sleep(self.retry_delay)
+        return None
+
+    def _probe(self):
+        with _open(self.url, self.timeout, method="HEAD") as response:
+            size = response.headers.get("Content-Length")
+            ranges = response.headers.get("Accept-Ranges", "") == "bytes"
+        return (int(size) if size is not None else None, ranges)
+
+    def _stream(self, size, ranges):
+        """Download the whole file in one request, resuming the .part file if any"""
+        offset = 0
+        if ranges and os.path.isfile(self.part):
+            offset = os.path.getsize(self.part)
+            if size is not None and offset > size:
+                offset = 0
+        self.resumed = offset
+        if self.algorithm:
+            self.hasher = (
+                file_digest(self.part, self.algorithm, offset)
+                if offset
+                else hashlib.new(self.algorithm)
+            )
+        with open(self.part, "ab" if offset else "wb") as file:
+
+            def _attempt():
+                nonlocal offset
+                with _open(self.url, self.timeout, start=offset or None) as response:
+                    if offset and response.status != 206:
+                        # The server sent the whole file
+                        offset = 0
+                        file.seek(0)
+                        file.truncate()
+                        if self.algorithm:
+                            self.hasher = hashlib.new(self.algorithm)
+                    while True:
+                        block = response.read(BLOCK_SIZE)
+                        if not block:
+                            break
+                        file.write(block)
+                        if self.hasher is not None:
+                            self.hasher.update(block)
+                        offset += len(block)
+                if size is not None and offset < size:
+                    raise DownloadError(
+                        f"Incomplete download, {offset} of {size} bytes"
+                    )
+
+            self._retry(_attempt)
+
+    def _chunked(self, size):
+        """Download the file in chunks, in parallel, resuming the completed chunks"""
+        chunks = [
+            (start, min(start + self.chunk_size, size) - 1)
+            for start in range(0, size, self.chunk_size)
+        ]
+        done = set()
+        if os.path.isfile(self.part) and os.path.getsize(self.part) == size:
+            try:
+                with open(self.state, "r", encoding="utf-8") as file:
+                    state = json.load(file)
+                if (
+                    state.get("size") == size
+                    and state.get("chunk_size") == self.chunk_size
+                ):
+                    done = set(state.get("done", []))
+            except (OSError, ValueError):
+                pass
+        if not done:
+            with open(self.part, "wb") as file:
+                file.truncate(size)
+        self.resumed = sum(chunks[index][1] - chunks[index][0] + 1 for index in done)
+        if self.algorithm:
+            self.hasher = hashlib.new(self.algorithm)
+        lock = threading.Lock()
+        # First chunk not included in the checksum yet: chunks are
+        # hashed in order, as soon as all the previous ones are complete
+        next_to_hash = 0
+        fd = os.open(self.part, os.O_RDWR)
+
+        def _hash_completed():
+            nonlocal next_to_hash
+            while self.hasher is not None and next_to_hash in done:
+                start, end = chunks[next_to_hash]
+                position = start
+                while position <= end:
+                    block = os.pread(fd, min(BLOCK_SIZE, end + 1 - position), position)
+                    if not block:
+                        raise DownloadError("Short read from the partial file")
+                    self.hasher.update(block)
+                    position += len(block)
+                next_to_hash += 1
+
+        def _save_state():
+            os.fsync(fd)
+            with open(self.state, "w", encoding="utf-8") as file:
+                json.dump(
+                    {"size": size, "chunk_size": self.chunk_size, "done": sorted(done)},
+                    file,
+                )
+
+        def _fetch(index):
+            start, end = chunks[index]
+
+            def _attempt():
+                with _open(self.url, self.timeout, start=start, end=end) as response:
+                    if response.status != 206:
+                        raise DownloadError(
+                            "The server does not support range requests"
+                        )
+                    position = start
+                    while True:
+                        block = response.read(BLOCK_SIZE)
+                        if not block:
+                            break
+                        if position + len(block) > end + 1:
+                            raise DownloadError("Chunk bigger than requested")
+                        os.pwrite(fd, block, position)
+                        position += len(block)
+                if position != end + 1:
+                    raise DownloadError(f"Incomplete chunk {start}-{end}")
+
+            self._retry(_attempt)
+            with lock:
+                done.add(index)
+                _save_state()
+                _hash_completed()
+
+        try:
+            with lock:
+                _hash_completed()
+            with ThreadPoolExecutor(max_workers=self.chunk_concurrency) as executor:
+                list(
+                    executor.map(
+                        _fetch,
+                        [index for index in range(len(chunks)) if index not in done],
+                    )
+                )
+        finally:
+            os.close(fd)
+
+    def _is_present(self, size):
+        """Check if the destination file is already the one to download
+
+        With a checksum, it has to match. Without a checksum, the size
+        has to match: a file of unknown size is downloaded again.
+        """
+        if not os.path.isfile(self.dest):
+            return False
+        if size is not None and os.path.getsize(self.dest) != size:
+            return False
+        if self.algorithm is not None:
+            return file_digest(self.dest, self.algorithm).hexdigest() == self.expected
+        return size is not None
+
+    def run(self):
+        """Download the file
+
+        Returns:
+            dict: result, see RETURN
+
+        Raises:
+            DownloadError: if the download failed. The partial file is kept,
+                           to resume the next time, unless its checksum is wrong.
+        """
+        start = time.monotonic()
+        size, ranges = self._retry(self._probe)
+        if self._is_present(size):
+            return {
+                "dest": self.dest,
+                "size": os.path.getsize(self.dest),
+                "changed": False,
+                "resumed": 0,
+                "elapsed": 0,
+            }
+        if ranges and size is not None and size > self.chunk_size:
+            self._chunked(size)
+        else:
+            self._stream(size, ranges)
+        if size is not None and os.path.getsize(self.part) != size:
+            raise DownloadError(
+                f"Wrong size {os.path.getsize(self.part)}, expected {size}"
+            )
+        if self.hasher is not None and self.hasher.hexdigest() != self.expected:
+            for path in (self.part, self.state):
+                if os.path.exists(path):
+                    os.remove(path)
+            raise DownloadError(
+                f"Wrong {self.algorithm} checksum {self.hasher.hexdigest()}, expected {self.expected}"
+            )
+        os.replace(self.part, self.dest)
+        if os.path.exists(self.state):
+            os.remove(self.state)
+        return {
+            "dest": self.dest,
+            "size": os.path.getsize(self.dest),
+            "changed": True,
+            "resumed": self.resumed,
+            "elapsed": round(time.monotonic() - start, 3),
+        }
+
+
+def main():
+    from ansible.module_utils.basic import AnsibleModule
+
+    module = AnsibleModule(
+        argument_spec={
+            "base_url": {"type": "str", "required": True},
+            "names": {"type": "list", "elements": "str", "required": True},
+            "query": {"type": "str", "default": "", "no_log": True},
+            "dest": {"type": "path", "required": True},
+            "checksums": {"type": "dict", "default": {}},
+            "max_concurrent": {"type": "int", "default": 4},
+            "chunk_size": {"type": "int", "default": 134217728},
+            "chunk_concurrency": {"type": "int", "default": 4},
+            "timeout": {"type": "int", "default": 30},
+            "retries": {"type": "int", "default": 5},
+            "retry_delay": {"type": "int", "default": 10},
+        },
+        add_file_common_args=True,
+        supports_check_mode=True,
+    )
+    params = module.params
+    downloads = {}
+    for name in params["names"]:
+        url = f"{params['base_url'].rstrip('/')}/{name}"
+        if params["query"]:
+            url += "?" + params["query"].lstrip("?")
+        downloads[name] = Download(
+            url,
+            os.path.join(params["dest"], name.split("/")[-1]),
+            checksum=params["checksums"].get(name),
+            chunk_size=params["chunk_size"],
+            chunk_concurrency=params["chunk_concurrency"],
+            timeout=params["timeout"],
+            retries=params["retries"],
+            retry_delay=params["retry_delay"],
+        )
+    if module.check_mode:
+        module.exit_json(
+            changed=any(
+                not os.path.isfile(download.dest) for download in downloads.values()
+            ),
+            files=[
+                {"name": name, "dest": download.dest}
+                for name, download in downloads.items()
+            ],
+        )
+
+    os.makedirs(params["dest"], exist_ok=True)
+    results = []
+    errors = []
+    changed = False
+    with ThreadPoolExecutor(max_workers=params["max_concurrent"]) as executor:
+        futures = {
+            name: executor.submit(download.run) for name, download in downloads.items()
+        }
+        for name, future in futures.items():
+            try:
+                result = future.result()
+            except (OSError, DownloadError) as exc:
+                errors.append(f"{name}: {exc}")
+                continue
+            file_args = module.load_file_common_arguments(
+                dict(params, path=result["dest"])
+            )
+            result["changed"] = module.set_fs_attributes_if_different(
+                file_args, result["changed"]
+            )
+            result["name"] = name
+            changed = changed or result["changed"]
+            results.append(result)
+    if errors:
+        module.fail_json(
+            msg="Download failed: " + "; ".join(errors), changed=changed, files=results
+        )
+    module.exit_json(changed=changed, files=results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""
+Journal of the completed playbooks of an Ansible sequence, to resume it after a failure,
+and Ansible retry files, to only rerun it on the failed hosts
+"""
+
+import glob
+import hashlib
+import json
+import logging
+import os
+import time
+
+log = logging.getLogger("QESAP")
+
+# Folder, within the base project folder, for the journal files
+JOURNAL_DIR = ".qesap"
+
+
+def journal_file(base_project, sequence):
+    """Get the journal file of one sequence
+
+    Args:
+        base_project (str): base project path
+        sequence (str): name of the Ansible sequence
+
+    Returns:
+        str: path of the file
+    """
+    return os.path.join(base_project, JOURNAL_DIR, f"ansible.{sequence}.journal")
+
+
+def clear(base_project):
+    """Remove the journals of all the sequences
+
+    Args:
+        base_project (str): base project path
+    """
+    for filename in glob.glob(journal_file(base_project, "*")):
+        log.info("Remove the journal %s", filename)
+        os.remove(filename)
+
+
+def retry_dir(base_project, sequence):
+    """Get the folder of the Ansible retry files of one sequence
+
+    Args:
+        base_project (str): base project path
+        sequence (str): name of the Ansible sequence
+
+    Returns:
+        str: absolute path of the folder
+    """
+    return os.path.join(os.path.abspath(base_project), JOURNAL_DIR, "retry", sequence)
+
+
+def failed_hosts(retry_path, playbooks):
+    """Get the hosts that failed in the last run of some playbooks
+
+    Args:
+        retry_path (str): folder of the retry files, see retry_dir
+        playbooks (list of str): playbook file names
+
+    Returns:
+        list of str: host names from the retry files of the playbooks, sorted
+    """
+    hosts = set()
+    for playbook in playbooks:
+        name = os.path.splitext(os.path.basename(playbook))[0]
+        filename = os.path.join(retry_path, f"{name}.retry")
+        if not os.path.isfile(filename):
+            continue
+        log.debug("Read the retry file %s", filename)
+        with open(filename, "r", encoding="utf-8") as file:
+            hosts.update(line.strip() for line in file if line.strip())
+    return sorted(hosts)
+
+
+def fingerprint(command, inventory_content):
+    """Calculate the fingerprint of one command
+
+    Args:
+        command (dict): command as prepared by ansible_command_sequence
+        inventory_content (bytes): content of the inventory file
+
+    Returns:
+        str: hex sha256 of the command line and of the inventory
+    """
+    digest = hashlib.sha256()
+    digest.update(command["cmd"].encode())
+    digest.update(b"\0")
+    digest.update(inventory_content)
+    return digest.hexdigest()
+
+
+class AnsibleJournal:
+    """Record of the playbooks successfully completed in the last runs of a sequence
+
+    The journal is a file with one JSON line for each completed command.
+    Only the tracked commands are recorded: the preliminary ones,
+    like the host reachability check, have to run every time.
+    """
+
+    def __init__(self, filename, inventory, tracked, resume=False):
+        """
+        Args:
+            filename (str): journal file, see journal_file
+            inventory (str): inventory.yaml file path
+            tracked (list of dict): commands to record and to skip if already completed
+            resume (bool): load the journal of the previous runs,
+                           otherwise start from an empty one
+        """
+        self.filename = filename
+        with open(inventory, "rb") as file:
+            inventory_content = file.read()
+        self.fingerprints = {
+            id(command): fingerprint(command, inventory_content) for command in tracked
+        }
+        self.completed = set()
+        if resume:
+            self.completed = self._load()
+            log.info("Resume from the journal %s", filename)
+        elif os.path.exists(filename):
+            log.debug("Reset the journal %s", filename)
+            os.remove(filename)
+
+    def _load(self):
+        completed = set()
+        if not os.path.isfile(self.filename):
+            log.warning("No journal %s to resume from", self.filename)
+            return completed
+        with open(self.filename, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    completed.add(json.loads(line)["fingerprint"])
+                except (ValueError, KeyError, TypeError):
+                    # A partially written last line, if qesap was killed
+                    log.debug("Invalid journal line %r", line)
+        return completed
+
+    def done(self, command):
+        """Check if a command has been already completed, with the same fingerprint
+
+        Args:
+            command (dict): one of the tracked commands
+
+        Returns:
+            bool: True if the command can be skipped
+        """
+        return self.fingerprints.get(id(command)) in self.completed
+
+    def record(self, command):
+        """Add a successfully completed command to the journal
+
+        Args:
+            command (dict): the completed command, not tracked ones are ignored
+        """
+        if id(command) not in self.fingerprints:
+            return
+        self.completed.add(self.fingerprints[id(command)])
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        with open(self.filename, "a", encoding="utf-8") as file:
+            file.write(
+                json.dumps(
+                    {
+                        "fingerprint": self.fingerprints[id(command)],
+                        "cmd": command["cmd"],
+                        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                    }
+                )
+                + "\n"
+            )
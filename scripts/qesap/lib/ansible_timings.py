@@ -0,0 +1,169 @@
+"""
+Aggregation of the per-task timings written by the qesap_timings Ansible callback plugin
+"""
+
+import glob
+import json
+import logging
+import os
+
+log = logging.getLogger("QESAP")
+
+# Name of the files written by the callback plugin, one for each playbook
+TIMINGS_GLOB = "ansible.*.timing.jsonl"
+
+
+def timings_filename(log_filename):
+    """Get the timings file of a playbook
+
+    Args:
+        log_filename (str): the playbook log file, like ansible.<NAME>.log.txt
+
+    Returns:
+        str: ansible.<NAME>.timing.jsonl
+    """
+    return log_filename.removesuffix(".log.txt") + ".timing.jsonl"
+
+
+def load(paths):
+    """Load the task timings
+
+    Args:
+        paths (list of str): timing files, or folders with timing files.
+                             Folders can contain the files of different runs.
+
+    Returns:
+        list of dict: one dict for each task executed on each host
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(
+                sorted(
+                    glob.glob(os.path.join(path, "**", TIMINGS_GLOB), recursive=True)
+                )
+            )
+        elif os.path.isfile(path):
+            files.append(path)
+        else:
+            log.warning("No timings file or folder %s", path)
+    records = []
+    for filename in files:
+        log.debug("Load timings from %s", filename)
+        with open(filename, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    log.warning("Invalid line in %s: %r", filename, line)
+                    continue
+                if isinstance(record, dict) and "duration" in record:
+                    records.append(record)
+    return records
+
+
+def slowest_tasks(records, top=20):
+    """Aggregate the timings of the same task on all the hosts and in all the runs
+
+    Args:
+        records (list of dict): output of load
+        top (int): max number of tasks to return
+
+    Returns:
+        list of dict: the slowest tasks, with keys playbook, role, task,
+                      count (executions), mean and max duration in seconds.
+                      Sorted by max duration.
+    """
+    tasks = {}
+    for record in records:
+        key = (record.get("playbook"), record.get("role"), record.get("task"))
+        task = tasks.setdefault(
+            key,
+            {
+                "playbook": key[0],
+                "role": key[1],
+                "task": key[2],
+                "count": 0,
+                "total": 0,
+                "max": 0,
+            },
+        )
+        task["count"] += 1
+        task["total"] += record["duration"]
+        task["max"] = max(task["max"], record["duration"])
+    for task in tasks.values():
+        task["mean"] = round(task.pop("total") / task["count"], 3)
+    return sorted(tasks.values(), key=lambda task: task["max"], reverse=True)[:top]
+
+
+def host_totals(records):
+    """Aggregate the timings of all the tasks executed on each host
+
+    Args:
+        records (list of dict): output of load
+
+    Returns:
+        list of dict: one dict for each host, with keys host, tasks, failed,
+                      total duration and playbooks, dict of the total
+                      duration on each playbook. Sorted by host name.
+    """
+    hosts = {}
+    for record in records:
+        host = hosts.setdefault(
+            record.get("host"),
+            {
+                "host": record.get("host"),
+                "tasks": 0,
+                "failed": 0,
+                "total": 0,
+                "playbooks": {},
+            },
+        )
+        host["tasks"] += 1
+        if record.get("status") in ("failed", "unreachable"):
+            host["failed"] += 1
+        host["total"] += record["duration"]
+        playbook = record.get("playbook")
+        host["playbooks"][playbook] = (
+            host["playbooks"].get(playbook, 0) + record["duration"]
+        )
+    return [hosts[name] for name in sorted(hosts, key=str)]
+
+
+def format_report(records, top=20):
+    """Compose the text report with the slowest tasks and the per-host comparison
+
+    Args:
+        records (list of dict): output of load
+        top (int): number of tasks in the slowest tasks table
+
+    Returns:
+        str: the report
+    """
+    tasks = slowest_tasks(records, top)
+    names = [
+        f"{task['playbook']}: {task['role'] + ' : ' if task['role'] else ''}{task['task']}"
+        for task in tasks
+    ]
+    width = max([len("TASK")] + [len(name) for name in names])
+    lines = [f"{'TASK':<{width}}  {'COUNT':>5}  {'MEAN':>9}  {'MAX':>9}"]
+    for name, task in zip(names, tasks):
+        lines.append(
+            f"{name:<{width}}  {task['count']:>5}  {task['mean']:>8.1f}s  {task['max']:>8.1f}s"
+        )
+
+    hosts = host_totals(records)
+    playbooks = sorted(
+        {playbook for host in hosts for playbook in host["playbooks"]}, key=str
+    )
+    width = max([len("HOST")] + [len(str(host["host"])) for host in hosts])
+    header = f"{'HOST':<{width}}  {'TASKS':>5}  {'FAILED':>6}  {'TOTAL':>9}"
+    for playbook in playbooks:
+        header += f"  {str(playbook):>{max(9, len(str(playbook)))}}"
+    lines.extend(["", header])
+    for host in hosts:
+        line = f"{host['host']:<{width}}  {host['tasks']:>5}  {host['failed']:>6}  {host['total']:>8.1f}s"
+        for playbook in playbooks:
+            line += f"  {host['playbooks'].get(playbook, 0):>{max(9, len(str(playbook))) - 1}.1f}s"
+        lines.append(line)
+    return "\n".join(lines) + "\n"
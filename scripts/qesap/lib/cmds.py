@@ -2,18 +2,38 @@
 sub commands library
 """
 
+import asyncio
+import concurrent.futures
+import copy
+import importlib.util
+import json
 import os
 import shutil
 import re
+import time
 import logging
 import yaml
 
-from lib.config import CONF
+import lib.ansible_journal
+import lib.ansible_timings
+import lib.config
+import lib.fail_fast
+import lib.fact_cache
+import lib.file_writer
 import lib.process_manager
+import lib.readiness
+import lib.schema
+import lib.ssh_multiplex
+import lib.terraform_cache
+import lib.terraform_json
+import lib.terraform_parallel
 from lib.status import Status
 
 log = logging.getLogger("QESAP")
 
+# Time needed to apply each resource, written when terraform:json_output is enabled
+TERRAFORM_TIMING_REPORT = "terraform.apply.timing.txt"
+
 
 def create_tfvars(config, template):
     """Create the tfvars file content
@@ -23,9 +43,24 @@ def create_tfvars(config, template):
         template (str): tfvars template, full path
 
     Returns:
-        tfvar_content (dict): dictionary with tfvars content. None in case of error
+        tfvar_content (list or dict): lines of the terraform.tfvars content or,
+                                      with terraform:tfvars_format json, content of
+                                      the terraform.tfvars.json. None in case of error
         err (str): Error message, None in case of PASS
     """
+    if config.get_tfvars_format() == "json":
+        if not template and not config.terraform_yml():
+            return (
+                None,
+                "No terraform.tfvars.template neither terraform in the configuration",
+            )
+        tfvar_content = config.yaml_to_tfvars_json(template)
+        if tfvar_content is None:
+            return (
+                None,
+                "Problem converting config.yaml content to terraform.tfvars.json",
+            )
+        return tfvar_content, None
     if template:
         log.debug("tfvar template %s", template)
         tfvar_content = config.template_to_tfvars(template)
@@ -67,11 +102,70 @@ def create_hana_media(config_ansible, apiver):
     return hanamedia_content, None
 
 
+def command_timeout(timeout, stage_deadline):
+    """Calculate the timeout for the next command of a stage
+
+    Args:
+        timeout (float): max number of seconds for each command. None for no limit.
+        stage_deadline (float): time.monotonic() value when the whole stage
+                                has to be completed. None for no limit.
+
+    Returns:
+        (float, bool): max number of seconds for the next command, None for no limit,
+                       and True if this value is limited by the stage deadline
+    """
+    if stage_deadline is None:
+        return timeout, False
+    remaining = stage_deadline - time.monotonic()
+    if timeout is None or remaining < timeout:
+        return remaining, True
+    return timeout, False
+
+
+def timeout_status(stage, command, timeout, stage_timeout, by_stage):
+    """Compose the Status for a command killed for timeout
+
+    Args:
+        stage (str): 'Terraform' or 'Ansible'
+        command (str): the killed command
+        timeout (float): the timeout used for the command
+        stage_timeout (float): the timeout of the whole stage
+        by_stage (bool): True if the command has been killed for the stage timeout
+
+    Returns:
+        Status: error
+    """
+    if by_stage:
+        msg = f"{stage} stage timeout of {stage_timeout}s expired at {command}"
+    else:
+        msg = f"{stage} command timeout of {timeout}s expired at {command}"
+    log.error(msg)
+    return Status(msg)
+
+
+def tfvars_text(tfvar_content):
+    """Render the tfvars file content, as returned by create_tfvars
+
+    Args:
+        tfvar_content (list or dict): lines of a terraform.tfvars
+                                      or content of a terraform.tfvars.json
+
+    Returns:
+        str: the whole file content
+    """
+    if isinstance(tfvar_content, dict):
+        return json.dumps(tfvar_content, indent=2) + "\n"
+    return "".join(tfvar_content) + "\n"
+
+
 def cmd_configure(configure_data, base_project, dryrun):
     """Main executor for the configure sub-command
 
+    Each file is rendered in memory and written only if its content changed,
+    so that the mtime of the unchanged ones is preserved.
+
     Args:
-        configure_data (obj): configuration structure
+        configure_data (dict or CONF): configuration structure, see lib.config.get_config
         base_project (str): base project path where to
                       look for the terraform and ansible folder
                       to write all the needed files
@@ -83,7 +177,8 @@ def cmd_configure(configure_data, base_project, dryrun):
     """
 
     # Validations
-    config = CONF(configure_data)
+    config = lib.config.get_config(configure_data)
+    configure_data = config.conf
     if not config.validate():
         return Status(f"Invalid configuration file content in {configure_data}")
     cfg_paths = config.validate_basedir(base_project)
@@ -120,23 +215,51 @@ def cmd_configure(configure_data, base_project, dryrun):
                     f"Create {cfg_paths['hana_vars_file']} with content {configure_data['ansible']['hana_vars']}"
                 )
     else:
-        log.info("Write .tfvars %s", cfg_paths["tfvars_file"])
-        with open(cfg_paths["tfvars_file"], "w", encoding="utf-8") as file:
-            file.write("".join(tfvar_content))
-            file.write("\n")
-
+        outputs = [(cfg_paths["tfvars_file"], tfvars_text(tfvar_content))]
         if config.has_section_or_variable(["ansible"]):
-            log.info("Write hana_media %s", cfg_paths["hana_media_file"])
-            with open(cfg_paths["hana_media_file"], "w", encoding="utf-8") as file:
-                yaml.dump(hanamedia_content, file)
-
+            # Deep copy of the read-only configuration values, to dump them as plain YAML
+            outputs.append(
+                (
+                    cfg_paths["hana_media_file"],
+                    yaml.dump(copy.deepcopy(hanamedia_content)),
+                )
+            )
             if (
                 "hana_vars" in configure_data["ansible"]
                 and configure_data["apiver"] >= 2
             ):
-                log.info("Write hana_vars %s", cfg_paths["hana_vars_file"])
-                with open(cfg_paths["hana_vars_file"], "w", encoding="utf-8") as file:
-                    yaml.dump(configure_data["ansible"]["hana_vars"], file)
+                outputs.append(
+                    (
+                        cfg_paths["hana_vars_file"],
+                        yaml.dump(
+                            copy.deepcopy(configure_data["ansible"]["hana_vars"])
+                        ),
+                    )
+                )
+        changes = []
+        for path, content in outputs:
+            if lib.file_writer.write_if_changed(path, content):
+                log.info("Write %s", path)
+                changes.append(path)
+            else:
+                log.info("Unchanged %s", path)
+        lib.file_writer.record_generated(base_project, [path for path, _ in outputs])
+        # Terraform loads both terraform.tfvars and terraform.tfvars.json:
+        # remove the one left by a previous configure with the other format,
+        # not one written by hand
+        other_tfvars_file = (
+            cfg_paths["tfvars_file"].removesuffix(".json")
+            if cfg_paths["tfvars_file"].endswith(".json")
+            else cfg_paths["tfvars_file"] + ".json"
+        )
+        if lib.file_writer.remove_generated(base_project, other_tfvars_file):
+            changes.append(other_tfvars_file)
+        if set(changes) & {
+            cfg_paths.get("hana_media_file"),
+            cfg_paths.get("hana_vars_file"),
+        }:
+            # Playbooks completed with the old variables have to run again
+            lib.ansible_journal.clear(base_project)
     return Status("ok")
 
 
@@ -144,7 +267,7 @@ def cmd_deploy(configure_data, base_project, dryrun=False):
     """Main executor for the deploy sub-command
 
     Args:
-        configure_data (obj): configuration structure
+        configure_data (dict or CONF): configuration structure, see lib.config.get_config
         base_project (str): base project path where to
                       look for the Terraform and Ansible files
         dryrun (bool): enable dryrun execution mode
@@ -152,22 +275,26 @@ def cmd_deploy(configure_data, base_project, dryrun=False):
     Returns:
         int: execution result, 0 means OK. It is mind to be used as script exit code
     """
-    res = cmd_configure(configure_data, base_project, dryrun)
+    # The same validated configuration is shared by all the steps
+    config = lib.config.get_config(configure_data)
+    res = cmd_configure(config, base_project, dryrun)
     if res != 0:
         return res
+    # Terraform plan and apply are skipped by cmd_terraform
+    # if none of their inputs, tfvars included, changed since the last apply
     res = cmd_terraform(
-        configure_data, base_project, dryrun, workspace="default", destroy=False
+        config, base_project, dryrun, workspace="default", destroy=False
     )
     if res != 0:
         return res
-    return cmd_ansible(configure_data, base_project, dryrun, destroy=False)
+    return cmd_ansible(config, base_project, dryrun, destroy=False)
 
 
 def cmd_destroy(configure_data, base_project, dryrun=False):
     """Main executor for the deploy sub-command
 
     Args:
-        configure_data (obj): configuration structure
+        configure_data (dict or CONF): configuration structure, see lib.config.get_config
         base_project (str): base project path where to
                       look for the Terraform and Ansible files
         dryrun (bool): enable dryrun execution mode
@@ -175,17 +302,99 @@ def cmd_destroy(configure_data, base_project, dryrun=False):
     Returns:
         int: execution result, 0 means OK. It is mind to be used as script exit code
     """
-    config = CONF(configure_data)
+    config = lib.config.get_config(configure_data)
+    configure_data = config.conf
     if not config.validate():
         return Status(f"Invalid configuration file content in {configure_data}")
-    res = cmd_ansible(configure_data, base_project, dryrun, destroy=True)
+    res = cmd_ansible(config, base_project, dryrun, destroy=True)
     if res != 0:
         return res
     return cmd_terraform(
-        configure_data, base_project, dryrun, workspace="default", destroy=True
+        config, base_project, dryrun, workspace="default", destroy=True
+    )
+
+
+def terraform_run_opts(config, dryrun):
+    """Calculate the subprocess_run options shared by all the terraform commands
+
+    Args:
+        config (obj): CONF instance
+        dryrun (bool): enable dryrun execution mode
+
+    Returns:
+        (dict, str): subprocess_run keyword arguments and
+                     the plugin cache folder, None if not configured
+    """
+    run_opts = {}
+    if config.has_section_or_variable(["terraform", "output_tail"]):
+        run_opts["tail"] = config.conf["terraform"]["output_tail"]
+    plugin_cache_dir, _ = config.get_plugin_cache()
+    if plugin_cache_dir is not None:
+        # Shared cache of the provider plugins, used by all the deployments
+        log.info("Use terraform plugin cache %s", plugin_cache_dir)
+        if not dryrun:
+            os.makedirs(plugin_cache_dir, exist_ok=True)
+        run_opts["env"] = dict(os.environ)
+        run_opts["env"]["TF_PLUGIN_CACHE_DIR"] = plugin_cache_dir
+    return run_opts, plugin_cache_dir
+
+
+def terraform_json_output(config):
+    """Check if terraform plan and apply have to run with -json
+
+    Args:
+        config (obj): CONF instance
+
+    Returns:
+        bool: True if terraform:json_output is enabled
+    """
+    return bool(
+        config.has_section_or_variable(["terraform", "json_output"])
+        and config.conf["terraform"]["json_output"]
     )
 
 
+def terraform_cmd(terraform_common_cmd, subcommand, *args):
+    """Compose a terraform command line
+
+    Terraform expects all the flags before the positional arguments,
+    like the plan file or the workspace name: -no-color is the first one.
+
+    Args:
+        terraform_common_cmd (str): terraform binary and its global options, like -chdir
+        subcommand (str): terraform subcommand, like 'plan' or 'workspace new'
+        args (str): flags, then positional arguments of the subcommand
+
+    Returns:
+        str: the command line
+    """
+    return " ".join([terraform_common_cmd, subcommand, "-no-color", *args])
+
+
+def terraform_ret_status(ret, command, timeout, stage_timeout, by_stage):
+    """Compose the Status for the exit code of a terraform command
+
+    Args:
+        ret (int): exit code of the command
+        command (str): the executed command
+        timeout (float): the timeout used for the command, None if no timeout
+        stage_timeout (float): the timeout of the whole stage
+        by_stage (bool): True if the timeout is the one of the stage
+
+    Returns:
+        Status: error, None if the command has been successful
+    """
+    log.debug("Terraform process return ret:%d", ret)
+    if ret == lib.process_manager.TIMEOUT_RC and timeout is not None:
+        return timeout_status("Terraform", command, timeout, stage_timeout, by_stage)
+    if ret == lib.process_manager.INTERRUPTED_RC:
+        return Status(f"Interrupted at {command}")
+    if ret != 0:
+        log.error("command:%s returned non zero %d", command, ret)
+        return Status(f"Error rc: {ret} at {command}")
+    return None
+
+
 def cmd_terraform(
     configure_data,
     base_project,
@@ -193,66 +402,440 @@ def cmd_terraform(
     workspace="default",
     destroy=False,
     parallel=None,
+    force_init=False,
+    force_apply=False,
 ):
     """Main executor for the deploy sub-command
 
     Args:
-        configure_data (obj): configuration structure
+        configure_data (dict or CONF): configuration structure, see lib.config.get_config
         base_project (str): base project path where to
                       look for the Terraform files
         dryrun (bool): enable dryrun execution mode
         workspace (str): name of the workspace to activate before running the deployment
         destroy (bool): destroy
-        parallel (int): value to use for argument --parallelism=n when call terraform plan and apply
+        parallel (int or str): value to use for argument --parallelism=n when call terraform plan and apply.
+                               'auto' to calculate it from the plan and reduce it, plan and apply again,
+                               if the cloud API throttles the requests.
+        force_init (bool): run 'terraform init' also if already done for the same inputs
+        force_apply (bool): run 'terraform plan' and 'terraform apply' also if nothing changed
+                            since the last successful apply
 
     Returns:
         Status: execution result, 0 means OK. It is mind to be used as script exit code
     """
 
     # Validations
-    config = CONF(configure_data)
+    config = lib.config.get_config(configure_data)
+    configure_data = config.conf
     if not config.validate():
         return Status(f"Invalid configuration file content in {configure_data}")
     cfg_paths = config.validate_basedir(base_project)
     if not cfg_paths:
         return Status(f"Invalid folder structure at {base_project}")
 
-    terraform_common_cmd = (
-        f"{config.get_terraform_bin()} -chdir={cfg_paths['provider']}"
-    )
+    terraform_bin = config.get_terraform_bin()
+    if (
+        not destroy
+        and not force_apply
+        and lib.terraform_cache.apply_is_cached(
+            cfg_paths["provider"], workspace, terraform_bin=terraform_bin
+        )
+    ):
+        log.info(
+            "Skip terraform, nothing changed in %s workspace:%s since the last apply",
+            cfg_paths["provider"],
+            workspace,
+        )
+        return Status("ok")
+
+    terraform_common_cmd = f"{terraform_bin} -chdir={cfg_paths['provider']}"
+    init_cmd = terraform_cmd(terraform_common_cmd, "init")
 
     cmds = []
     if destroy:
-        cmds.append(f"{terraform_common_cmd} destroy -auto-approve")
+        lib.terraform_cache.clear_apply_fingerprint(cfg_paths["provider"], workspace)
+        cmds.append(terraform_cmd(terraform_common_cmd, "destroy", "-auto-approve"))
         if workspace != "default":
-            cmds.append(f"{terraform_common_cmd} workspace select default")
-            cmds.append(f"{terraform_common_cmd} workspace delete {workspace}")
+            cmds.append(
+                terraform_cmd(terraform_common_cmd, "workspace select", "default")
+            )
+            cmds.append(
+                terraform_cmd(terraform_common_cmd, "workspace delete", workspace)
+            )
     else:
-        cmds.append(f"{terraform_common_cmd} init")
+        if not force_init and lib.terraform_cache.init_is_cached(
+            cfg_paths["provider"], terraform_bin
+        ):
+            log.info(
+                "Skip terraform init, %s is already initialized for the same inputs",
+                cfg_paths["provider"],
+            )
+        else:
+            cmds.append(init_cmd)
         if workspace != "default":
-            cmds.append(f"{terraform_common_cmd} workspace new {workspace}")
-        parallel_str = ""
-        if parallel:
-            parallel_str = f"-parallelism={parallel} "
-        cmds.append(f"{terraform_common_cmd} plan {parallel_str}-out=plan.zip")
-        cmds.append(
-            f"{terraform_common_cmd} apply {parallel_str}-auto-approve plan.zip"
+            cmds.append(terraform_cmd(terraform_common_cmd, "workspace new", workspace))
+
+    run_opts, plugin_cache_dir = terraform_run_opts(config, dryrun)
+    json_progress = None
+    if terraform_json_output(config):
+        # Same parser for plan and apply, to know in advance how many changes apply has to do
+        json_progress = lib.terraform_json.TerraformJsonProgress()
+    cmd_timeout, stage_timeout = config.get_timeouts("terraform")
+    stage_deadline = None
+    if stage_timeout is not None:
+        stage_deadline = time.monotonic() + stage_timeout
+
+    def _run(command, line_handlers=()):
+        """Run one terraform command
+
+        Returns:
+            (int, Status, list of str): exit code, error Status (None if OK)
+                                        and output of the command
+        """
+        cmd_run_opts = dict(run_opts)
+        handlers = [handler for handler in line_handlers if handler is not None]
+        if len(handlers) == 1:
+            cmd_run_opts["line_handler"] = handlers[0]
+        elif handlers:
+
+            def _all_handlers(line):
+                # All the handlers see each line, any of them can abort
+                results = [handler(line) for handler in handlers]
+                return any(results)
+
+            cmd_run_opts["line_handler"] = _all_handlers
+        if dryrun:
+            print(command)
+            return 0, None, []
+        timeout, by_stage = command_timeout(cmd_timeout, stage_deadline)
+        if timeout is not None:
+            if timeout <= 0:
+                return (
+                    lib.process_manager.TIMEOUT_RC,
+                    timeout_status(
+                        "Terraform", command, timeout, stage_timeout, by_stage
+                    ),
+                    [],
+                )
+            cmd_run_opts["timeout"] = timeout
+        log_filename = f"terraform.{command.split()[2]}.log.txt"
+        log.debug("Write %s getcwd:%s", log_filename, os.getcwd())
+        ret, stdout = lib.process_manager.subprocess_run(
+            command, log_file=log_filename, **cmd_run_opts
         )
+        err = terraform_ret_status(ret, command, timeout, stage_timeout, by_stage)
+        return ret, err, stdout
 
     for command in cmds:
-        command += " -no-color"
-        if dryrun:
-            print(command)
+        _, err, _ = _run(command)
+        if err is not None:
+            return err
+        if command == init_cmd and not dryrun:
+            lib.terraform_cache.save_init_fingerprint(
+                cfg_paths["provider"], terraform_bin
+            )
+
+    if not destroy:
+        auto = parallel == "auto"
+        policy = config.get_parallel_policy()
+        retries = policy["throttle_retries"] if auto else 0
+        parallelism = None if auto else parallel
+        json_flags = ["-json"] if json_progress is not None else []
+        for attempt in range(retries + 1):
+            throttle = lib.terraform_parallel.ThrottleDetector() if auto else None
+            parallel_flags = [f"-parallelism={parallelism}"] if parallelism else []
+            ret, err, _ = _run(
+                terraform_cmd(
+                    terraform_common_cmd,
+                    "plan",
+                    *json_flags,
+                    *parallel_flags,
+                    "-out=plan.zip",
+                ),
+                [json_progress, throttle],
+            )
+            if err is None and auto and parallelism is None:
+                ret, err, plan_json = _run(
+                    terraform_cmd(terraform_common_cmd, "show", "-json", "plan.zip")
+                )
+                if err is None and not dryrun:
+                    changes = lib.terraform_parallel.count_changes("\n".join(plan_json))
+                    if changes is None:
+                        return Status("Unable to read the plan from plan.zip")
+                    parallelism = lib.terraform_parallel.auto_parallelism(
+                        changes, policy
+                    )
+                    parallel_flags = [f"-parallelism={parallelism}"]
+            if err is None:
+                ret, err, _ = _run(
+                    terraform_cmd(
+                        terraform_common_cmd,
+                        "apply",
+                        *json_flags,
+                        *parallel_flags,
+                        "-auto-approve",
+                        "plan.zip",
+                    ),
+                    [json_progress, throttle],
+                )
+                if json_progress is not None and not dryrun:
+                    json_progress.write_timing_report(TERRAFORM_TIMING_REPORT)
+            if err is None:
+                if not dryrun:
+                    lib.terraform_cache.save_apply_fingerprint(
+                        cfg_paths["provider"], workspace, terraform_bin=terraform_bin
+                    )
+                break
+            if (
+                not auto
+                or not throttle.throttled
+                or ret
+                in (lib.process_manager.TIMEOUT_RC, lib.process_manager.INTERRUPTED_RC)
+                or attempt == retries
+                or parallelism == 1
+            ):
+                return err
+            parallelism = max(
+                1, (parallelism or lib.terraform_parallel.TERRAFORM_PARALLELISM) // 2
+            )
+            log.warning(
+                "Throttled by the cloud API, plan and apply again with parallelism %d",
+                parallelism,
+            )
+
+    if plugin_cache_dir is not None and not dryrun:
+        lib.terraform_cache.touch_plugin_cache(plugin_cache_dir, cfg_paths["provider"])
+    return Status("ok")
+
+
+def cmd_terraform_workspaces(
+    configure_data,
+    base_project,
+    dryrun,
+    workspaces,
+    max_concurrent=None,
+    destroy=False,
+    parallel=None,
+    force_init=False,
+    force_apply=False,
+):
+    """Executor for the terraform sub-command on many workspaces concurrently
+
+    Each workspace has its own Terraform data folder (TF_DATA_DIR=.terraform-<WORKSPACE>)
+    and plan file (plan.<WORKSPACE>.zip) in the provider folder, so the workspaces
+    do not interfere. 'terraform init' is serialized, as all the workspaces share
+    the .terraform.lock.hcl and the plugin cache; plan and apply run concurrently.
+
+    Args:
+        configure_data (dict or CONF): configuration structure, see lib.config.get_config
+        base_project (str): base project path where to
+                      look for the Terraform files
+        dryrun (bool): enable dryrun execution mode
+        workspaces (list of str): names of the workspaces to deploy
+        max_concurrent (int): max number of workspaces deployed at the same time.
+                              None means no limit.
+        destroy (bool): destroy
+        parallel (int): value to use for argument --parallelism=n when call terraform plan and apply
+        force_init (bool): run 'terraform init' also if already done for the same inputs
+        force_apply (bool): run 'terraform plan' and 'terraform apply' also if nothing changed
+                            since the last successful apply
+
+    Returns:
+        Status: execution result, 0 means OK only if all the workspaces are OK.
+                It is mind to be used as script exit code
+    """
+    config = lib.config.get_config(configure_data)
+    configure_data = config.conf
+    if not config.validate():
+        return Status(f"Invalid configuration file content in {configure_data}")
+    cfg_paths = config.validate_basedir(base_project)
+    if not cfg_paths:
+        return Status(f"Invalid folder structure at {base_project}")
+    if len(set(workspaces)) != len(workspaces) or "default" in workspaces:
+        return Status(f"Invalid workspace list {workspaces}")
+    if parallel == "auto":
+        return Status("Parallel auto is not supported for many workspaces")
+
+    provider_dir = cfg_paths["provider"]
+    terraform_bin = config.get_terraform_bin()
+    terraform_common_cmd = f"{terraform_bin} -chdir={provider_dir}"
+    run_opts, plugin_cache_dir = terraform_run_opts(config, dryrun)
+    json_output = terraform_json_output(config)
+    cmd_timeout, stage_timeout = config.get_timeouts("terraform")
+    stage_deadline = None
+    if stage_timeout is not None:
+        stage_deadline = time.monotonic() + stage_timeout
+    flags = []
+    if json_output:
+        flags.append("-json")
+    if parallel:
+        flags.append(f"-parallelism={parallel}")
+
+    async def _run_workspace(workspace, init_lock):
+        data_dir = f".terraform-{workspace}"
+        init_cmd = terraform_cmd(terraform_common_cmd, "init")
+        plan_cmd = terraform_cmd(
+            terraform_common_cmd, "plan", *flags, f"-out=plan.{workspace}.zip"
+        )
+        apply_cmd = terraform_cmd(
+            terraform_common_cmd,
+            "apply",
+            *flags,
+            "-auto-approve",
+            f"plan.{workspace}.zip",
+        )
+        cmds = []
+        if destroy:
+            lib.terraform_cache.clear_apply_fingerprint(
+                provider_dir, workspace, data_dir
+            )
+        elif not force_apply and lib.terraform_cache.apply_is_cached(
+            provider_dir, workspace, data_dir, terraform_bin
+        ):
+            log.info(
+                "Skip terraform workspace:%s, nothing changed since the last apply",
+                workspace,
+            )
+            return Status("ok")
+        # Also destroy needs the data folder, that can be missing,
+        # like in a fresh checkout
+        if not force_init and lib.terraform_cache.init_is_cached(
+            provider_dir, terraform_bin, data_dir
+        ):
+            log.info("Skip terraform init for workspace:%s", workspace)
+        else:
+            cmds.append(init_cmd)
+        if destroy:
+            cmds.append(
+                terraform_cmd(terraform_common_cmd, "workspace select", workspace)
+            )
+            cmds.append(terraform_cmd(terraform_common_cmd, "destroy", "-auto-approve"))
+            cmds.append(
+                terraform_cmd(terraform_common_cmd, "workspace select", "default")
+            )
+            cmds.append(
+                terraform_cmd(terraform_common_cmd, "workspace delete", workspace)
+            )
         else:
-            ret, out = lib.process_manager.subprocess_run(command)
-            log.debug("Terraform process return ret:%d", ret)
-            log_filename = f"terraform.{command.split()[2]}.log.txt"
-            log.debug("Write %s getcwd:%s", log_filename, os.getcwd())
-            with open(log_filename, "w", encoding="utf-8") as log_file:
-                log_file.write("\n".join(out))
-            if ret != 0:
-                log.error("command:%s returned non zero %d", command, ret)
-                return Status(f"Error rc: {ret} at {command}")
+            environment = os.path.join(provider_dir, data_dir, "environment")
+            selected = None
+            if os.path.isfile(environment):
+                with open(environment, "r", encoding="utf-8") as file:
+                    selected = file.read().strip()
+            if selected != workspace:
+                cmds.append(
+                    terraform_cmd(terraform_common_cmd, "workspace new", workspace)
+                )
+            cmds.append(plan_cmd)
+            cmds.append(apply_cmd)
+
+        ws_run_opts = dict(run_opts)
+        ws_run_opts["env"] = dict(run_opts.get("env", os.environ))
+        ws_run_opts["env"]["TF_DATA_DIR"] = data_dir
+        json_progress = None
+        if json_output:
+            json_progress = lib.terraform_json.TerraformJsonProgress()
+        for command in cmds:
+            cmd_run_opts = dict(ws_run_opts)
+            if json_progress is not None and command in (plan_cmd, apply_cmd):
+                cmd_run_opts["line_handler"] = json_progress
+            if dryrun:
+                print(f"TF_DATA_DIR={data_dir} {command}")
+                continue
+            timeout, by_stage = command_timeout(cmd_timeout, stage_deadline)
+            if timeout is not None:
+                if timeout <= 0:
+                    return timeout_status(
+                        "Terraform", command, timeout, stage_timeout, by_stage
+                    )
+                cmd_run_opts["timeout"] = timeout
+            log_filename = f"terraform.{workspace}.{command.split()[2]}.log.txt"
+            if command == init_cmd:
+                async with init_lock:
+                    ret, _ = await lib.process_manager.async_subprocess_run(
+                        command, log_file=log_filename, **cmd_run_opts
+                    )
+            else:
+                ret, _ = await lib.process_manager.async_subprocess_run(
+                    command, log_file=log_filename, **cmd_run_opts
+                )
+            if json_progress is not None and command == apply_cmd:
+                json_progress.write_timing_report(
+                    f"terraform.{workspace}.apply.timing.txt"
+                )
+            err = terraform_ret_status(ret, command, timeout, stage_timeout, by_stage)
+            if err is not None:
+                return err
+            if command == init_cmd:
+                lib.terraform_cache.save_init_fingerprint(
+                    provider_dir, terraform_bin, data_dir
+                )
+            if command == apply_cmd:
+                lib.terraform_cache.save_apply_fingerprint(
+                    provider_dir, workspace, data_dir, terraform_bin
+                )
+        return Status("ok")
+
+    async def _run_all():
+        init_lock = asyncio.Lock()
+        return await lib.process_manager.async_gather_limited(
+            [_run_workspace(workspace, init_lock) for workspace in workspaces],
+            max_concurrent,
+        )
+
+    try:
+        results = lib.process_manager.run_interruptible(_run_all())
+    except asyncio.CancelledError:
+        return Status(f"Interrupted while running workspaces {','.join(workspaces)}")
+
+    failed = []
+    for workspace, result in zip(workspaces, results):
+        log.info("Workspace %s: %s", workspace, result.msg)
+        if result != 0:
+            failed.append(f"{workspace}: {result.msg}")
+    if plugin_cache_dir is not None and not dryrun:
+        lib.terraform_cache.touch_plugin_cache(plugin_cache_dir, provider_dir)
+    if failed:
+        return Status(f"Failed workspaces {'; '.join(failed)}")
+    return Status("ok")
+
+
+def cmd_cache_prune(configure_data, dryrun, max_size=None):
+    """Main executor for the cache prune sub-command
+
+    Remove the least recently used providers from the Terraform plugin cache
+    configured in terraform:plugin_cache_dir
+
+    Args:
+        configure_data (dict or CONF): configuration structure, see lib.config.get_config
+        dryrun (bool): enable dryrun execution mode, only print what would be removed
+        max_size (str): max size of the cache, like '10G'.
+                        Default is terraform:plugin_cache_max_size from the conf.yaml
+
+    Returns:
+        Status: execution result, 0 means OK. It is mind to be used as script exit code
+    """
+    config = lib.config.get_config(configure_data)
+    configure_data = config.conf
+    if not config.validate():
+        return Status(f"Invalid configuration file content in {configure_data}")
+    cache_dir, conf_max_size = config.get_plugin_cache()
+    if cache_dir is None:
+        return Status("No terraform:plugin_cache_dir in the configuration")
+    if max_size is not None:
+        max_size_bytes = lib.schema.parse_size(max_size)
+        if max_size_bytes is None:
+            return Status(f"Invalid cache max size {max_size}")
+    elif conf_max_size is not None:
+        max_size_bytes = conf_max_size
+    else:
+        return Status("No cache max size in the configuration or in the arguments")
+    if not os.path.isdir(cache_dir):
+        log.info("No plugin cache folder %s", cache_dir)
+        return Status("ok")
+    removed = lib.terraform_cache.prune_plugin_cache(cache_dir, max_size_bytes, dryrun)
+    log.info("Removed %d entries from %s", len(removed), cache_dir)
     return Status("ok")
 
 
@@ -273,9 +856,9 @@ def ansible_validate(config, base_project, sequence, provider):
                 False,
                 "Invalid internal structure of the Ansible part of config.yaml",
             )
-        for playbook in config.get_playbooks(sequence):
+        for step in config.get_playbook_steps(sequence):
             playbook_filename = os.path.join(
-                base_project, "ansible", "playbooks", playbook.split(" ")[0]
+                base_project, "ansible", "playbooks", step["playbook"].split(" ")[0]
             )
             if not os.path.isfile(playbook_filename):
                 log.error("Missing playbook at %s", playbook_filename)
@@ -288,19 +871,19 @@ def ansible_validate(config, base_project, sequence, provider):
 
 
 def ansible_command_sequence(
-    configure_data_ansible,
+    config,
     admin_user,
     base_project,
     sequence,
     inventory,
     profile,
     junit,
-    apiver,
+    timings=False,
 ):
     """Compose the sequence of Ansible commands
 
     Args:
-        configure_data_ansible (obj): ansible part of the configure_data
+        config (CONF): configuration object, the same used by the caller
         admin_user (str): name of the admin user
         base_project (str): base project path where to
                       look for the Ansible files
@@ -308,13 +891,18 @@ def ansible_command_sequence(
         inventory (str): inventory.yaml file path
         profile (bool): enable task profile
         junit (str): enable junit report and provide folder where to store report
-        apiver (int): apiver of the conf.yaml. It is important to know if apiver >= 4,
-                      that means list of playbooks is within the new key sequences
+        timings (bool): enable the qesap_timings callback, writing the timing of each task
+                        in a ansible.<PLAYBOOK>.timing.jsonl file for each playbook
 
     Returns:
         list of strings, each of them is an anslble or ansible-playbook command
     """
 
+    configure_data_ansible = config.conf["ansible"]
+    # It is important to know if apiver >= 4,
+    # that means list of playbooks is within the new key sequences
+    apiver = config.conf["apiver"]
+
     # Create the environment variable set that will be used by any command
     original_env = dict(os.environ)
     original_env["ANSIBLE_PIPELINING"] = "True"
@@ -325,10 +913,42 @@ def ansible_command_sequence(
     if junit:
         ansible_callbacks.append("junit")
         original_env["JUNIT_OUTPUT_DIR"] = junit
+    if timings:
+        ansible_callbacks.append("qesap_timings")
     if len(ansible_callbacks) > 0:
         original_env["ANSIBLE_CALLBACKS_ENABLED"] = ",".join(ansible_callbacks)
     if "roles_path" in configure_data_ansible:
         original_env["ANSIBLE_ROLES_PATH"] = configure_data_ansible["roles_path"]
+    ssh_multiplex = "ssh_control_persist" in configure_data_ansible
+    if ssh_multiplex:
+        # Persistent SSH connections shared by all the commands of the sequence.
+        # ANSIBLE_SSH_ARGS has precedence over the ssh_args in ansible.cfg,
+        # so its ControlPersist and ControlPath are the ones used.
+        original_env["ANSIBLE_SSH_ARGS"] = lib.ssh_multiplex.ssh_args(
+            lib.ssh_multiplex.control_dir(base_project),
+            configure_data_ansible["ssh_control_persist"],
+        )
+    steps = config.get_playbook_steps(sequence)
+    if any(step["retry_limit"] for step in steps):
+        # The hosts where a playbook fails are written in a retry file,
+        # see cmd_ansible retry_failed
+        original_env["ANSIBLE_RETRY_FILES_ENABLED"] = "True"
+        original_env["ANSIBLE_RETRY_FILES_SAVE_PATH"] = lib.ansible_journal.retry_dir(
+            base_project, sequence
+        )
+    profiles = config.get_execution_profiles()
+    fail_fast = config.get_fail_fast_patterns()
+    fact_cache = configure_data_ansible.get("fact_cache", False)
+    flush_cache = set()
+    if fact_cache:
+        # Facts gathered by a playbook are reused by the following ones
+        original_env.update(
+            lib.fact_cache.cache_env(lib.fact_cache.cache_dir(base_project))
+        )
+        invalidate_after = None
+        if isinstance(fact_cache, dict):
+            invalidate_after = fact_cache.get("invalidate_after")
+        flush_cache = lib.fact_cache.flush_after(steps, invalidate_after)
 
     # Verify that the two needed binaries are usable
     ansible_bin_paths = {}
@@ -355,6 +975,9 @@ def ansible_command_sequence(
         # Pre-creating it ensures the path exists even if the sequence fails early.
         ansible_cmd_seq.append({"cmd": f"mkdir -p {junit}"})
 
+    # The built-in readiness probe replaces the two following ad-hoc commands
+    readiness_probe = configure_data_ansible.get("readiness_probe", False)
+
     # This is to avoid any manual intervention during first connection.
     # Without this code it is usually needed to interactively
     # accept the ssh host fingerprint.
@@ -370,7 +993,8 @@ def ansible_command_sequence(
     # for avoiding the ansible ssh connection failure introduced by
     # https://github.com/ansible/ansible/pull/78826 in "ansible-core 2.15.0"
     ssh_share += f' --ssh-extra-args="-l {admin_user} -o UpdateHostKeys=yes -o StrictHostKeyChecking=accept-new"'
-    ansible_cmd_seq.append({"cmd": ssh_share})
+    if not readiness_probe:
+        ansible_cmd_seq.append({"cmd": ssh_share})
 
     # This command is used to wait until user and sudo permissions are ready before running the playbooks
     # this is needed due to GCP guest agent taking some time to set these up after VM creation
@@ -379,14 +1003,27 @@ def ansible_command_sequence(
         "-m shell "
         "-a 'i=0; while [ $i -lt 35 ]; do sudo -n true && exit 0; sleep 5; i=$((i+1)); done; exit 1' "
     )
-    ansible_cmd_seq.append({"cmd": sudo_wait})
+    if not readiness_probe:
+        ansible_cmd_seq.append({"cmd": sudo_wait})
+        if ssh_multiplex:
+            # Also the two ad-hoc commands open the persistent SSH connections
+            for command in ansible_cmd_seq[-2:]:
+                command["env"] = original_env
 
     selected_list_of_playbooks = []
     if apiver < 4:
         selected_list_of_playbooks = configure_data_ansible[sequence]
     else:
         selected_list_of_playbooks = configure_data_ansible["sequences"][sequence]
-    for playbook in selected_list_of_playbooks:
+    for index, playbook in enumerate(selected_list_of_playbooks):
+        # Each element is a string or a dictionary, see CONF.get_playbook_steps
+        step_name = None
+        hosts = None
+        if isinstance(playbook, dict):
+            step_name = playbook.get("name")
+            hosts = playbook.get("hosts")
+            playbook = playbook["playbook"]
+
         # playbook input is here from the conf.yaml
         # 1. it could be a string only with one playbook file name, no path
         # 2. it could have some arguments, so single string
@@ -417,71 +1054,335 @@ def ansible_command_sequence(
             playbook = re.sub(rf"\${{{match[2:-1]}}}", value, playbook)
 
         # Finally compose the command ansible-playbook
-        # using the resolved `playbook` string
-        ansible_cmd_seq.append(
-            {
-                "cmd": f"{ansible_bin_paths['ansible-playbook']} {ansible_common} {playbook}",
-                "env": original_env,
-            }
-        )
+        # using the resolved `playbook` string.
+        # Its output is streamed to a log file named after the playbook.
+        if hosts:
+            playbook += f" --limit {hosts}"
+        if index in flush_cache:
+            # Facts cached before a reboot or a patch are stale
+            playbook += " --flush-cache"
+        log_filename = ansible_log_filename(playbook_abs_filename)
+        if step_name:
+            log_filename = f"ansible.{step_name}.log.txt"
+        env = original_env
+        if steps[index]["profile"] is not None or timings:
+            env = dict(original_env)
+        if steps[index]["profile"] is not None:
+            env.update(ansible_profile_env(profiles[steps[index]["profile"]]))
+        if timings:
+            env["QESAP_TIMINGS_FILE"] = lib.ansible_timings.timings_filename(
+                log_filename
+            )
+        playbook_cmd = {
+            "cmd": f"{ansible_bin_paths['ansible-playbook']} {ansible_common} {playbook}",
+            "env": env,
+            "log_file": log_filename,
+        }
+        if "output_tail" in configure_data_ansible:
+            playbook_cmd["tail"] = configure_data_ansible["output_tail"]
+        if fail_fast:
+            playbook_cmd["line_handler"] = lib.fail_fast.FailFastDetector(fail_fast)
+        ansible_cmd_seq.append(playbook_cmd)
     return True, ansible_cmd_seq
 
 
-def execute_ansible_commands(commands, dryrun):
+def ansible_retry_limit(commands, steps, journal, retry_path):
+    """Limit the playbooks to rerun to the hosts where they failed in the previous run
+
+    Only the playbooks not completed yet, with retry_limit, without hosts
+    and with a retry file are limited, each one to the hosts in its own retry file.
+    The others, like the playbooks never started because
+    the sequence stopped before them, run on all their hosts.
+    The journal fingerprint is the one of the command without the limit,
+    so that completing the playbook on the failed hosts completes it.
+
+    Args:
+        commands (list of dict): the playbook commands, in the order of the steps
+        steps (list of dict): the steps of the sequence, see CONF.get_playbook_steps
+        journal (AnsibleJournal): journal of the previous runs
+        retry_path (str): folder of the retry files, see ansible_journal.retry_dir
+    """
+    limited = False
+    for command, step in zip(commands, steps):
+        if journal.done(command) or not step["retry_limit"] or step["hosts"]:
+            continue
+        playbook = step["playbook"].split()[0]
+        hosts = lib.ansible_journal.failed_hosts(retry_path, [playbook])
+        if not hosts:
+            continue
+        name = os.path.splitext(os.path.basename(playbook))[0]
+        limit_file = os.path.join(retry_path, f"qesap.{name}.failed_hosts")
+        with open(limit_file, "w", encoding="utf-8") as file:
+            file.write("\n".join(hosts) + "\n")
+        log.info("Rerun %s on the failed hosts %s", playbook, ", ".join(hosts))
+        command["cmd"] += f" --limit @{limit_file}"
+        limited = True
+    if not limited:
+        log.warning("No failed hosts in %s, rerun on all the hosts", retry_path)
+
+
+def ansible_profile_env(profile):
+    """Compose the environment variables for an execution profile
+
+    Mitogen strategies need the ansible_mitogen package:
+    if it is not installed, the equivalent Ansible strategy is used.
+
+    Args:
+        profile (dict): one of the ansible:execution_profiles, see CONF.get_execution_profiles
+
+    Returns:
+        dict: environment variables for ansible-playbook
+    """
+    env = {}
+    if "forks" in profile:
+        env["ANSIBLE_FORKS"] = str(profile["forks"])
+    if "timeout" in profile:
+        env["ANSIBLE_TIMEOUT"] = str(profile["timeout"])
+    if "pipelining" in profile:
+        env["ANSIBLE_PIPELINING"] = str(profile["pipelining"])
+    if "strategy" in profile:
+        strategy = profile["strategy"]
+        if strategy.startswith("mitogen_"):
+            spec = importlib.util.find_spec("ansible_mitogen")
+            if spec is None or not spec.submodule_search_locations:
+                log.warning(
+                    "Mitogen is not installed, use the %s strategy", strategy[8:]
+                )
+                strategy = strategy[8:]
+            else:
+                env["ANSIBLE_STRATEGY_PLUGINS"] = os.path.join(
+                    spec.submodule_search_locations[0], "plugins", "strategy"
+                )
+        env["ANSIBLE_STRATEGY"] = strategy
+    for key, value in profile.get("env", {}).items():
+        env[key] = str(value)
+    return env
+
+
+def execute_ansible_commands(commands, dryrun, timeouts=(None, None), journal=None):
     """Helper to execute a list of ansible commands.
 
     Args:
         commands (list): List of command dictionaries as prepared by ansible_command_sequence.
         dryrun (bool): Enable dryrun execution mode.
+        timeouts (tuple): max number of seconds for each command and for the whole list,
+                          as returned by CONF.get_timeouts. None for no limit.
+        journal (AnsibleJournal): skip the commands already completed
+                                  and record the ones completed now. None to not use it.
 
     Returns:
         Status: Execution result, 0 means OK.
     """
+    cmd_timeout, stage_timeout = timeouts
+    stage_deadline = None
+    if stage_timeout is not None:
+        stage_deadline = time.monotonic() + stage_timeout
     for command in commands:
         if dryrun:
             print(command["cmd"])
+        elif journal is not None and journal.done(command):
+            log.info("Skip %s, already completed", command["cmd"])
         else:
-            ret, out = lib.process_manager.subprocess_run(**command)
-            log.debug("Ansible process return ret:%d", ret)
-            if "ansible-playbook" in command["cmd"]:
-                ansible_export_output(command["cmd"], out)
-            if ret != 0:
-                log.error("command:%s returned non zero %d", command, ret)
-                return Status(f"Error rc: {ret} at {command}")
+            timeout, by_stage = command_timeout(cmd_timeout, stage_deadline)
+            run_opts = {}
+            if timeout is not None:
+                if timeout <= 0:
+                    return timeout_status(
+                        "Ansible", command["cmd"], timeout, stage_timeout, by_stage
+                    )
+                run_opts["timeout"] = timeout
+            ret, _ = lib.process_manager.subprocess_run(**command, **run_opts)
+            err = ansible_ret_status(ret, command, timeout, stage_timeout, by_stage)
+            if err is not None:
+                return err
+            if journal is not None:
+                journal.record(command)
     return Status("ok")
 
 
-def ansible_export_output(command, out):
-    """Write the Ansible (or ansible-playbook) stdout to file
+def ansible_ret_status(ret, command, timeout, stage_timeout, by_stage):
+    """Compose the Status for the exit code of an ansible command
 
-    Function is in charge to:
-    - get a cmd and calculate from it the log file name to write.
-      The filename is calculated, when available, from the playbook name:
-      stripping '.yaml' and adding '.log.txt'
-    - open a file in write mode. Path for this file is the current directory
-    - write to the file the content of the out variable.
-      Each element of the out list to a new file line
+    Args:
+        ret (int): exit code of the command
+        command (dict): the executed command, as prepared by ansible_command_sequence
+        timeout (float): the timeout used for the command, None if no timeout
+        stage_timeout (float): the timeout of the whole sequence
+        by_stage (bool): True if the timeout is the one of the sequence
+
+    Returns:
+        Status: error, None if the command has been successful
+    """
+    log.debug("Ansible process return ret:%d", ret)
+    if ret == lib.process_manager.TIMEOUT_RC and timeout is not None:
+        return timeout_status(
+            "Ansible", command["cmd"], timeout, stage_timeout, by_stage
+        )
+    if ret == lib.process_manager.INTERRUPTED_RC:
+        return Status(f"Interrupted at {command['cmd']}")
+    if ret == lib.process_manager.ABORTED_RC and "line_handler" in command:
+        return Status(f"Aborted at {command['cmd']}: {command['line_handler'].matched}")
+    if ret != 0:
+        log.error("command:%s returned non zero %d", command, ret)
+        return Status(f"Error rc: {ret} at {command}")
+    return None
+
+
+def execute_ansible_dag(
+    commands, dependencies, dryrun, timeouts=(None, None), journal=None
+):
+    """Helper to execute ansible commands concurrently, respecting their dependencies
+
+    A command starts as soon as all the commands it depends on are successfully completed.
+    After the first failure no other command is started,
+    the ones already running are waited for.
 
     Args:
-        command (str): one cmd element as prepared by ansible_command_sequence
-        out (str list): as returned by subprocess_run
+        commands (list): List of command dictionaries as prepared by ansible_command_sequence.
+        dependencies (list of list of int): for each command, the indexes of the
+                                            commands that have to complete before it.
+                                            Only previous commands can be referred.
+        dryrun (bool): Enable dryrun execution mode.
+        timeouts (tuple): max number of seconds for each command and for the whole list,
+                          as returned by CONF.get_timeouts. None for no limit.
+        journal (AnsibleJournal): skip the commands already completed
+                                  and record the ones completed now. None to not use it.
+
+    Returns:
+        Status: Execution result, 0 means OK. The first failure, in commands order.
+    """
+    if dryrun:
+        for command in commands:
+            print(command["cmd"])
+        return Status("ok")
+    cmd_timeout, stage_timeout = timeouts
+    stage_deadline = None
+    if stage_timeout is not None:
+        stage_deadline = time.monotonic() + stage_timeout
+    # Status of each command, None if not executed
+    results = [None] * len(commands)
+
+    async def _run_all():
+        done = [asyncio.Event() for _ in commands]
+
+        async def _step(index):
+            command = commands[index]
+            try:
+                for dependency in dependencies[index]:
+                    await done[dependency].wait()
+                if any(result not in (None, 0) for result in results) or any(
+                    results[dependency] is None for dependency in dependencies[index]
+                ):
+                    log.info("Skip %s, a previous command failed", command["cmd"])
+                    return
+                if journal is not None and journal.done(command):
+                    log.info("Skip %s, already completed", command["cmd"])
+                    results[index] = Status("ok")
+                    return
+                run_opts = {}
+                timeout, by_stage = command_timeout(cmd_timeout, stage_deadline)
+                if timeout is not None:
+                    if timeout <= 0:
+                        results[index] = timeout_status(
+                            "Ansible", command["cmd"], timeout, stage_timeout, by_stage
+                        )
+                        return
+                    run_opts["timeout"] = timeout
+                ret, _ = await lib.process_manager.async_subprocess_run(
+                    **command, **run_opts
+                )
+                err = ansible_ret_status(ret, command, timeout, stage_timeout, by_stage)
+                results[index] = Status("ok") if err is None else err
+                if err is None and journal is not None:
+                    journal.record(command)
+                if ret == lib.process_manager.ABORTED_RC:
+                    # Fail fast: also stop the playbooks running concurrently
+                    for other in steps:
+                        if other is not asyncio.current_task():
+                            other.cancel()
+            finally:
+                done[index].set()
+
+        steps = [asyncio.ensure_future(_step(index)) for index in range(len(commands))]
+        # Steps cancelled by a fail fast abort are not a failure of the whole run
+        for outcome in await asyncio.gather(*steps, return_exceptions=True):
+            if isinstance(outcome, Exception):
+                raise outcome
+
+    try:
+        lib.process_manager.run_interruptible(_run_all())
+    except asyncio.CancelledError:
+        return Status("Interrupted while running the Ansible sequence")
+    for result in results:
+        if result not in (None, 0):
+            return result
+    return Status("ok")
+
+
+def ansible_readiness(config, inventory, admin_user, ssh_control_dir, dryrun):
+    """Wait for all the hosts in the inventory to be ready for the playbooks
+
+    Args:
+        config (obj): CONF instance
+        inventory (str): inventory.yaml file path
+        admin_user (str): name of the admin user
+        ssh_control_dir (str): folder for the SSH control sockets,
+                               None if SSH multiplexing is not used
+        dryrun (bool): enable dryrun execution mode
+
+    Returns:
+        Status: execution result, 0 means that all the hosts are ready
+    """
+    probe_conf = config.conf["ansible"]["readiness_probe"]
+    timeout = lib.readiness.DEFAULT_READINESS_TIMEOUT
+    if isinstance(probe_conf, dict):
+        # Already validated by the schema, see CONF.validate_ansible_config
+        timeout = probe_conf.get("timeout", timeout)
+    if dryrun:
+        log.info("Dryrun: skip the readiness probe of the hosts in %s", inventory)
+        return Status("ok")
+    ssh_args = None
+    if ssh_control_dir is not None:
+        ssh_args = lib.ssh_multiplex.ssh_args(
+            ssh_control_dir, config.conf["ansible"]["ssh_control_persist"]
+        )
+    reports = lib.readiness.wait_hosts(
+        inventory, admin_user, timeout=timeout, ssh_args=ssh_args
+    )
+    if reports is None:
+        return Status("Interrupted while waiting for the hosts")
+    not_ready = []
+    for report in reports:
+        log.info(
+            "Host %s ready:%s tcp:%ss ssh:%ss sudo:%ss",
+            report["host"],
+            report["ready"],
+            report.get("tcp", "-"),
+            report.get("ssh", "-"),
+            report.get("sudo", "-"),
+        )
+        if not report["ready"]:
+            not_ready.append(f"{report['host']} ({report['failed_at']})")
+    if not_ready:
+        return Status(f"Hosts not ready within {timeout}s: {', '.join(not_ready)}")
+    return Status("ok")
+
+
+def ansible_log_filename(playbook_path):
+    """Calculate the name of the file where to write the ansible-playbook stdout
+
+    The filename is calculated from the playbook name:
+    stripping '.yaml' and adding '.log.txt'.
+    The file is in the current directory.
+
+    Args:
+        playbook_path (str): playbook file, with or without path
+
+    Returns:
+        str: log file name
     """
-    # log name has to be derived from the name of the playbook:
-    # search the playbook name in all command words.
-    playbook_path = None
-    for cmd_element in command.split():
-        match = re.search(rf"{os.path.join('ansible', 'playbooks')}.*", cmd_element)
-        if match:
-            playbook_path = cmd_element
-            break
-    if playbook_path is None:
-        log.error("Unable to find which one is the playbook in %s", command)
-        return
     playbook_name = os.path.splitext(os.path.basename(playbook_path))[0]
-    log_filename = f"ansible.{playbook_name}.log.txt"
-    log.debug("Write %s getcwd:%s", log_filename, os.getcwd())
-    with open(log_filename, "w", encoding="utf-8") as log_file:
-        log_file.write("\n".join(out))
+    return f"ansible.{playbook_name}.log.txt"
 
 
 def cmd_ansible(
@@ -492,11 +1393,14 @@ def cmd_ansible(
     profile=False,
     junit=False,
     sequence=None,
+    resume=False,
+    timings=False,
+    retry_failed=False,
 ):
     """Main executor for the deploy sub-command
 
     Args:
-        configure_data (obj): configuration structure
+        configure_data (dict or CONF): configuration structure, see lib.config.get_config
         base_project (str): base project path where to
                       look for the Ansible files
         dryrun (bool): enable dryrun execution mode
@@ -506,10 +1410,17 @@ def cmd_ansible(
         sequence (str): only run a named section from the ansible::sequence conf.yaml part.
                        In case it is used with conf.yaml using apiver <4, only 'create' and 'destroy'
                        values are supported.
+        resume (bool): skip the playbooks completed by the previous runs of the same sequence,
+                       if their command line and the inventory are still the same
+        timings (bool): write the timing of each task, see ansible_command_sequence
+        retry_failed (bool): like resume, and only run the playbooks with retry_limit
+                             on the hosts that failed in the previous run
 
     Returns:
         Status: execution result, 0 means OK. It is mind to be used as script exit code
     """
+    config = lib.config.get_config(configure_data)
+    configure_data = config.conf
     if sequence:
         if (configure_data["apiver"] >= 4) or (sequence in ["create", "destroy"]):
             selected_sequence = sequence
@@ -523,7 +1434,6 @@ def cmd_ansible(
             selected_sequence = "destroy"
 
     # Validations
-    config = CONF(configure_data)
     if not config.has_section_or_variable(["ansible"]):
         err = f"Deployment configured without Ansible in {configure_data}"
         log.error(err)
@@ -548,17 +1458,150 @@ def cmd_ansible(
         base_project, "terraform", configure_data["provider"], "inventory.yaml"
     )
     ret, ansible_cmd_seq = ansible_command_sequence(
-        configure_data["ansible"],
+        config,
         admin_user,
         base_project,
         selected_sequence,
         inventory,
         profile,
         junit,
-        configure_data["apiver"],
+        timings=timings,
     )
     if not ret:
         log.error("ansible_command_sequence ret:%d", ret)
         return Status(ansible_cmd_seq)
 
-    return execute_ansible_commands(ansible_cmd_seq, dryrun)
+    ssh_control_dir = None
+    if config.has_section_or_variable(["ansible", "ssh_control_persist"]):
+        ssh_control_dir = lib.ssh_multiplex.control_dir(base_project)
+        log.info("Use SSH control sockets in %s", ssh_control_dir)
+        if not dryrun:
+            os.makedirs(ssh_control_dir, mode=0o700, exist_ok=True)
+
+    fact_cache_dir = None
+    if (
+        config.has_section_or_variable(["ansible", "fact_cache"])
+        and config.conf["ansible"]["fact_cache"]
+        and not dryrun
+    ):
+        # The cache only lasts for the duration of the sequence
+        fact_cache_dir = lib.fact_cache.cache_dir(base_project)
+        lib.fact_cache.clear(fact_cache_dir)
+
+    res = Status("ok")
+    try:
+        if (
+            config.has_section_or_variable(["ansible", "readiness_probe"])
+            and config.conf["ansible"]["readiness_probe"]
+        ):
+            res = ansible_readiness(
+                config, inventory, admin_user, ssh_control_dir, dryrun
+            )
+        # The playbooks are the last commands of the sequence,
+        # they run after all the preliminary ones
+        steps = config.get_playbook_steps(selected_sequence)
+        first_playbook = len(ansible_cmd_seq) - len(steps)
+        journal = None
+        if not dryrun:
+            journal = lib.ansible_journal.AnsibleJournal(
+                lib.ansible_journal.journal_file(base_project, selected_sequence),
+                inventory,
+                ansible_cmd_seq[first_playbook:],
+                resume=resume or retry_failed,
+            )
+            retry_path = lib.ansible_journal.retry_dir(base_project, selected_sequence)
+            if retry_failed:
+                ansible_retry_limit(
+                    ansible_cmd_seq[first_playbook:], steps, journal, retry_path
+                )
+            elif os.path.isdir(retry_path):
+                shutil.rmtree(retry_path)
+        if res == 0 and config.has_ansible_dag(selected_sequence):
+            dependencies = [
+                [index - 1] if index else [] for index in range(first_playbook)
+            ]
+            for step in steps:
+                after = [first_playbook + index for index in step["after"]]
+                if not after and first_playbook:
+                    after = [first_playbook - 1]
+                dependencies.append(after)
+            res = execute_ansible_dag(
+                ansible_cmd_seq,
+                dependencies,
+                dryrun,
+                timeouts=config.get_timeouts("ansible"),
+                journal=journal,
+            )
+        elif res == 0:
+            res = execute_ansible_commands(
+                ansible_cmd_seq,
+                dryrun,
+                timeouts=config.get_timeouts("ansible"),
+                journal=journal,
+            )
+    finally:
+        # Also on errors and interruptions, not to leave the masters around
+        if ssh_control_dir is not None:
+            lib.ssh_multiplex.teardown(ssh_control_dir, dryrun)
+        if fact_cache_dir is not None:
+            lib.fact_cache.clear(fact_cache_dir)
+    return res
+
+
+def cmd_report_timings(paths, top=20):
+    """Main executor for the report timings sub-command
+
+    Print the slowest Ansible tasks and the time spent on each host,
+    from the files written by 'ansible --timings'
+
+    Args:
+        paths (list of str): timing files, or folders where to look for them
+        top (int): number of tasks in the slowest tasks table
+
+    Returns:
+        Status: execution result, 0 means OK. It is mind to be used as script exit code
+    """
+    records = lib.ansible_timings.load(paths)
+    if not records:
+        return Status(f"No Ansible task timings in {paths}")
+    print(lib.ansible_timings.format_report(records, top), end="")
+    return Status("ok")
+
+
+def cmd_validate(paths, max_concurrent=None):
+    """Main executor for the validate sub-command
+
+    Validate many conf.yaml files, each with the schema of its apiver,
+    in parallel processes. All the problems of each file are printed,
+    one per line, like <FILE>:<LINE>: <YAML PATH>: <MESSAGE>
+
+    Args:
+        paths (list of str): conf.yaml files
+        max_concurrent (int): max number of processes. None for the number of CPUs.
+
+    Returns:
+        Status: execution result, 0 means that all the files are valid
+    """
+    if len(paths) > 1 and max_concurrent != 1:
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=max_concurrent
+        ) as executor:
+            results = list(executor.map(lib.schema.validate_file, paths, chunksize=8))
+    else:
+        results = [lib.schema.validate_file(path) for path in paths]
+    invalid = 0
+    total = 0
+    for path, errors in zip(paths, results):
+        if not errors:
+            log.info("%s is valid", path)
+            continue
+        invalid += 1
+        total += len(errors)
+        for error in errors:
+            location = f"{path}:{error.line}" if error.line else path
+            print(f"{location}: {lib.schema.format_path(error.path)}: {error.message}")
+    if invalid:
+        return Status(
+            f"{total} errors in {invalid} of {len(paths)} configuration files"
+        )
+    return Status("ok")
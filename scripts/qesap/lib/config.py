@@ -2,10 +2,17 @@
 configuration file related libraries
 """
 
-import re
+import copy
+import functools
+import json
 import os
 import logging
 
+import lib.fail_fast
+import lib.schema
+import lib.tfvars
+from lib.schema import DEFAULT_PARALLEL_POLICY, TFVARS_FORMATS, parse_size
+
 log = logging.getLogger("QESAP")
 
 
@@ -43,48 +50,141 @@ def yaml_to_tfvars_entry(key, value):
     return entry
 
 
-def validate_ansible_hana_var(hana_var):
+class ReadOnlyDict(dict):
     """
-    Validate hana_vars
+    dict of a frozen configuration, that cannot be modified.
+    Its deep copy is a regular, modifiable, dict.
     """
-    mandatory = [
-        ("sap_hana_install_software_directory", lambda value: re.search(r"/.*", value)),
-        ("sap_hana_install_master_password", None),
-        (
-            "sap_hana_install_sid",
-            lambda value: len(hana_var["sap_hana_install_sid"]) == 3,
-        ),
-        (
-            "sap_hana_install_instance_number",
-            lambda value: re.search(r"^[0-9]{2}$", value),
-        ),
-        ("sap_domain", None),
-        ("primary_site", None),
-        ("secondary_site", None),
-    ]
-    for mandatory_value in mandatory:
-        if mandatory_value[0] not in hana_var:
-            log.error("Mandatory %s not present in 'hana_var'", mandatory_value[0])
-            return False
-        if mandatory_value[1] is not None:
-            if not mandatory_value[1](hana_var[mandatory_value[0]]):
-                log.error(
-                    "Invalid value '%s':%s",
-                    mandatory_value[0],
-                    hana_var[mandatory_value[0]],
-                )
-                return False
-    return True
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("The configuration is read-only")
+
+    __setitem__ = __delitem__ = __ior__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return {key: copy.deepcopy(value, memo) for key, value in self.items()}
+
+    def __reduce__(self):
+        return (ReadOnlyDict, (dict(self),))
+
+
+class ReadOnlyList(list):
+    """
+    list of a frozen configuration, that cannot be modified.
+    Its deep copy is a regular, modifiable, list.
+    """
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("The configuration is read-only")
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _read_only
+    append = extend = insert = pop = remove = clear = sort = reverse = _read_only
+
+    def __copy__(self):
+        return list(self)
+
+    def __deepcopy__(self, memo):
+        return [copy.deepcopy(value, memo) for value in self]
+
+    def __reduce__(self):
+        return (ReadOnlyList, (list(self),))
+
+
+def read_only(value):
+    """
+    Get a read-only copy of a configuration structure
+
+    Args:
+        value: configuration structure, as loaded from the conf.yaml
+
+    Returns:
+        the same structure, with each dict and list replaced by
+        a ReadOnlyDict and a ReadOnlyList
+    """
+    if isinstance(value, dict):
+        return ReadOnlyDict({key: read_only(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return ReadOnlyList(read_only(item) for item in value)
+    return value
+
+
+def get_config(configure_data):
+    """
+    Get the frozen configuration object used by the cmd_* functions
+
+    Args:
+        configure_data (dict or CONF): configuration structure from the conf.yaml,
+                                       or a CONF already built from it
+
+    Returns:
+        CONF: a frozen CONF, the same object if configure_data already is a frozen one.
+              A not frozen CONF is copied, not frozen in place.
+    """
+    if isinstance(configure_data, CONF):
+        if configure_data.frozen:
+            return configure_data
+        configure_data = configure_data.conf
+    return CONF(configure_data).freeze()
+
+
+def memoized(method):
+    """
+    Cache the result of a CONF method for each set of arguments,
+    only for the frozen CONF instances. Each call gets its own copy
+    of the result, so that the cached one cannot be modified.
+    """
+
+    @functools.wraps(method)
+    def _wrapper(self, *args):
+        if not self.frozen:
+            return method(self, *args)
+        key = (method.__name__,) + tuple(
+            tuple(arg) if isinstance(arg, list) else arg for arg in args
+        )
+        if key not in self.memo:
+            self.memo[key] = method(self, *args)
+        return copy.deepcopy(self.memo[key])
+
+    return _wrapper
 
 
 class CONF:
     """
     Class to manipulate data from the config.yaml
+
+    A frozen CONF, see freeze(), has its own read-only copy of the configuration
+    data, and it caches the result of the validations and of the accessors:
+    it can be built once and shared by all the steps of a deployment,
+    and by many deployments in the same process.
     """
 
     def __init__(self, configure_data):
+        self.memo = {}
+        self.frozen = False
         self.conf = configure_data
 
+    def __setattr__(self, name, value):
+        if getattr(self, "frozen", False):
+            raise AttributeError(f"Frozen configuration, cannot set {name}")
+        super().__setattr__(name, value)
+
+    def freeze(self):
+        """
+        Replace the configuration with a read-only copy of it
+        and enable the memoization of its methods
+
+        Returns:
+            CONF: self, to chain with the constructor
+        """
+        if not self.frozen:
+            self.conf = read_only(self.conf)
+            self.frozen = True
+        return self
+
     def get_terraform_bin(self):
         """
         Allow to specify a custom binary to be used in place of terraform.
@@ -97,6 +197,29 @@ class CONF:
         # in its way (PATH env var)
         return "terraform"
 
+    def get_plugin_cache(self):
+        """
+        Get the Terraform provider plugin cache configuration
+
+        Returns:
+            (str, int): absolute path of the cache folder, None if not configured,
+                        and max cache size in bytes, None if not configured or invalid
+        """
+        if not self.has_section_or_variable(["terraform", "plugin_cache_dir"]):
+            return None, None
+        cache_dir = os.path.abspath(
+            os.path.expanduser(self.conf["terraform"]["plugin_cache_dir"])
+        )
+        max_size = None
+        if self.has_section_or_variable(["terraform", "plugin_cache_max_size"]):
+            max_size = parse_size(self.conf["terraform"]["plugin_cache_max_size"])
+            if max_size is None:
+                log.error(
+                    "Invalid terraform:plugin_cache_max_size %r",
+                    self.conf["terraform"]["plugin_cache_max_size"],
+                )
+        return cache_dir, max_size
+
     def yaml_to_tfvars(self):
         """
         Takes data structure collected from the terraform part
@@ -116,6 +239,57 @@ class CONF:
         log.debug("config_out:%s", config_out)
         return config_out
 
+    @memoized
+    def get_tfvars_format(self):
+        """
+        Get the format of the generated tfvars file, from terraform:tfvars_format
+
+        Returns:
+            str: 'hcl' for terraform.tfvars, 'json' for terraform.tfvars.json
+        """
+        if self.has_section_or_variable(["terraform", "tfvars_format"]):
+            return self.conf["terraform"]["tfvars_format"]
+        return TFVARS_FORMATS[0]
+
+    def yaml_to_tfvars_json(self, tfvars_template=None):
+        """
+        Takes data structure collected from the terraform part of the yaml config
+        and merges it in the content of a terraform.tfvars.json file.
+        Values are used as they are: numbers, bools, strings and nested
+        lists and maps are all preserved by the JSON encoding.
+
+        Args:
+            tfvars_template (str): path to a JSON tfvars template file, None for no template.
+                                   Variables from the yaml config win over the template ones.
+
+        Returns:
+            dict: terraform.tfvars.json content. None for error.
+        """
+        content = {}
+        if tfvars_template:
+            if not tfvars_template.endswith(".json"):
+                log.error(
+                    "terraform:tfvars_format json needs a .tfvars.json template, got %s",
+                    tfvars_template,
+                )
+                return None
+            log.info("Read %s", tfvars_template)
+            try:
+                with open(tfvars_template, "r", encoding="utf-8") as file:
+                    content = json.load(file)
+            except ValueError as exc:
+                log.error("Invalid JSON in %s: %s", tfvars_template, exc)
+                return None
+            if not isinstance(content, dict):
+                log.error("The template %s is not a JSON object", tfvars_template)
+                return None
+        if self.terraform_yml():
+            content.update(self.conf["terraform"]["variables"])
+        else:
+            log.debug("No terraform variables in the configure.yaml to merge")
+        return content
+
+    @memoized
     def terraform_yml(self):
         """
         Check if Terraform:variables are present in the config.yaml
@@ -174,7 +348,9 @@ class CONF:
         ```
 
         They are also copied in the final .tfvars. Eventually values for them is updated if
-        same variable is also specified in the conf.yaml
+        same variable is also specified in the conf.yaml: the whole assignment is replaced,
+        also when its value is a multi-line list, map or heredoc string.
+        Only the exact variable name is matched, not commented out assignments.
 
         Args:
             tfvars_template (str): path to the tfvars template file
@@ -192,47 +368,97 @@ class CONF:
                 return tfvar_content
 
             log.debug("Config has terraform variables")
+            entries = {}
             for key, value in self.conf["terraform"]["variables"].items():
-                key_replace = False
-                # Look for key in the template file content
-                for index, line in enumerate(tfvar_content):
-                    if re.search(rf"{key}\s*=.*", line):
-                        log.debug(
-                            "Replace template %s with [%s = %s]", line, key, value
-                        )
-                        tfvar_content[index] = yaml_to_tfvars_entry(key, value) + "\n"
-                        key_replace = True
-                # add the new key/value pair
-                if not key_replace:
-                    log.debug(
-                        "[k:%s = v:%s] is not in the template, append it", key, value
-                    )
-                    entry = yaml_to_tfvars_entry(key, value)
-                    if entry is None:
-                        return None
-                    tfvar_content.append(f"{entry}\n")
+                entries[key] = yaml_to_tfvars_entry(key, value)
+                if entries[key] is None:
+                    return None
+            tfvar_content = lib.tfvars.merge(tfvar_content, entries)
             log.debug("Result terraform.tfvars:\n%s", tfvar_content)
             return tfvar_content
 
+    @memoized
+    def get_schema_errors(self):
+        """
+        Validate the whole configuration with the schema of its apiver, see lib.schema
+
+        Returns:
+            list of SchemaError: all the problems found, empty if the configuration is valid
+        """
+        return lib.schema.validate_config(self.conf)
+
+    def _validate_schema(self, prefix=(), exclude=None):
+        """
+        Log all the schema errors within a part of the configuration
+
+        Args:
+            prefix (tuple): path of the part to validate, the empty path for all of it
+            exclude (tuple): path of a sub-part to not validate, None to validate all of it
+
+        Returns:
+            bool: True if that part of the configuration is valid
+        """
+        valid = True
+        for error in self.get_schema_errors():
+            if error.path[: len(prefix)] != prefix:
+                continue
+            if exclude is not None and error.path[: len(exclude)] == exclude:
+                continue
+            log.error("%s: %s", lib.schema.format_path(error.path), error.message)
+            valid = False
+        return valid
+
+    @memoized
     def validate(self):
         """
         Validate the mandatory and common part
-        of the internal structure of the configure.yaml
+        of the internal structure of the configure.yaml.
+        The ansible section is validated by validate_ansible_config.
         """
         log.debug("Configure data:%s", self.conf)
-        if self.conf is None:
-            log.error("Empty config")
-            return False
+        return self._validate_schema(exclude=("ansible",))
 
-        if "apiver" not in self.conf or not isinstance(self.conf["apiver"], int):
-            log.error("Error at 'apiver' in the config")
-            return False
+    def validate_parallel_policy(self):
+        """
+        Validate the optional terraform:parallel_policy
+        """
+        return self._validate_schema(("terraform", "parallel_policy"))
 
-        if "provider" not in self.conf or not isinstance(self.conf["provider"], str):
-            log.error("Error at 'provider' in the config")
-            return False
-        return True
+    @memoized
+    def get_parallel_policy(self):
+        """
+        Get the policy for 'terraform --parallel auto':
+        the defaults in DEFAULT_PARALLEL_POLICY updated with terraform:parallel_policy
+
+        Returns:
+            dict: the policy
+        """
+        policy = dict(DEFAULT_PARALLEL_POLICY)
+        if self.has_section_or_variable(["terraform", "parallel_policy"]):
+            policy.update(self.conf["terraform"]["parallel_policy"])
+        return policy
+
+    @memoized
+    def get_timeouts(self, section):
+        """
+        Get the timeouts configured for the 'terraform' or 'ansible' section
+
+        Args:
+            section (str): 'terraform' or 'ansible'
 
+        Returns:
+            (float, float): max number of seconds for each single command
+                            and for the whole section. None if not configured.
+        """
+        timeouts = []
+        for timeout in ["command_timeout", "stage_timeout"]:
+            if self.has_section_or_variable([section, timeout]):
+                timeouts.append(self.conf[section][timeout])
+            else:
+                timeouts.append(None)
+        return tuple(timeouts)
+
+    @memoized
     def has_section_or_variable(self, variable_path):
         """
         Check if a variable exists in the conf.yaml.
@@ -251,37 +477,7 @@ class CONF:
             current = current[key]
         return True
 
-    @staticmethod
-    def validate_ansible_media_config(ansible_conf, apiver):
-        """
-        Validate the media part of the ansible configure.yaml
-        """
-        if apiver < 3:
-            log.error("Apiver: %d is no longer supported", apiver)
-            return False
-
-        if "hana_media" not in ansible_conf or ansible_conf["hana_media"] is None:
-            log.error("Missing or empty 'hana_media' in 'ansible' in the config")
-            return False
-
-        for media in ansible_conf["hana_media"]:
-            match = re.search(r"^http[s]?://.*", media)
-            if match:
-                log.error("Media %s provided as full url. File name expected.", media)
-                return False
-
-        for var in ["az_storage_account_name", "az_container_name"]:
-            if var not in ansible_conf:
-                log.error(
-                    "Missing '%s' in 'ansible' in the config: %s", var, ansible_conf
-                )
-                return False
-
-        if "az_sas_token" not in ansible_conf and "az_key_name" not in ansible_conf:
-            log.error("Both az_sas_token and az_key_name missing in the config")
-            return False
-        return True
-
+    @memoized
     def has_ansible_playbooks(self, sequence):
         """
         Return True if the `sequence` has at least
@@ -311,6 +507,7 @@ class CONF:
                 return False
         return True
 
+    @memoized
     def get_playbooks(self, sequence):
         """
         Get list of playbooks
@@ -319,16 +516,76 @@ class CONF:
             return self.conf["ansible"][sequence]
         return self.conf["ansible"]["sequences"][sequence]
 
+    @memoized
+    def get_playbook_steps(self, sequence):
+        """
+        Get the playbooks of a sequence as the steps of a dependency graph.
+
+        Each element of the sequence is a string, with the playbook and its arguments,
+        or a dictionary with the keys:
+          - playbook: the playbook and its arguments
+          - name (optional): name of the step, default is the playbook file name without extension
+          - after (optional): name, or list of names, of the steps that have to complete
+                              before this one. Default is the previous step.
+          - hosts (optional): only run the playbook on these hosts or groups (--limit)
+          - profile (optional): name of the ansible:execution_profiles entry to use.
+                                Default is the profile named 'default', if any.
+          - retry_limit (optional): with 'ansible --retry-failed' only run the playbook
+                                    on the hosts that failed in the previous run. Default False.
+
+        The sequence has to be already validated by _validate_ansible_sequence.
+
+        Returns:
+            list of dict: one dict for each step, with keys playbook, name, hosts, profile,
+                          retry_limit and after, list of indexes of the steps to wait for
+        """
+        steps = []
+        for entry in self.get_playbooks(sequence):
+            if not isinstance(entry, dict):
+                entry = {"playbook": entry}
+            playbook_filename = os.path.basename(entry["playbook"].split()[0])
+            step = {
+                "playbook": entry["playbook"],
+                "name": entry.get("name", os.path.splitext(playbook_filename)[0]),
+                "hosts": entry.get("hosts"),
+                "profile": entry.get("profile"),
+                "retry_limit": entry.get("retry_limit", False),
+            }
+            if step["profile"] is None and "default" in self.get_execution_profiles():
+                step["profile"] = "default"
+            if "after" in entry:
+                after = entry["after"]
+                if isinstance(after, str):
+                    after = [after]
+                names = [previous["name"] for previous in steps]
+                step["after"] = [names.index(name) for name in after]
+            else:
+                step["after"] = [len(steps) - 1] if steps else []
+            steps.append(step)
+        return steps
+
+    @memoized
+    def has_ansible_dag(self, sequence):
+        """
+        Return True if at least one playbook of the sequence
+        explicitly declares its dependencies with 'after'.
+        """
+        return any(
+            isinstance(entry, dict) and "after" in entry
+            for entry in self.get_playbooks(sequence)
+        )
+
     def _validate_ansible_sequence(self, sequence):
         """
-        Validate the sequence part of the ansible configure.yaml
+        Validate that the sequence is in the ansible configure.yaml,
+        its steps are validated by the schema
         """
         if not sequence:
             return True
         selected_seq = (
             self.conf["ansible"]
             if self.conf["apiver"] < 4
-            else self.conf["ansible"].get("sequences", {})
+            else self.conf["ansible"].get("sequences") or {}
         )
         if sequence not in selected_seq or selected_seq[sequence] is None:
             log.error(
@@ -339,25 +596,64 @@ class CONF:
             return False
         return True
 
-    @staticmethod
-    def validate_ansible_verbosity(ansible_conf):
+    @memoized
+    def get_execution_profiles(self):
         """
-        Validate the verbosity part of the ansible configure.yaml
+        Get the ansible:execution_profiles
+
+        Returns:
+            dict: profile name as key, dict of its settings as value
         """
-        if "verbosity" in ansible_conf:
-            verbosity = ansible_conf["verbosity"]
-            try:
-                verbosity = int(verbosity)
-            except (ValueError, TypeError):
-                log.error("ansible verbosity must be an integer, got: %r", verbosity)
-                return False
-            if not 1 <= verbosity <= 6:
-                log.error(
-                    "ansible verbosity must be between 1 and 6, got: %d", verbosity
-                )
-                return False
-        return True
+        if not self.has_section_or_variable(["ansible", "execution_profiles"]):
+            return {}
+        return self.conf["ansible"]["execution_profiles"] or {}
 
+    def validate_execution_profiles(self):
+        """
+        Validate the optional ansible:execution_profiles
+        """
+        return self._validate_schema(("ansible", "execution_profiles"))
+
+    @memoized
+    def get_fail_fast_patterns(self):
+        """
+        Get the ansible:fail_fast patterns.
+
+        ansible:fail_fast is true, to use the default patterns, or a list.
+        Each element is a regular expression or a dictionary with keys
+        'task', regular expression of the task name, and optionally
+        'pattern', default is to match any fatal error in the task.
+
+        Returns:
+            list of dict: each with keys 'pattern' and 'task' (None for any task).
+                          Empty list if fail fast is not enabled.
+        """
+        if not self.has_section_or_variable(["ansible", "fail_fast"]):
+            return []
+        fail_fast = self.conf["ansible"]["fail_fast"]
+        if fail_fast is True:
+            fail_fast = lib.fail_fast.DEFAULT_FAIL_FAST_PATTERNS
+        if not fail_fast:
+            return []
+        patterns = []
+        for item in fail_fast:
+            if isinstance(item, str):
+                item = {"pattern": item}
+            patterns.append(
+                {
+                    "task": item.get("task"),
+                    "pattern": item.get("pattern", lib.fail_fast.DEFAULT_TASK_PATTERN),
+                }
+            )
+        return patterns
+
+    def validate_fail_fast(self):
+        """
+        Validate the optional ansible:fail_fast
+        """
+        return self._validate_schema(("ansible", "fail_fast"))
+
+    @memoized
     def validate_ansible_config(self, sequence):
         """
         Validate the ansible part of the internal structure of the config.yaml
@@ -366,31 +662,18 @@ class CONF:
             log.info("No Ansible section in the conf.yaml. Nothing to validate.")
             return True
 
-        if self.conf["ansible"] is None:
-            log.error("No content in the Ansible section in the conf.yaml")
-            return False
-
         log.debug("Configure ansible part of data:%s", self.conf["ansible"])
 
-        if not self.validate_ansible_media_config(
-            self.conf["ansible"], self.conf["apiver"]
-        ):
-            log.error("Ansible media configuration")
+        # All the errors are reported, not only the first one
+        valid = self._validate_schema(("ansible",))
+        if not valid or not isinstance(self.conf.get("apiver"), int):
             return False
-
-        if not self._validate_ansible_sequence(sequence):
-            return False
-
-        if "hana_vars" in self.conf["ansible"] and not validate_ansible_hana_var(
-            self.conf["ansible"]["hana_vars"]
-        ):
-            return False
-
-        return self.validate_ansible_verbosity(self.conf["ansible"])
+        return self._validate_ansible_sequence(sequence)
 
     def validate_basedir(self, basedir):
         """
-        Validate the file and folder structure of the main repository
+        Validate the file and folder structure of the main repository.
+        Not memoized, as it depends on the file system.
         """
         terraform_dir = os.path.join(basedir, "terraform")
         result = {
@@ -417,6 +700,8 @@ class CONF:
                 return False
 
         result["tfvars_file"] = os.path.join(result["provider"], "terraform.tfvars")
+        if self.get_tfvars_format() == "json":
+            result["tfvars_file"] += ".json"
         if self.has_section_or_variable(["ansible"]):
             result["hana_media_file"] = os.path.join(
                 ansible_pl_vars_dir, "hana_media.yaml"
@@ -0,0 +1,84 @@
+"""
+Ansible facts cache shared by all the playbooks of a sequence
+"""
+
+import logging
+import os
+import shutil
+
+log = logging.getLogger("QESAP")
+
+# Folder, within the base project folder, for the jsonfile facts cache
+FACT_CACHE_DIR = os.path.join(".qesap", "facts")
+
+# Playbooks that reboot or patch the hosts: facts gathered before them are stale
+DEFAULT_INVALIDATE_AFTER = ["fully-patch-system.yaml", "sap-hana-preconfigure.yaml"]
+
+
+def cache_dir(base_project):
+    """Get the folder of the facts cache of one deployment
+
+    Args:
+        base_project (str): base project path
+
+    Returns:
+        str: absolute path of the folder
+    """
+    return os.path.join(os.path.abspath(base_project), FACT_CACHE_DIR)
+
+
+def cache_env(cache_path):
+    """Compose the environment variables to enable the facts cache
+
+    With 'smart' gathering, facts are only gathered
+    by the first playbook that needs them for each host.
+
+    Args:
+        cache_path (str): folder of the cache, see cache_dir
+
+    Returns:
+        dict: environment variables for ansible-playbook
+    """
+    return {
+        "ANSIBLE_CACHE_PLUGIN": "jsonfile",
+        "ANSIBLE_CACHE_PLUGIN_CONNECTION": cache_path,
+        "ANSIBLE_GATHERING": "smart",
+    }
+
+
+def flush_after(steps, invalidate_after=None):
+    """Find the steps that have to flush the facts cache
+
+    A step flushes the cache if it depends on a playbook that invalidates it.
+
+    Args:
+        steps (list of dict): the steps of a sequence, see CONF.get_playbook_steps
+        invalidate_after (list of str): playbook file names that invalidate the cache.
+                                        None to use DEFAULT_INVALIDATE_AFTER
+
+    Returns:
+        set of int: indexes of the steps
+    """
+    if invalidate_after is None:
+        invalidate_after = DEFAULT_INVALIDATE_AFTER
+    invalidating = {
+        index
+        for index, step in enumerate(steps)
+        if os.path.basename(step["playbook"].split()[0]) in invalidate_after
+    }
+    return {
+        index
+        for index, step in enumerate(steps)
+        if invalidating.intersection(step["after"])
+    }
+
+
+def clear(cache_path):
+    """Remove all the facts in the cache
+
+    Args:
+        cache_path (str): folder of the cache, see cache_dir
+    """
+    if os.path.isdir(cache_path):
+        log.debug("Clear the facts cache %s", cache_path)
+        shutil.rmtree(cache_path)
@@ -0,0 +1,59 @@
+"""
+Early abort of an Ansible playbook when its output shows an unrecoverable error
+"""
+
+import logging
+import re
+
+log = logging.getLogger("QESAP")
+
+# Patterns used by ansible:fail_fast: true
+DEFAULT_FAIL_FAST_PATTERNS = [r"UNREACHABLE!"]
+
+# Pattern used by the entries of ansible:fail_fast with only the task name
+DEFAULT_TASK_PATTERN = r"^fatal: "
+
+# Header printed by ansible-playbook at the start of each task
+TASK_RE = re.compile(r"^(?:TASK|RUNNING HANDLER) \[(.*)\]")
+
+
+class FailFastDetector:
+    """Line handler for subprocess_run that stops the process at the first fatal error
+
+    Each pattern is a regular expression matched against each output line,
+    optionally only within the tasks whose name matches another regular expression.
+    The process is terminated as soon as one line matches: patterns should not
+    match errors that are ignored by the playbook.
+    After the process completes, `matched` describes the matching line.
+    """
+
+    def __init__(self, patterns):
+        """
+        Args:
+            patterns (list of dict): each with keys 'pattern' and 'task' (None for any task)
+        """
+        self.patterns = [
+            (
+                re.compile(item["task"]) if item.get("task") is not None else None,
+                re.compile(item["pattern"]),
+            )
+            for item in patterns
+        ]
+        self.task = None
+        self.matched = None
+
+    def __call__(self, line):
+        task = TASK_RE.match(line)
+        if task:
+            self.task = task.group(1)
+            return False
+        for task_re, line_re in self.patterns:
+            if task_re is not None and (
+                self.task is None or not task_re.search(self.task)
+            ):
+                continue
+            if line_re.search(line):
+                self.matched = line if self.task is None else f"[{self.task}] {line}"
+                log.error("Fail-fast pattern '%s' matched: %s", line_re.pattern, line)
+                return True
+        return False
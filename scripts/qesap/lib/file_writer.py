@@ -0,0 +1,121 @@
+"""
+Atomic write of the generated files, only when their content changes
+"""
+
+import hashlib
+import json
+import logging
+import os
+import stat
+
+log = logging.getLogger("QESAP")
+
+# Record, within the base project folder, of the sha256 of each generated file
+GENERATED_RECORD = os.path.join(".qesap", "generated.json")
+
+
+def file_hash(path):
+    """Calculate the sha256 of a file
+
+    Args:
+        path (str): file path
+
+    Returns:
+        str: hex digest, None if the file does not exist
+    """
+    if not os.path.isfile(path):
+        return None
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def write_if_changed(path, content):
+    """Write a file only if its content is different from the existing one
+
+    An unchanged file keeps its mtime, so that tools caching on it
+    do not see a change. A changed file is written in a temporary file
+    in the same folder and then renamed, so that readers never see
+    a partially written file. The mode of the existing file is preserved.
+
+    Args:
+        path (str): file path
+        content (str): the whole file content
+
+    Returns:
+        bool: True if the file has been written
+    """
+    data = content.encode("utf-8")
+    if file_hash(path) == hashlib.sha256(data).hexdigest():
+        log.debug("%s is unchanged", path)
+        return False
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(temp_path, "wb") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        if os.path.isfile(path):
+            os.chmod(temp_path, stat.S_IMODE(os.stat(path).st_mode))
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    log.debug("%s written", path)
+    return True
+
+
+def _load_record(base_project):
+    record_path = os.path.join(base_project, GENERATED_RECORD)
+    try:
+        with open(record_path, "r", encoding="utf-8") as file:
+            record = json.load(file)
+    except (OSError, ValueError):
+        return {}
+    return record if isinstance(record, dict) else {}
+
+
+def _save_record(base_project, record):
+    record_path = os.path.join(base_project, GENERATED_RECORD)
+    os.makedirs(os.path.dirname(record_path), exist_ok=True)
+    write_if_changed(record_path, json.dumps(record, indent=2, sort_keys=True))
+
+
+def record_generated(base_project, paths):
+    """Record the current content of files generated by qesap.py
+
+    Args:
+        base_project (str): base project path, the files are within it
+        paths (list of str): paths of the generated files
+    """
+    record = _load_record(base_project)
+    for path in paths:
+        record[os.path.relpath(path, base_project)] = file_hash(path)
+    _save_record(base_project, record)
+
+
+def remove_generated(base_project, path):
+    """Remove a file only if it has been generated by qesap.py
+    and it has not been modified since then
+
+    Args:
+        base_project (str): base project path, the file is within it
+        path (str): file path
+
+    Returns:
+        bool: True if the file has been removed
+    """
+    if not os.path.isfile(path):
+        return False
+    record = _load_record(base_project)
+    key = os.path.relpath(path, base_project)
+    if record.get(key) != file_hash(path):
+        log.warning("Keep %s: it has not been generated by qesap.py", path)
+        return False
+    log.info("Remove %s", path)
+    os.remove(path)
+    del record[key]
+    _save_record(base_project, record)
+    return True
@@ -2,20 +2,215 @@
 All tools needed to manage external executable and processes
 """
 
+import asyncio
+import contextlib
+import contextvars
+import json
+import os
+import signal
 import subprocess
 import shlex
 import logging
+import time
+from collections import deque
+from datetime import datetime, timezone
 
 log = logging.getLogger("QESAP")
 
+# Number of output lines kept in memory, for the error report,
+# when the output is streamed to a log file.
+OUTPUT_TAIL_LINES = 100
+
+# Size of each read from the process stdout pipe
+READ_CHUNK_SIZE = 64 * 1024
+
+# Interval, in seconds, used to check if a process is terminated
+# after it has closed its stdout
+POLL_INTERVAL = 0.05
+
+# Time, in seconds, a terminated process group has to exit
+# after SIGTERM, before to get SIGKILL
+TERMINATE_GRACE = 30
+
+# Exit code returned for a process killed after its timeout.
+# It is the same used by the coreutils 'timeout'
+TIMEOUT_RC = 124
+
+# Exit code returned for a process terminated as its line_handler
+# asked to stop it
+ABORTED_RC = 125
+
+# Exit code returned for a process killed as qesap.py
+# received SIGINT (Ctrl-C) or SIGTERM
+INTERRUPTED_RC = 130
+
+# Resource accounting of each executed process, in order of completion,
+# in the list of the current record_steps context. See _account.
+# A context variable, so that many deployments in the same process
+# (in different threads or asyncio tasks) each get only their own steps.
+_RUN_STEPS = contextvars.ContextVar("qesap_run_steps", default=None)
+
+
+@contextlib.contextmanager
+def record_steps():
+    """Record the resource accounting of the processes executed within the context
+
+    Yields:
+        list of dict: accounting of each executed process, see _account
+    """
+    steps = []
+    token = _RUN_STEPS.set(steps)
+    try:
+        yield steps
+    finally:
+        _RUN_STEPS.reset(token)
+
+
+async def _read_lines(reader):
+    """Asynchronously generate the lines from a stream
+
+    The stream is read in chunks and not with readline,
+    so there is no limit on the length of a single line.
+
+    Args:
+        reader (asyncio.StreamReader): stream to read from
+
+    Yields:
+        bytes: one line, without the trailing newline
+    """
+    pending = b""
+    while True:
+        chunk = await reader.read(READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        pending += chunk
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            yield line
+    if pending:
+        yield pending
+
+
+def _poll(proc, block=False):
+    """Reap the process, if terminated, collecting its resource usage
+
+    os.wait4 is used in place of Popen.poll, so that the resource usage
+    of the process, and of all its waited descendants, is available.
+    It is stored in proc.rusage, the exit code in proc.returncode.
+
+    Args:
+        proc (subprocess.Popen): the process
+        block (bool): wait for the process to terminate
+
+    Returns:
+        int: the exit code, None if the process is still running
+    """
+    if proc.returncode is not None:
+        return proc.returncode
+    pid, status, rusage = os.wait4(proc.pid, 0 if block else os.WNOHANG)
+    if pid == 0:
+        return None
+    proc.rusage = rusage
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return proc.returncode
+
+
+def _account(cmd, log_file, returncode, start, start_time, rusage):
+    """Record the resource accounting of one executed process, see record_steps
+
+    Args:
+        cmd (str): the executed command
+        log_file (str): the file with the command output, could be None
+        returncode (int): exit code of the command
+        start (float): time.monotonic() value at process start
+        start_time (datetime): process start timestamp
+        rusage (resource.struct_rusage): resource usage as returned by os.wait4
+    """
+    step = {
+        "cmd": cmd,
+        "log_file": log_file,
+        "rc": returncode,
+        "start": start_time.isoformat(),
+        "end": datetime.now(timezone.utc).isoformat(),
+        "wall_time": round(time.monotonic() - start, 3),
+        "user_cpu": None,
+        "sys_cpu": None,
+        "max_rss_kb": None,
+    }
+    if rusage is not None:
+        step["user_cpu"] = round(rusage.ru_utime, 3)
+        step["sys_cpu"] = round(rusage.ru_stime, 3)
+        # On Linux ru_maxrss is in KiB
+        step["max_rss_kb"] = rusage.ru_maxrss
+    log.debug("Accounting %s", step)
+    steps = _RUN_STEPS.get()
+    if steps is not None:
+        steps.append(step)
+
+
+async def _terminate(proc, grace=TERMINATE_GRACE):
+    """Terminate the whole process group of a process and wait for it
+
+    The process group get SIGTERM, then SIGKILL if the process
+    is still running after `grace` seconds or if the termination
+    is cancelled (for example by a second Ctrl-C).
+
+    Args:
+        proc (subprocess.Popen): the process, leader of its process group
+        grace (int): seconds to wait before to use SIGKILL
+    """
+    log.info("Terminate process group %d", proc.pid)
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        return
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + grace
+    try:
+        while _poll(proc) is None and loop.time() < deadline:
+            await asyncio.sleep(POLL_INTERVAL)
+    finally:
+        if _poll(proc) is None:
+            log.error("Kill process group %d", proc.pid)
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            _poll(proc, block=True)
+
+
+async def async_subprocess_run(
+    cmd, env=None, log_file=None, tail=None, timeout=None, line_handler=None
+):
+    """Run one process within the asyncio event loop
+
+    The output of the process is read line by line while the process is running.
+    Each line is immediately logged and, if requested, written to a log file.
+    Only the last `tail` lines are kept in memory, so the memory usage
+    does not depend on the amount of output produced by the process.
+
+    The process is the leader of a new process group: if the timeout expires
+    or if this coroutine is cancelled, the whole process group is terminated.
+
+    Timing and resource usage of the process are recorded, see record_steps.
 
-def subprocess_run(cmd, env=None):
-    """Tiny wrapper around subprocess
     Args:
         cmd (string): properly splitted in list of string internally by shlex.plit
-                      before to be used as input for subprocess.run
+                      before to be used as input for subprocess.Popen
+        env (dict): environment for the process. None means inherit the current one
+        log_file (str): path of a file where to write the whole process output.
+                        The file is created or truncated. None means no log file.
+        tail (int): max number of stdout lines to keep and return. None means
+                    all of them when log_file is None, OUTPUT_TAIL_LINES otherwise
+        timeout (float): max number of seconds the process can run.
+                         None means no limit.
+        line_handler (callable): called with each output line,
+                                 while the process is running.
+                                 If it returns True the process group is terminated.
     Returns:
-        (int, list of string): exit code and list of stdout
+        (int, list of string): exit code and list of stdout.
+                               Exit code is TIMEOUT_RC if the timeout expired,
+                               ABORTED_RC if terminated by the line_handler.
     """
     if 0 == len(cmd):
         log.error("Empty command")
@@ -25,20 +220,217 @@ def subprocess_run(cmd, env=None):
     if env is not None:
         log.info("with env %s", env)
 
-    proc = subprocess.run(
-        shlex.split(cmd),
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-        check=False,
-        env=env,
-    )
+    if tail is None and log_file is not None:
+        tail = OUTPUT_TAIL_LINES
+    ret_stdout = deque(maxlen=tail)
+
+    args = shlex.split(cmd)
+    loop = asyncio.get_running_loop()
+    log_handler = None
+
+    async def _communicate(proc):
+        reader = asyncio.StreamReader()
+        transport, _ = await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), proc.stdout
+        )
+        try:
+            async for raw_line in _read_lines(reader):
+                line = raw_line.decode("UTF-8", errors="replace").rstrip("\r")
+                log.debug("OUTPUT: %s", line)
+                if log_handler is not None:
+                    log_handler.write(f"{line}\n")
+                ret_stdout.append(line)
+                if line_handler is not None and line_handler(line):
+                    log.error("Abort '%s'", cmd)
+                    await _terminate(proc)
+                    return ABORTED_RC
+        finally:
+            transport.close()
+        while _poll(proc) is None:
+            await asyncio.sleep(POLL_INTERVAL)
+        return proc.returncode
+
+    try:
+        if log_file is not None:
+            log.debug("Write %s", log_file)
+            log_handler = open(log_file, "w", encoding="utf-8")
+        # The process is not created with asyncio.create_subprocess_exec
+        # so that it does not depend on the asyncio child watcher:
+        # the process is reaped here, by polling it with os.wait4.
+        start = time.monotonic()
+        start_time = datetime.now(timezone.utc)
+        proc = subprocess.Popen(
+            args,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            env=env,
+            start_new_session=True,
+        )
+        proc.rusage = None
+        try:
+            returncode = await asyncio.wait_for(_communicate(proc), timeout)
+        except asyncio.TimeoutError:
+            log.error("Timeout of %ss expired for '%s'", timeout, cmd)
+            await _terminate(proc)
+            returncode = TIMEOUT_RC
+        except asyncio.CancelledError:
+            log.error("Interrupted '%s'", cmd)
+            await _terminate(proc)
+            _account(cmd, log_file, INTERRUPTED_RC, start, start_time, proc.rusage)
+            raise
+        _account(cmd, log_file, returncode, start, start_time, proc.rusage)
+    finally:
+        if log_handler is not None:
+            log_handler.close()
 
-    ret_stdout = list(proc.stdout.decode("UTF-8").splitlines())
-    if proc.returncode != 0:
-        log.error("ERROR %d in %s", proc.returncode, " ".join(cmd[0:1]))
-    for line in ret_stdout:
-        if proc.returncode != 0:
+    if returncode != 0:
+        log.error("ERROR %d in %s", returncode, args[0])
+        for line in ret_stdout:
             log.error("OUTPUT: %s", line)
-        else:
-            log.debug("OUTPUT: %s", line)
-    return (proc.returncode, ret_stdout)
+    return (returncode, list(ret_stdout))
+
+
+def run_interruptible(coroutine):
+    """Run a coroutine in a new event loop, cancelling it on SIGINT or SIGTERM
+
+    The cancellation terminates all the process groups started by the coroutine.
+
+    Args:
+        coroutine (coroutine): the coroutine to run
+    Returns:
+        the coroutine result
+    Raises:
+        asyncio.CancelledError: if the coroutine has been interrupted by a signal
+    """
+
+    async def _main():
+        loop = asyncio.get_running_loop()
+        task = asyncio.ensure_future(coroutine)
+
+        def _on_signal(signum):
+            log.error("Received signal %d, terminate all the processes", signum)
+            task.cancel()
+
+        handled_signals = []
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signum, _on_signal, signum)
+                handled_signals.append(signum)
+            except (ValueError, RuntimeError):
+                # Signal handlers can only be installed from the main thread
+                log.debug("Unable to handle signal %d", signum)
+        try:
+            return await task
+        finally:
+            for signum in handled_signals:
+                loop.remove_signal_handler(signum)
+
+    return asyncio.run(_main())
+
+
+def subprocess_run(
+    cmd, env=None, log_file=None, tail=None, timeout=None, line_handler=None
+):
+    """Tiny synchronous wrapper around async_subprocess_run
+
+    SIGINT (Ctrl-C) and SIGTERM received during the execution
+    are forwarded to the whole process group.
+    It cannot be called from a running asyncio event loop,
+    use async_subprocess_run there.
+
+    Args:
+        see async_subprocess_run
+    Returns:
+        (int, list of string): exit code and list of stdout.
+                               Exit code is TIMEOUT_RC if the timeout expired,
+                               INTERRUPTED_RC if interrupted by a signal.
+    """
+    try:
+        return run_interruptible(
+            async_subprocess_run(
+                cmd,
+                env=env,
+                log_file=log_file,
+                tail=tail,
+                timeout=timeout,
+                line_handler=line_handler,
+            )
+        )
+    except asyncio.CancelledError:
+        return (INTERRUPTED_RC, [])
+
+
+async def async_gather_limited(coroutines, max_concurrent=None):
+    """Await many coroutines concurrently, but only max_concurrent of them at a time
+
+    Args:
+        coroutines (list): coroutine objects to await
+        max_concurrent (int): max number of coroutines running at the same time.
+                              None means no limit.
+    Returns:
+        list: coroutines results, in the same order of the input list
+    """
+    if not max_concurrent:
+        return await asyncio.gather(*coroutines)
+    semaphore = asyncio.Semaphore(max_concurrent)
+
+    async def _limited(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    return await asyncio.gather(*[_limited(coroutine) for coroutine in coroutines])
+
+
+async def async_run_many(commands, max_concurrent=None):
+    """Run many processes concurrently within the asyncio event loop
+
+    Args:
+        commands (list of dict): each element is the set of arguments
+                                 for one async_subprocess_run call,
+                                 like {"cmd": "ls", "env": {...}, "log_file": "ls.log.txt"}
+        max_concurrent (int): max number of processes running at the same time.
+                              None means no limit.
+    Returns:
+        list of (int, list of string): exit code and list of stdout of each
+                                       command, in the same order of commands
+    """
+    return await async_gather_limited(
+        [async_subprocess_run(**command) for command in commands], max_concurrent
+    )
+
+
+def run_many(commands, max_concurrent=None):
+    """Synchronous wrapper around async_run_many
+
+    SIGINT (Ctrl-C) and SIGTERM received during the execution
+    are forwarded to all the process groups.
+
+    Args:
+        see async_run_many
+    Returns:
+        list of (int, list of string): exit code and list of stdout of each
+                                       command, in the same order of commands.
+                                       All the exit codes are INTERRUPTED_RC
+                                       if interrupted by a signal.
+    """
+    try:
+        return run_interruptible(
+            async_run_many(commands, max_concurrent=max_concurrent)
+        )
+    except asyncio.CancelledError:
+        return [(INTERRUPTED_RC, [])] * len(commands)
+
+
+def write_run_report(filename, summary, steps):
+    """Write a JSON report with the accounting of all the executed processes
+
+    Args:
+        filename (str): path of the JSON file to write
+        summary (dict): general information about the run
+        steps (list of dict): accounting of the executed processes, see record_steps
+    """
+    report = dict(summary)
+    report["steps"] = steps
+    log.debug("Write %s getcwd:%s", filename, os.getcwd())
+    with open(filename, "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=2)
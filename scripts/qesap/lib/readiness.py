@@ -0,0 +1,184 @@
+"""
+Readiness probe of the hosts in the Ansible inventory
+"""
+
+import asyncio
+import logging
+import shutil
+import time
+
+import yaml
+
+import lib.process_manager
+
+log = logging.getLogger("QESAP")
+
+# Default of ansible:readiness_probe:timeout, seconds to wait for all the hosts
+DEFAULT_READINESS_TIMEOUT = 180
+
+# Backoff between two attempts of the same probe, in seconds
+BACKOFF_INITIAL = 0.5
+BACKOFF_MAX = 8
+
+# Max time, in seconds, for each single probe attempt
+PROBE_TIMEOUT = 20
+
+
+def inventory_hosts(inventory):
+    """Get the hosts from an Ansible YAML inventory file
+
+    Variables defined at group level are inherited by the hosts.
+
+    Args:
+        inventory (str): inventory.yaml file path
+
+    Returns:
+        dict: host name as key and dict of its variables as value
+    """
+    with open(inventory, "r", encoding="utf-8") as file:
+        data = yaml.safe_load(file) or {}
+    hosts = {}
+
+    def _walk(group, inherited):
+        if not isinstance(group, dict):
+            return
+        group_vars = dict(inherited)
+        group_vars.update(group.get("vars") or {})
+        for name, host_vars in (group.get("hosts") or {}).items():
+            if name in hosts:
+                continue
+            hosts[name] = dict(group_vars)
+            hosts[name].update(host_vars or {})
+        for child in (group.get("children") or {}).values():
+            _walk(child, group_vars)
+
+    for group in data.values():
+        _walk(group, {})
+    return hosts
+
+
+async def _retry(probe, deadline):
+    """Call an async probe until it returns True, with exponential backoff
+
+    No attempt starts after the deadline and each attempt ends by the deadline.
+
+    Args:
+        probe (coroutine function): the probe, with the max number of seconds
+                                    for the attempt as argument
+        deadline (float): time.monotonic() value after which to give up
+
+    Returns:
+        bool: True if the probe succeeded before the deadline
+    """
+    backoff = BACKOFF_INITIAL
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        if await probe(min(PROBE_TIMEOUT, remaining)):
+            return True
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        await asyncio.sleep(min(backoff, remaining))
+        backoff = min(backoff * 2, BACKOFF_MAX)
+
+
+async def probe_host(name, host_vars, user, ssh_args, deadline):
+    """Wait for one host to be ready to run Ansible playbooks
+
+    The host is ready when, in this order:
+     - its SSH port accepts TCP connections
+     - it is possible to login with SSH. The host key is accepted
+       and saved in the known_hosts the first time.
+     - the user can use sudo without password
+
+    Args:
+        name (str): host name in the inventory
+        host_vars (dict): host variables from the inventory
+        user (str): default SSH user, if not ansible_user in host_vars
+        ssh_args (str): additional ssh arguments
+        deadline (float): time.monotonic() value after which to give up
+
+    Returns:
+        dict: readiness report for the host, with keys host, ready,
+              failed_at (name of the failed probe, None if ready)
+              and seconds needed to pass each probe
+    """
+    address = host_vars.get("ansible_host", name)
+    port = int(host_vars.get("ansible_port", 22))
+    user = host_vars.get("ansible_user", user)
+    start = time.monotonic()
+    report = {"host": name, "ready": False, "failed_at": None}
+
+    async def _tcp(timeout):
+        try:
+            _, writer = await asyncio.wait_for(
+                asyncio.open_connection(address, port), timeout
+            )
+        except (OSError, asyncio.TimeoutError) as exc:
+            log.debug("Host %s TCP %s:%d not ready: %s", name, address, port, exc)
+            return False
+        writer.close()
+        return True
+
+    ssh_cmd = (
+        f"{shutil.which('ssh') or 'ssh'} -o BatchMode=yes -o ConnectTimeout=10"
+        " -o UpdateHostKeys=yes -o StrictHostKeyChecking=accept-new"
+        f" -l {user} -p {port}"
+    )
+    if "ansible_ssh_private_key_file" in host_vars:
+        ssh_cmd += f" -i {host_vars['ansible_ssh_private_key_file']}"
+    if ssh_args:
+        ssh_cmd += f" {ssh_args}"
+
+    async def _ssh(remote_cmd, timeout):
+        ret, _ = await lib.process_manager.async_subprocess_run(
+            f"{ssh_cmd} {address} {remote_cmd}", tail=10, timeout=timeout
+        )
+        return ret == 0
+
+    for probe_name, probe in [
+        ("tcp", _tcp),
+        ("ssh", lambda timeout: _ssh("true", timeout)),
+        ("sudo", lambda timeout: _ssh("sudo -n true", timeout)),
+    ]:
+        if not await _retry(probe, deadline):
+            report["failed_at"] = probe_name
+            log.error("Host %s not ready, %s probe failed", name, probe_name)
+            return report
+        report[probe_name] = round(time.monotonic() - start, 3)
+    report["ready"] = True
+    log.info("Host %s ready in %.1fs", name, report["sudo"])
+    return report
+
+
+def wait_hosts(inventory, user, timeout=DEFAULT_READINESS_TIMEOUT, ssh_args=None):
+    """Wait, concurrently, for all the hosts in the inventory to be ready
+
+    Args:
+        inventory (str): inventory.yaml file path
+        user (str): default SSH user, if not ansible_user in the inventory
+        timeout (float): max number of seconds to wait for all the hosts
+        ssh_args (str): additional ssh arguments
+
+    Returns:
+        list of dict: readiness report of each host, see probe_host.
+                      None if interrupted.
+    """
+    hosts = inventory_hosts(inventory)
+    log.info("Wait for %d hosts to be ready, timeout %ss", len(hosts), timeout)
+    deadline = time.monotonic() + timeout
+
+    async def _all():
+        return await asyncio.gather(
+            *[
+                probe_host(name, host_vars, user, ssh_args, deadline)
+                for name, host_vars in hosts.items()
+            ]
+        )
+
+    try:
+        return lib.process_manager.run_interruptible(_all())
+    except asyncio.CancelledError:
+        return None
@@ -0,0 +1,596 @@
+"""
+Declarative schema of the conf.yaml, compiled once in validator functions
+that report all the errors, with their YAML path and line, in a single pass
+"""
+
+import collections
+import os
+import re
+import logging
+
+import yaml
+
+log = logging.getLogger("QESAP")
+
+# Policy used by 'terraform --parallel auto', overwritten by terraform:parallel_policy
+DEFAULT_PARALLEL_POLICY = {
+    "min": 10,
+    "max": 50,
+    "resources_per_worker": 2,
+    "throttle_retries": 2,
+    "provider_max": {},
+}
+
+# Values of terraform:tfvars_format, the first is the default
+TFVARS_FORMATS = ["hcl", "json"]
+
+# Settings of each ansible:execution_profiles entry and their type
+EXECUTION_PROFILE_KEYS = {
+    "forks": int,
+    "strategy": str,
+    "timeout": int,
+    "pipelining": bool,
+    "env": dict,
+}
+
+# Ansible strategy plugins that can be selected in an execution profile
+ANSIBLE_STRATEGIES = [
+    "linear",
+    "free",
+    "host_pinned",
+    "mitogen_linear",
+    "mitogen_free",
+    "mitogen_host_pinned",
+]
+
+# Size like 512, 100M, 1.5G or 10MiB
+SIZE_RE = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*$", re.IGNORECASE)
+
+# One problem found in a configuration:
+#  - path: tuple of the keys and list indexes of the wrong element
+#  - line: line number in the YAML file, None if not known
+#  - message: description of the problem
+SchemaError = collections.namedtuple("SchemaError", ["path", "line", "message"])
+
+# Oldest supported apiver
+MIN_APIVER = 3
+
+# Type names usable in the 'type' of a schema node
+TYPES = {
+    "str": (lambda value: isinstance(value, str), "a string"),
+    "int": (
+        lambda value: isinstance(value, int) and not isinstance(value, bool),
+        "an integer",
+    ),
+    "number": (
+        lambda value: isinstance(value, (int, float)) and not isinstance(value, bool),
+        "a number",
+    ),
+    "bool": (lambda value: isinstance(value, bool), "a boolean"),
+    "map": (lambda value: isinstance(value, dict), "a dictionary"),
+    "list": (lambda value: isinstance(value, list), "a list"),
+}
+
+
+def parse_size(value):
+    """
+    Convert a size like 512, '100M' or '1.5G' in number of bytes.
+    Suffixes K, M, G, T are powers of 1024.
+
+    Returns:
+        int: number of bytes, None if the value is not a valid size
+    """
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value if value >= 0 else None
+    if not isinstance(value, str):
+        return None
+    match = SIZE_RE.search(value)
+    if not match:
+        return None
+    exponent = " KMGT".index(match.group(2).upper() or " ")
+    return int(float(match.group(1)) * 1024**exponent)
+
+
+def format_path(path):
+    """Compose the text of a path, like ansible:sequences:create[2]:after
+
+    Args:
+        path (tuple): keys and list indexes
+
+    Returns:
+        str: the path, '<root>' for the empty path
+    """
+    text = ""
+    for item in path:
+        if isinstance(item, int):
+            text += f"[{item}]"
+        else:
+            text += f":{item}" if text else str(item)
+    return text or "<root>"
+
+
+def compile_schema(node):
+    """Compile a schema node in a validator function
+
+    A node is a dictionary with the optional keys:
+     - type: name, or list of names, of the allowed types, see TYPES
+     - keys: for a dictionary, the node of each known key
+     - values: for a dictionary, the node of the keys not in 'keys'
+     - closed: for a dictionary, True if keys not in 'keys' are errors
+     - required: for a dictionary, list of the mandatory keys
+     - require_any: for a dictionary, list of key groups, at least one key of each group is mandatory
+     - items: for a list, the node of each element
+     - min_items: for a list, min number of elements
+     - enum: list of the allowed values
+     - min, max: limits of a number, 'positive' to exclude 0
+     - pattern: regular expression that a string has to match, described by 'pattern_message'
+     - not_pattern: regular expression that a string must not match, described by 'pattern_message'
+     - regex: True if the string is a regular expression
+     - length: exact length of a string
+     - check: function of the value returning an iterable of (sub-path, message) tuples
+
+    All the regular expressions are compiled here, only once.
+
+    Args:
+        node (dict): the schema node
+
+    Returns:
+        function: validator(value, path, errors) appending
+                  a (path, message) tuple to errors for each problem
+    """
+    types = node.get("type")
+    if isinstance(types, str):
+        types = [types]
+    type_checks = [TYPES[name][0] for name in types or []]
+    type_message = " or ".join(TYPES[name][1] for name in types or [])
+    keys = {name: compile_schema(child) for name, child in node.get("keys", {}).items()}
+    values = compile_schema(node["values"]) if "values" in node else None
+    items = compile_schema(node["items"]) if "items" in node else None
+    closed = node.get("closed", False)
+    required = node.get("required", [])
+    require_any = node.get("require_any", [])
+    min_items = node.get("min_items")
+    enum = node.get("enum")
+    minimum = node.get("min")
+    maximum = node.get("max")
+    positive = node.get("positive", False)
+    pattern = re.compile(node["pattern"]) if "pattern" in node else None
+    not_pattern = re.compile(node["not_pattern"]) if "not_pattern" in node else None
+    pattern_message = node.get("pattern_message", "has an invalid format")
+    regex = node.get("regex", False)
+    length = node.get("length")
+    check = node.get("check")
+
+    def _validate(value, path, errors):
+        if type_checks and not any(type_check(value) for type_check in type_checks):
+            errors.append((path, f"must be {type_message}, got: {value!r}"))
+            return
+        if isinstance(value, dict):
+            for name in required:
+                if name not in value or value[name] is None:
+                    errors.append((path, f"missing mandatory '{name}'"))
+            for names in require_any:
+                if not any(name in value for name in names):
+                    errors.append(
+                        (path, f"at least one of {', '.join(names)} is mandatory")
+                    )
+            for key, item in value.items():
+                if item is None and key in required:
+                    # Already reported as missing
+                    continue
+                if key in keys:
+                    keys[key](item, path + (key,), errors)
+                elif values is not None:
+                    values(item, path + (key,), errors)
+                elif closed:
+                    errors.append((path + (key,), "unknown key"))
+        elif isinstance(value, list):
+            if min_items is not None and len(value) < min_items:
+                errors.append((path, f"must have at least {min_items} elements"))
+            if items is not None:
+                for index, item in enumerate(value):
+                    items(item, path + (index,), errors)
+        else:
+            if enum is not None and value not in enum:
+                errors.append((path, f"must be one of {enum}, got: {value!r}"))
+            if TYPES["number"][0](value):
+                if minimum is not None and value < minimum:
+                    errors.append((path, f"must be >= {minimum}, got: {value}"))
+                if maximum is not None and value > maximum:
+                    errors.append((path, f"must be <= {maximum}, got: {value}"))
+                if positive and value <= 0:
+                    errors.append((path, f"must be positive, got: {value}"))
+            if isinstance(value, str):
+                if pattern is not None and not pattern.search(value):
+                    errors.append((path, f"{pattern_message}: {value!r}"))
+                if not_pattern is not None and not_pattern.search(value):
+                    errors.append((path, f"{pattern_message}: {value!r}"))
+                if length is not None and len(value) != length:
+                    errors.append(
+                        (path, f"must be {length} characters long, got: {value!r}")
+                    )
+                if regex:
+                    try:
+                        re.compile(value)
+                    except re.error as exc:
+                        errors.append((path, f"invalid regular expression: {exc}"))
+        if check is not None:
+            for sub_path, message in check(value):
+                errors.append((path + tuple(sub_path), message))
+
+    return _validate
+
+
+def _check_steps(entries):
+    """Names and 'after' references of the steps of a sequence, see CONF.get_playbook_steps"""
+    if not isinstance(entries, list):
+        return
+    names = {}
+    for index, entry in enumerate(entries):
+        if isinstance(entry, str):
+            entry = {"playbook": entry}
+        if not isinstance(entry, dict) or not isinstance(entry.get("playbook"), str):
+            continue
+        after = entry.get("after", [])
+        if isinstance(after, str):
+            after = [after]
+        # Wrong types are reported by the schema
+        for name in after if isinstance(after, list) else []:
+            # Referring only to previous steps, the graph cannot have cycles
+            if isinstance(name, str) and names.get(name) != 1:
+                yield (
+                    (index, "after"),
+                    f"'{name}' does not refer to one previous step",
+                )
+        if "name" in entry:
+            name = entry["name"]
+            if not isinstance(name, str):
+                continue
+            if name in names:
+                yield ((index, "name"), f"duplicated name {name}")
+        else:
+            filename = os.path.basename((entry["playbook"].split() or [""])[0])
+            name = os.path.splitext(filename)[0]
+        names[name] = names.get(name, 0) + 1
+
+
+def _check_profiles(ansible):
+    """Each 'profile' of the sequence steps has to be in ansible:execution_profiles"""
+    if not isinstance(ansible, dict):
+        return
+    profiles = ansible.get("execution_profiles")
+    if not isinstance(profiles, dict):
+        profiles = {}
+    sequences = ansible.get("sequences")
+    if isinstance(sequences, dict):
+        sequences = [(("sequences", name), steps) for name, steps in sequences.items()]
+    else:
+        sequences = [((name,), ansible.get(name)) for name in ("create", "destroy")]
+    for path, steps in sequences:
+        if not isinstance(steps, list):
+            continue
+        for index, entry in enumerate(steps):
+            if (
+                isinstance(entry, dict)
+                and isinstance(entry.get("profile"), str)
+                and entry["profile"] not in profiles
+            ):
+                yield (
+                    path + (index, "profile"),
+                    f"unknown execution profile {entry['profile']}",
+                )
+
+
+def _check_parallel_policy(policy):
+    if (
+        isinstance(policy, dict)
+        and TYPES["int"][0](policy.get("min"))
+        and TYPES["int"][0](policy.get("max"))
+        and policy["min"] > policy["max"]
+    ):
+        yield ((), "min is bigger than max")
+
+
+def _check_size(value):
+    if parse_size(value) is None:
+        yield (
+            (),
+            f"invalid size {value!r}, expected a number of bytes like 512, 100M or 1.5G",
+        )
+
+
+def _check_verbosity(value):
+    try:
+        verbosity = int(value)
+    except (ValueError, TypeError):
+        yield ((), f"must be an integer, got: {value!r}")
+        return
+    if not 1 <= verbosity <= 6:
+        yield ((), f"must be between 1 and 6, got: {verbosity}")
+
+
+def _check_control_persist(value):
+    # true is for the default ControlPersist, see lib.ssh_multiplex.ssh_args
+    if value is False:
+        yield ((), "must be true, a duration like 30m or a number of seconds")
+
+
+def _check_profile_settings(profile):
+    if (
+        isinstance(profile.get("strategy"), str)
+        and profile["strategy"] not in ANSIBLE_STRATEGIES
+    ):
+        yield (("strategy",), f"must be one of {ANSIBLE_STRATEGIES}")
+
+
+TIMEOUT = {"type": "number", "positive": True}
+
+NOT_EMPTY = {"type": "str", "pattern": r"\S", "pattern_message": "must not be empty"}
+
+TERRAFORM = {
+    "type": "map",
+    "keys": {
+        "variables": {"type": "map"},
+        "tfvars_template": {"type": "str"},
+        "tfvars_format": {"type": "str", "enum": TFVARS_FORMATS},
+        "bin": {"type": "str"},
+        "command_timeout": TIMEOUT,
+        "stage_timeout": TIMEOUT,
+        "output_tail": {"type": "int", "min": 1},
+        "json_output": {"type": "bool"},
+        "plugin_cache_dir": {"type": "str"},
+        "plugin_cache_max_size": {"type": ["int", "str"], "check": _check_size},
+        "parallel_policy": {
+            "type": "map",
+            "closed": True,
+            "keys": {
+                key: (
+                    {"type": "map", "values": {"type": "int", "min": 1}}
+                    if key == "provider_max"
+                    else {"type": "int", "min": 0 if key == "throttle_retries" else 1}
+                )
+                for key in DEFAULT_PARALLEL_POLICY
+            },
+            "check": _check_parallel_policy,
+        },
+    },
+}
+
+STEP = {
+    "type": ["str", "map"],
+    "closed": True,
+    "required": ["playbook"],
+    "pattern": r"\S",
+    "pattern_message": "must not be empty",
+    "keys": {
+        "playbook": NOT_EMPTY,
+        "name": NOT_EMPTY,
+        "after": {"type": ["str", "list"], "items": {"type": "str"}},
+        "hosts": NOT_EMPTY,
+        "profile": NOT_EMPTY,
+        "retry_limit": {"type": "bool"},
+    },
+}
+
+SEQUENCE = {"type": "list", "items": STEP, "check": _check_steps}
+
+HANA_VARS = {
+    "type": "map",
+    "required": [
+        "sap_hana_install_software_directory",
+        "sap_hana_install_master_password",
+        "sap_hana_install_sid",
+        "sap_hana_install_instance_number",
+        "sap_domain",
+        "primary_site",
+        "secondary_site",
+    ],
+    "keys": {
+        "sap_hana_install_software_directory": {
+            "type": "str",
+            "pattern": r"/.*",
+            "pattern_message": "must be a path",
+        },
+        "sap_hana_install_sid": {"type": "str", "length": 3},
+        "sap_hana_install_instance_number": {
+            "type": "str",
+            "pattern": r"^[0-9]{2}$",
+            "pattern_message": "must be two digits",
+        },
+    },
+}
+
+ANSIBLE_3 = {
+    "type": "map",
+    "required": ["az_storage_account_name", "az_container_name", "hana_media"],
+    "require_any": [["az_sas_token", "az_key_name"]],
+    "check": _check_profiles,
+    "keys": {
+        "az_storage_account_name": {"type": "str"},
+        "az_container_name": {"type": "str"},
+        "az_sas_token": {"type": "str"},
+        "az_key_name": {"type": "str"},
+        # One file name is also accepted as a string
+        "hana_media": {
+            "type": ["list", "str"],
+            "min_items": 1,
+            "not_pattern": r"^http[s]?://",
+            "pattern_message": "file name expected, not a full url",
+            "items": {
+                "type": "str",
+                "not_pattern": r"^http[s]?://",
+                "pattern_message": "file name expected, not a full url",
+            },
+        },
+        "hana_vars": HANA_VARS,
+        "verbosity": {"type": ["int", "str"], "check": _check_verbosity},
+        "roles_path": {"type": "str"},
+        "output_tail": {"type": "int", "min": 1},
+        "command_timeout": TIMEOUT,
+        "stage_timeout": TIMEOUT,
+        "ssh_control_persist": {
+            "type": ["bool", "str", "int"],
+            "check": _check_control_persist,
+        },
+        "readiness_probe": {
+            "type": ["bool", "map"],
+            "closed": True,
+            "keys": {"timeout": TIMEOUT},
+        },
+        "fact_cache": {
+            "type": ["bool", "map"],
+            "closed": True,
+            "keys": {"invalidate_after": {"type": "list", "items": {"type": "str"}}},
+        },
+        "fail_fast": {
+            "type": ["bool", "list"],
+            "items": {
+                "type": ["str", "map"],
+                "regex": True,
+                "closed": True,
+                "required": ["task"],
+                "keys": {
+                    "task": {"type": "str", "regex": True},
+                    "pattern": {"type": "str", "regex": True},
+                },
+            },
+        },
+        "execution_profiles": {
+            "type": "map",
+            "values": {
+                "type": "map",
+                "closed": True,
+                "check": _check_profile_settings,
+                "keys": {
+                    key: {"type": "int", "min": 1}
+                    if expected is int
+                    else {"type": {str: "str", bool: "bool", dict: "map"}[expected]}
+                    for key, expected in EXECUTION_PROFILE_KEYS.items()
+                },
+            },
+        },
+        "create": SEQUENCE,
+        "destroy": SEQUENCE,
+    },
+}
+
+# apiver 4 moves the playbook lists in ansible:sequences
+ANSIBLE_4 = dict(ANSIBLE_3)
+ANSIBLE_4["keys"] = {
+    key: value
+    for key, value in ANSIBLE_3["keys"].items()
+    if key not in ("create", "destroy")
+}
+ANSIBLE_4["keys"]["sequences"] = {"type": "map", "values": SEQUENCE}
+
+
+def _root(ansible):
+    return {
+        "type": "map",
+        "required": ["apiver", "provider"],
+        "keys": {
+            "apiver": {"type": "int"},
+            "provider": NOT_EMPTY,
+            "terraform": TERRAFORM,
+            "ansible": ansible,
+        },
+    }
+
+
+# Schema of each apiver, a conf.yaml uses the one of the highest apiver not above its own
+SCHEMAS = {3: _root(ANSIBLE_3), 4: _root(ANSIBLE_4)}
+
+# The validators, compiled when the module is imported
+VALIDATORS = {apiver: compile_schema(schema) for apiver, schema in SCHEMAS.items()}
+
+
+def yaml_lines(node, path=(), lines=None):
+    """Map each path of a composed YAML document to its line number
+
+    Args:
+        node (yaml.Node): root node from the YAML composer
+
+    Returns:
+        dict: path tuple as key, 1-based line number as value.
+              For a key of a dictionary, it is the line of the key.
+    """
+    if lines is None:
+        lines = {}
+    lines[path] = node.start_mark.line + 1
+    if isinstance(node, yaml.MappingNode):
+        for key_node, value_node in node.value:
+            child = path + (key_node.value,)
+            yaml_lines(value_node, child, lines)
+            lines[child] = key_node.start_mark.line + 1
+    elif isinstance(node, yaml.SequenceNode):
+        for index, item in enumerate(node.value):
+            yaml_lines(item, path + (index,), lines)
+    return lines
+
+
+def validate_config(data, lines=None):
+    """Validate a configuration with the schema of its apiver
+
+    Args:
+        data (dict): content of the conf.yaml
+        lines (dict): see yaml_lines, None if the line numbers are not known
+
+    Returns:
+        list of SchemaError: all the problems found, empty if the configuration is valid
+    """
+    lines = lines or {}
+    errors = []
+    if not isinstance(data, dict):
+        errors.append(((), "the configuration must be a dictionary"))
+    else:
+        apiver = data.get("apiver")
+        if not TYPES["int"][0](apiver):
+            errors.append(((), "missing or invalid 'apiver'"))
+        elif apiver < MIN_APIVER and "ansible" in data:
+            errors.append((("apiver",), f"apiver {apiver} is no longer supported"))
+        else:
+            # Without the ansible section, the older apiver are still accepted
+            schema = max(
+                (version for version in VALIDATORS if version <= apiver),
+                default=MIN_APIVER,
+            )
+            VALIDATORS[schema](data, (), errors)
+    result = []
+    for path, message in errors:
+        # The line of the closest element of the path that exists in the file
+        line = None
+        for length in range(len(path), -1, -1):
+            if path[:length] in lines:
+                line = lines[path[:length]]
+                break
+        result.append(SchemaError(path, line, message))
+    return result
+
+
+def validate_file(filename):
+    """Load and validate a conf.yaml
+
+    The YAML is composed only once, to get both the data and the line numbers.
+
+    Args:
+        filename (str): path of the conf.yaml
+
+    Returns:
+        list of SchemaError: all the problems found, empty if the configuration is valid
+    """
+    try:
+        with open(filename, "r", encoding="utf-8") as file:
+            loader = yaml.FullLoader(file)
+            try:
+                node = loader.get_single_node()
+                data = loader.construct_document(node) if node is not None else None
+            finally:
+                loader.dispose()
+    except OSError as exc:
+        return [SchemaError((), None, f"cannot read the file: {exc}")]
+    except yaml.YAMLError as exc:
+        mark = getattr(exc, "problem_mark", None)
+        return [
+            SchemaError((), mark.line + 1 if mark else None, f"invalid YAML: {exc}")
+        ]
+    return validate_config(data, yaml_lines(node) if node is not None else None)
@@ -0,0 +1,107 @@
+"""
+Persistent SSH connections (ControlMaster) shared by all the Ansible commands of a deployment
+"""
+
+import hashlib
+import logging
+import os
+import shutil
+import stat
+import tempfile
+
+import lib.process_manager
+
+log = logging.getLogger("QESAP")
+
+# Folder, within the base project folder, for the SSH control sockets
+CONTROL_DIR = os.path.join(".qesap", "ssh")
+
+# Max length of the path of a unix socket is 108 on Linux:
+# the socket name, from %C, is 40 characters long.
+MAX_CONTROL_DIR_LEN = 64
+
+# Default value of the ansible:ssh_control_persist
+DEFAULT_CONTROL_PERSIST = "30m"
+
+
+def control_dir(base_project):
+    """Get the folder for the SSH control sockets of one deployment
+
+    It is within the base project folder, or in the temporary folder
+    if the base project path is too long to be used for a unix socket.
+
+    Args:
+        base_project (str): base project path
+
+    Returns:
+        str: absolute path of the folder
+    """
+    path = os.path.join(os.path.abspath(base_project), CONTROL_DIR)
+    if len(path) > MAX_CONTROL_DIR_LEN:
+        digest = hashlib.sha256(path.encode()).hexdigest()[:12]
+        path = os.path.join(tempfile.gettempdir(), f"qesap-ssh-{digest}")
+    return path
+
+
+def ssh_args(control_path_dir, persist=DEFAULT_CONTROL_PERSIST):
+    """Compose the value for ANSIBLE_SSH_ARGS
+
+    Args:
+        control_path_dir (str): folder for the control sockets, see control_dir
+        persist (str or int): ControlPersist value, like '30m' or seconds
+
+    Returns:
+        str: ssh arguments
+    """
+    if persist is True:
+        persist = DEFAULT_CONTROL_PERSIST
+    return (
+        "-C -o ControlMaster=auto "
+        f"-o ControlPersist={persist} "
+        f"-o ControlPath={control_path_dir}/%C"
+    )
+
+
+def teardown_commands(control_path_dir):
+    """Compose the commands to close all the SSH master connections
+
+    Args:
+        control_path_dir (str): folder for the control sockets, see control_dir
+
+    Returns:
+        list of dict: one command for each control socket,
+                      in the format used by subprocess_run
+    """
+    if not os.path.isdir(control_path_dir):
+        return []
+    ssh_bin = shutil.which("ssh")
+    if not ssh_bin:
+        log.error("Missing binary ssh")
+        return []
+    cmds = []
+    for name in sorted(os.listdir(control_path_dir)):
+        socket = os.path.join(control_path_dir, name)
+        if not stat.S_ISSOCK(os.lstat(socket).st_mode):
+            continue
+        # With an explicit ControlPath the host name is not used
+        cmds.append({"cmd": f"{ssh_bin} -o ControlPath={socket} -O exit qesap"})
+    return cmds
+
+
+def teardown(control_path_dir, dryrun):
+    """Close all the SSH master connections of a deployment
+
+    Failures are only logged: a master could be already gone,
+    for example if the host has been destroyed.
+
+    Args:
+        control_path_dir (str): folder for the control sockets, see control_dir
+        dryrun (bool): enable dryrun execution mode
+    """
+    for command in teardown_commands(control_path_dir):
+        if dryrun:
+            print(command["cmd"])
+            continue
+        ret, _ = lib.process_manager.subprocess_run(**command)
+        if ret != 0:
+            log.warning("Unable to close the SSH master with %s", command["cmd"])
@@ -0,0 +1,473 @@
+"""
+Caches to avoid to repeat Terraform work already done
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+
+log = logging.getLogger("QESAP")
+
+# Name of the file, in the Terraform data folder,
+# with the fingerprint of the inputs of the last successful 'terraform init'
+INIT_STAMP = "qesap.init.sha256"
+
+# Lines of the .tf files that are relevant for 'terraform init':
+# provider and module sources and versions, backend configuration
+INIT_SETTINGS_RE = re.compile(
+    r"^\s*(?:source|version|required_version)\s*=|^\s*backend\s+\""
+)
+
+
+def terraform_files(provider_dir):
+    """Get all the .tf files of a Terraform project
+
+    Args:
+        provider_dir (str): Terraform project folder
+
+    Returns:
+        list of str: sorted list of .tf files path, also the ones in sub-folders,
+                     skipping the ones in the Terraform data folders
+    """
+    tf_files = []
+    for root, dirs, files in os.walk(provider_dir):
+        dirs[:] = sorted(d for d in dirs if not d.startswith(".terraform"))
+        tf_files.extend(
+            os.path.join(root, name) for name in sorted(files) if name.endswith(".tf")
+        )
+    return tf_files
+
+
+# Local module sources, like: source = "../generic_modules/common_variables"
+LOCAL_SOURCE_RE = re.compile(r'^\s*source\s*=\s*"(\.\.?/[^"]*)"', re.MULTILINE)
+
+
+def _is_external(path, provider_real):
+    """Check if a folder is not already part of the files walked for a Terraform project"""
+    rel_path = os.path.relpath(path, provider_real)
+    return (
+        rel_path == os.pardir
+        or rel_path.startswith(os.pardir + os.sep)
+        or rel_path.split(os.sep)[0].startswith(".terraform")
+    )
+
+
+def module_dirs(provider_dir, data_dir=".terraform"):
+    """Get the module folders used by a Terraform project outside of its own folder tree
+
+    Modules are found following, also recursively, the local sources
+    (like "../generic_modules/common_variables") in the .tf files and
+    reading the folders of the modules installed by 'terraform init'
+    from <data_dir>/modules/modules.json.
+
+    Args:
+        provider_dir (str): Terraform project folder
+        data_dir (str): Terraform data folder, relative to provider_dir
+
+    Returns:
+        list of str: sorted list of real paths of the module folders
+    """
+    provider_real = os.path.realpath(provider_dir)
+    queue = [provider_real]
+    modules_json = os.path.join(provider_dir, data_dir, "modules", "modules.json")
+    if os.path.isfile(modules_json):
+        try:
+            with open(modules_json, "r", encoding="utf-8") as file:
+                modules = json.load(file).get("Modules", [])
+        except (OSError, ValueError, AttributeError) as exc:
+            log.debug("Unable to read %s: %s", modules_json, exc)
+            modules = []
+        for module in modules:
+            if isinstance(module, dict) and module.get("Dir"):
+                queue.append(
+                    os.path.realpath(os.path.join(provider_dir, module["Dir"]))
+                )
+    found = []
+    seen = set()
+    while queue:
+        folder = queue.pop(0)
+        if folder in seen or not os.path.isdir(folder):
+            continue
+        seen.add(folder)
+        if _is_external(folder, provider_real):
+            found.append(folder)
+        for tf_file in terraform_files(folder):
+            with open(tf_file, "r", encoding="utf-8", errors="replace") as file:
+                content = file.read()
+            for match in LOCAL_SOURCE_RE.finditer(content):
+                queue.append(
+                    os.path.realpath(
+                        os.path.join(os.path.dirname(tf_file), match.group(1))
+                    )
+                )
+    return sorted(found)
+
+
+def binary_identity(terraform_bin):
+    """Identify a Terraform binary, so that any upgrade is detected
+
+    Args:
+        terraform_bin (str): Terraform binary, as configured in the conf.yaml
+
+    Returns:
+        str: resolved path, size and modification time, None if the binary is not found
+    """
+    bin_path = shutil.which(terraform_bin)
+    if bin_path is None:
+        log.debug("Unable to find %s", terraform_bin)
+        return None
+    bin_path = os.path.realpath(bin_path)
+    try:
+        bin_stat = os.stat(bin_path)
+    except OSError as exc:
+        log.debug("Unable to stat %s: %s", bin_path, exc)
+        return None
+    return f"{bin_path}:{bin_stat.st_size}:{bin_stat.st_mtime_ns}"
+
+
+def init_fingerprint(provider_dir, terraform_bin):
+    """Calculate the fingerprint of everything 'terraform init' depends on
+
+    The fingerprint is about:
+     - the Terraform binary (resolved path, size and modification time)
+     - version.tf and .terraform.lock.hcl content
+     - provider and module sources and versions and backend
+       configuration, from all the .tf files, also the ones
+       of the local modules outside of provider_dir
+
+    Args:
+        provider_dir (str): Terraform project folder
+        terraform_bin (str): Terraform binary, as configured in the conf.yaml
+
+    Returns:
+        str: hex digest of the fingerprint, None if the Terraform binary is not found
+    """
+    identity = binary_identity(terraform_bin)
+    if identity is None:
+        log.debug("No init fingerprint without the Terraform binary")
+        return None
+    sha = hashlib.sha256()
+    sha.update(f"{identity}\n".encode())
+
+    for name in ["version.tf", ".terraform.lock.hcl"]:
+        path = os.path.join(provider_dir, name)
+        if os.path.isfile(path):
+            sha.update(f"{name}\n".encode())
+            with open(path, "rb") as file:
+                sha.update(file.read())
+
+    provider_real = os.path.realpath(provider_dir)
+    folders = [provider_real] + [
+        folder
+        for folder in module_dirs(provider_dir)
+        if not os.path.relpath(folder, provider_real).startswith(".terraform")
+    ]
+    for folder in folders:
+        for tf_file in terraform_files(folder):
+            rel_path = os.path.relpath(tf_file, provider_real)
+            with open(tf_file, "r", encoding="utf-8", errors="replace") as file:
+                for line in file:
+                    if INIT_SETTINGS_RE.search(line):
+                        sha.update(f"{rel_path}:{line.strip()}\n".encode())
+    return sha.hexdigest()
+
+
+def init_is_cached(provider_dir, terraform_bin, data_dir=".terraform"):
+    """Check if 'terraform init' has been already executed for the same inputs
+
+    Args:
+        provider_dir (str): Terraform project folder
+        terraform_bin (str): Terraform binary, as configured in the conf.yaml
+        data_dir (str): Terraform data folder, relative to provider_dir
+
+    Returns:
+        bool: True if 'terraform init' can be skipped
+    """
+    stamp = os.path.join(provider_dir, data_dir, INIT_STAMP)
+    if not os.path.isfile(stamp):
+        log.debug("No init fingerprint in %s", stamp)
+        return False
+    fingerprint = init_fingerprint(provider_dir, terraform_bin)
+    if fingerprint is None:
+        return False
+    with open(stamp, "r", encoding="utf-8") as file:
+        cached = file.read().strip()
+    log.debug("Init fingerprint:%s cached:%s", fingerprint, cached)
+    return fingerprint == cached and init_providers_available(provider_dir, data_dir)
+
+
+def save_init_fingerprint(provider_dir, terraform_bin, data_dir=".terraform"):
+    """Store the fingerprint of the inputs of a successful 'terraform init'
+
+    Args:
+        provider_dir (str): Terraform project folder
+        terraform_bin (str): Terraform binary, as configured in the conf.yaml
+        data_dir (str): Terraform data folder, relative to provider_dir
+    """
+    fingerprint = init_fingerprint(provider_dir, terraform_bin)
+    if fingerprint is None:
+        return
+    stamp_dir = os.path.join(provider_dir, data_dir)
+    os.makedirs(stamp_dir, exist_ok=True)
+    stamp = os.path.join(stamp_dir, INIT_STAMP)
+    log.debug("Write %s", stamp)
+    with open(stamp, "w", encoding="utf-8") as file:
+        file.write(f"{fingerprint}\n")
+
+
+def init_providers_available(provider_dir, data_dir=".terraform"):
+    """Check that all the providers installed by 'terraform init' are still there
+
+    Providers installed from a plugin cache are symbolic links
+    to the cache content, that could have been pruned in the meantime.
+
+    Args:
+        provider_dir (str): Terraform project folder
+        data_dir (str): Terraform data folder, relative to provider_dir
+
+    Returns:
+        bool: False if at least one installed provider is a broken link
+    """
+    providers_dir = os.path.join(provider_dir, data_dir, "providers")
+    for root, dirs, files in os.walk(providers_dir):
+        for name in dirs + files:
+            path = os.path.join(root, name)
+            if os.path.islink(path) and not os.path.exists(path):
+                log.info("Provider %s is no longer available", path)
+                return False
+    return True
+
+
+# Provider blocks in .terraform.lock.hcl like:
+# provider "registry.terraform.io/hashicorp/azurerm" {
+#   version     = "4.54.0"
+LOCK_PROVIDER_RE = re.compile(
+    r'provider\s+"(?P<address>[^"]+)"\s*\{\s*version\s*=\s*"(?P<version>[^"]+)"'
+)
+
+
+def plugin_cache_entries(cache_dir):
+    """List all the provider versions stored in a Terraform plugin cache
+
+    Terraform plugin cache layout is
+    <HOSTNAME>/<NAMESPACE>/<TYPE>/<VERSION>/<OS_ARCH>/,
+    so each <VERSION> folder has the immutable content of one provider release.
+
+    Args:
+        cache_dir (str): Terraform plugin cache folder
+
+    Returns:
+        list of dict: one element for each provider version folder, with
+                      'path', 'size' in bytes and 'last_used' as mtime
+    """
+    entries = []
+    depth = len(cache_dir.rstrip(os.sep).split(os.sep))
+    for root, dirs, _ in os.walk(cache_dir):
+        if len(root.rstrip(os.sep).split(os.sep)) - depth != 3:
+            continue
+        for version in dirs:
+            path = os.path.join(root, version)
+            size = 0
+            for sub_root, _, files in os.walk(path):
+                for name in files:
+                    size += os.lstat(os.path.join(sub_root, name)).st_size
+            entries.append(
+                {"path": path, "size": size, "last_used": os.stat(path).st_mtime}
+            )
+        dirs[:] = []
+    return entries
+
+
+def touch_plugin_cache(cache_dir, provider_dir):
+    """Mark as used, now, the plugin cache entries of the providers of a deployment
+
+    The providers, and their versions, are read from the .terraform.lock.hcl.
+    The modification time of the cache entry is used for the LRU eviction.
+
+    Args:
+        cache_dir (str): Terraform plugin cache folder
+        provider_dir (str): Terraform project folder
+    """
+    lock_file = os.path.join(provider_dir, ".terraform.lock.hcl")
+    if not os.path.isfile(lock_file):
+        return
+    with open(lock_file, "r", encoding="utf-8") as file:
+        lock_content = file.read()
+    for match in LOCK_PROVIDER_RE.finditer(lock_content):
+        path = os.path.join(
+            cache_dir, *match.group("address").split("/"), match.group("version")
+        )
+        if os.path.isdir(path):
+            log.debug("Mark plugin cache entry %s as used", path)
+            os.utime(path)
+
+
+def prune_plugin_cache(cache_dir, max_size, dryrun=False):
+    """Remove the least recently used provider versions from the plugin cache,
+    until the cache size is not bigger than max_size
+
+    Args:
+        cache_dir (str): Terraform plugin cache folder
+        max_size (int): max cache size in bytes
+        dryrun (bool): only print what would be removed
+
+    Returns:
+        list of str: removed cache entries
+    """
+    entries = plugin_cache_entries(cache_dir)
+    total_size = sum(entry["size"] for entry in entries)
+    log.info("Plugin cache %s size:%d max_size:%d", cache_dir, total_size, max_size)
+    removed = []
+    for entry in sorted(entries, key=lambda entry: entry["last_used"]):
+        if total_size <= max_size:
+            break
+        if dryrun:
+            print(f"Remove {entry['path']} ({entry['size']} bytes)")
+        else:
+            log.info("Remove %s (%d bytes)", entry["path"], entry["size"])
+            shutil.rmtree(entry["path"])
+        total_size -= entry["size"]
+        removed.append(entry["path"])
+    return removed
+
+
+# Files, in the Terraform project folder, that are inputs of 'terraform apply'
+APPLY_INPUTS_RE = re.compile(
+    r"\.(?:tf|tfvars|tfvars\.json|tmpl|tpl)$|^\.terraform\.lock\.hcl$"
+)
+
+
+def _state_file(provider_dir, workspace):
+    """Path of the local Terraform state file of a workspace"""
+    if workspace == "default":
+        return os.path.join(provider_dir, "terraform.tfstate")
+    return os.path.join(
+        provider_dir, "terraform.tfstate.d", workspace, "terraform.tfstate"
+    )
+
+
+def _apply_stamp(provider_dir, workspace, data_dir):
+    """Path of the file with the fingerprint of the last successful apply"""
+    return os.path.join(provider_dir, data_dir, f"qesap.apply.{workspace}.sha256")
+
+
+def _hash_apply_inputs(sha, folder, provider_real):
+    """Add to the fingerprint all the apply inputs in a folder tree"""
+    for root, dirs, files in os.walk(folder):
+        dirs[:] = sorted(
+            d
+            for d in dirs
+            if not d.startswith(".terraform") and d != "terraform.tfstate.d"
+        )
+        for name in sorted(files):
+            if not APPLY_INPUTS_RE.search(name):
+                continue
+            path = os.path.join(root, name)
+            sha.update(f"{os.path.relpath(path, provider_real)}\n".encode())
+            with open(path, "rb") as file:
+                sha.update(file.read())
+
+
+def apply_fingerprint(
+    provider_dir, workspace, data_dir=".terraform", terraform_bin=None
+):
+    """Calculate the fingerprint of everything 'terraform apply' depends on
+
+    The fingerprint is about:
+     - the workspace name
+     - content of all the .tf, .tfvars, .tfvars.json, .tmpl and .tpl files and of the
+       .terraform.lock.hcl, also from sub-folders
+     - the same files of the modules outside of provider_dir,
+       like the local ones in ../generic_modules
+     - all the TF_VAR_* environment variables
+     - the Terraform binary (resolved path, size and modification time)
+     - content of the local state file, if any, so that any change
+       to the deployment done by someone else invalidates the fingerprint
+
+    Args:
+        provider_dir (str): Terraform project folder
+        workspace (str): Terraform workspace name
+        data_dir (str): Terraform data folder, relative to provider_dir
+        terraform_bin (str): Terraform binary, as configured in the conf.yaml.
+                             None to not include it in the fingerprint
+
+    Returns:
+        str: hex digest of the fingerprint
+    """
+    sha = hashlib.sha256()
+    sha.update(f"workspace:{workspace}\n".encode())
+    if terraform_bin is not None:
+        sha.update(f"bin:{binary_identity(terraform_bin)}\n".encode())
+    for name in sorted(os.environ):
+        if name.startswith("TF_VAR_"):
+            sha.update(f"env:{name}={os.environ[name]}\n".encode())
+    provider_real = os.path.realpath(provider_dir)
+    for folder in [provider_real] + module_dirs(provider_dir, data_dir):
+        _hash_apply_inputs(sha, folder, provider_real)
+    state_file = _state_file(provider_dir, workspace)
+    if os.path.isfile(state_file):
+        sha.update(b"state\n")
+        with open(state_file, "rb") as file:
+            sha.update(file.read())
+    return sha.hexdigest()
+
+
+def apply_is_cached(provider_dir, workspace, data_dir=".terraform", terraform_bin=None):
+    """Check if 'terraform apply' has been already successfully executed
+    for the same inputs, so that plan and apply would not change anything
+
+    Args:
+        provider_dir (str): Terraform project folder
+        workspace (str): Terraform workspace name
+        data_dir (str): Terraform data folder, relative to provider_dir
+        terraform_bin (str): Terraform binary, as configured in the conf.yaml
+
+    Returns:
+        bool: True if 'terraform plan' and 'terraform apply' can be skipped
+    """
+    stamp = _apply_stamp(provider_dir, workspace, data_dir)
+    if not os.path.isfile(stamp):
+        log.debug("No apply fingerprint in %s", stamp)
+        return False
+    fingerprint = apply_fingerprint(provider_dir, workspace, data_dir, terraform_bin)
+    with open(stamp, "r", encoding="utf-8") as file:
+        cached = file.read().strip()
+    log.debug("Apply fingerprint:%s cached:%s", fingerprint, cached)
+    return fingerprint == cached
+
+
+def save_apply_fingerprint(
+    provider_dir, workspace, data_dir=".terraform", terraform_bin=None
+):
+    """Store the fingerprint of the inputs of a successful 'terraform apply'
+
+    Args:
+        provider_dir (str): Terraform project folder
+        workspace (str): Terraform workspace name
+        data_dir (str): Terraform data folder, relative to provider_dir
+        terraform_bin (str): Terraform binary, as configured in the conf.yaml
+    """
+    stamp = _apply_stamp(provider_dir, workspace, data_dir)
+    os.makedirs(os.path.dirname(stamp), exist_ok=True)
+    log.debug("Write %s", stamp)
+    with open(stamp, "w", encoding="utf-8") as file:
+        file.write(
+            f"{apply_fingerprint(provider_dir, workspace, data_dir, terraform_bin)}\n"
+        )
+
+
+def clear_apply_fingerprint(provider_dir, workspace, data_dir=".terraform"):
+    """Forget the last successful 'terraform apply', for example after a destroy
+
+    Args:
+        provider_dir (str): Terraform project folder
+        workspace (str): Terraform workspace name
+        data_dir (str): Terraform data folder, relative to provider_dir
+    """
+    stamp = _apply_stamp(provider_dir, workspace, data_dir)
+    if os.path.isfile(stamp):
+        log.debug("Remove %s", stamp)
+        os.remove(stamp)
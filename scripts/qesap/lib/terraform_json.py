@@ -0,0 +1,129 @@
+"""
+Parser for the machine-readable output of 'terraform plan -json' and 'terraform apply -json'
+"""
+
+import json
+import logging
+
+log = logging.getLogger("QESAP")
+
+
+class TerraformJsonProgress:
+    """Incremental parser of the Terraform JSON event stream
+
+    An instance is a line handler for subprocess_run: it is called with
+    each output line while the process is running. The same instance
+    is used for plan and apply, so that the number of planned changes
+    is known when the apply starts.
+    """
+
+    def __init__(self):
+        self.planned = 0
+        self.completed = 0
+        self.timings = {}
+
+    def _progress(self):
+        if self.planned:
+            return f"[{self.completed}/{self.planned}]"
+        return f"[{self.completed}]"
+
+    def _on_change_summary(self, event):
+        changes = event.get("changes", {})
+        if changes.get("operation", "plan") == "plan":
+            self.planned = sum(
+                changes.get(key, 0) for key in ("add", "change", "remove")
+            )
+        log.info("%s", event.get("@message", ""))
+
+    def _on_apply_start(self, event):
+        hook = event.get("hook", {})
+        addr = hook.get("resource", {}).get("addr", "")
+        self.timings[addr] = {
+            "resource": addr,
+            "action": hook.get("action", ""),
+            "status": "running",
+            "elapsed": 0,
+        }
+        log.info("%s %s", self._progress(), event.get("@message", ""))
+
+    def _on_apply_end(self, event, status):
+        hook = event.get("hook", {})
+        addr = hook.get("resource", {}).get("addr", "")
+        timing = self.timings.setdefault(
+            addr, {"resource": addr, "action": hook.get("action", "")}
+        )
+        timing["status"] = status
+        timing["elapsed"] = hook.get("elapsed_seconds", 0)
+        if status == "complete":
+            self.completed += 1
+            log.info("%s %s", self._progress(), event.get("@message", ""))
+        else:
+            log.error("%s %s", self._progress(), event.get("@message", ""))
+
+    def _on_diagnostic(self, event):
+        diagnostic = event.get("diagnostic", {})
+        msg = diagnostic.get("summary", "")
+        if diagnostic.get("address"):
+            msg = f"{diagnostic['address']}: {msg}"
+        if diagnostic.get("detail"):
+            msg = f"{msg}: {diagnostic['detail']}"
+        if diagnostic.get("severity") == "error":
+            log.error("Terraform error %s", msg)
+        else:
+            log.warning("Terraform warning %s", msg)
+
+    def __call__(self, line):
+        """Process one output line
+
+        Args:
+            line (str): one line of the Terraform output
+        """
+        try:
+            event = json.loads(line)
+        except ValueError:
+            log.debug("Not a JSON line: %s", line)
+            return
+        if not isinstance(event, dict):
+            return
+        event_type = event.get("type")
+        if event_type == "change_summary":
+            self._on_change_summary(event)
+        elif event_type == "apply_start":
+            self._on_apply_start(event)
+        elif event_type == "apply_complete":
+            self._on_apply_end(event, "complete")
+        elif event_type == "apply_errored":
+            self._on_apply_end(event, "errored")
+        elif event_type == "diagnostic":
+            self._on_diagnostic(event)
+
+    def sorted_timings(self):
+        """Get the timing of each applied resource
+
+        Returns:
+            list of dict: one dict for each resource, with keys
+                          resource, action, status and elapsed (seconds).
+                          The slowest resource is the first.
+        """
+        return sorted(
+            self.timings.values(), key=lambda timing: timing["elapsed"], reverse=True
+        )
+
+    def write_timing_report(self, filename):
+        """Write a text table with the time needed to apply each resource
+
+        Args:
+            filename (str): path of the file to write
+        """
+        timings = self.sorted_timings()
+        width = max([len("RESOURCE")] + [len(t["resource"]) for t in timings])
+        log.debug("Write %s", filename)
+        with open(filename, "w", encoding="utf-8") as file:
+            file.write(
+                f"{'RESOURCE':<{width}}  {'ACTION':<8}  {'STATUS':<8}  ELAPSED\n"
+            )
+            for timing in timings:
+                file.write(
+                    f"{timing['resource']:<{width}}  {timing['action']:<8}  "
+                    f"{timing['status']:<8}  {timing['elapsed']}s\n"
+                )
@@ -0,0 +1,90 @@
+"""
+Adaptive -parallelism for terraform plan and apply
+"""
+
+import json
+import logging
+import math
+import re
+
+log = logging.getLogger("QESAP")
+
+# Terraform default -parallelism
+TERRAFORM_PARALLELISM = 10
+
+# Output of the providers when the cloud API is throttling the requests.
+# The 429 status code only in an HTTP status context, like StatusCode=429,
+# StatusCode: 429, HTTP 429 or Error 429: not any 429 in IDs, sizes or line numbers
+THROTTLE_RE = re.compile(
+    r"\b(?:Status(?:Code)?\s*[=:]\s*|HTTP(?:/[\d.]+)?\s+|Error\s+)429\b"
+    r"|TooManyRequests|Too Many Requests|Throttling|RequestLimitExceeded"
+    r"|rate limit exceeded",
+    re.IGNORECASE,
+)
+
+
+def count_changes(plan_json):
+    """Count the resources that a plan is going to change, for each provider
+
+    Args:
+        plan_json (str): output of 'terraform show -json <PLAN FILE>'
+
+    Returns:
+        dict: provider short name, like 'azurerm', as key and number of
+              resources to create, update or delete as value.
+              None if the plan cannot be parsed.
+    """
+    try:
+        plan = json.loads(plan_json)
+    except ValueError:
+        log.error("Invalid terraform plan JSON")
+        return None
+    changes = {}
+    for resource in plan.get("resource_changes", []):
+        actions = resource.get("change", {}).get("actions", [])
+        if not set(actions) - {"no-op", "read"}:
+            continue
+        provider = resource.get("provider_name", "").split("/")[-1]
+        changes[provider] = changes.get(provider, 0) + 1
+    log.debug("Planned changes per provider %s", changes)
+    return changes
+
+
+def auto_parallelism(changes, policy):
+    """Pick the -parallelism value for a plan
+
+    One worker every `resources_per_worker` changed resources,
+    between `min` and `max`, and not more than the `provider_max`
+    of any provider involved in the changes.
+
+    Args:
+        changes (dict): output of count_changes
+        policy (dict): the parallel policy, see CONF.get_parallel_policy
+
+    Returns:
+        int: the parallelism
+    """
+    total = sum(changes.values())
+    parallel = math.ceil(total / policy["resources_per_worker"])
+    parallel = max(policy["min"], min(policy["max"], parallel))
+    for provider in changes:
+        if provider in policy["provider_max"]:
+            parallel = min(parallel, policy["provider_max"][provider])
+    log.info("Use parallelism %d for %d changed resources", parallel, total)
+    return parallel
+
+
+class ThrottleDetector:
+    """Line handler for subprocess_run that detects API throttling errors
+
+    After the process completes, `throttled` is True
+    if at least one output line is about throttling.
+    """
+
+    def __init__(self):
+        self.throttled = False
+
+    def __call__(self, line):
+        if not self.throttled and THROTTLE_RE.search(line):
+            log.warning("API throttling detected: %s", line)
+            self.throttled = True
@@ -0,0 +1,114 @@
+"""
+Single pass parser and merge of the terraform.tfvars templates
+"""
+
+import logging
+import re
+
+log = logging.getLogger("QESAP")
+
+# Top level assignment, like 'name = value'. Not '==' or '=>'
+ASSIGNMENT_RE = re.compile(r"\s*([A-Za-z_][\w-]*)\s*=(?![=>])")
+
+# Tokens that change the parser state: strings, comments, brackets and heredoc start
+TOKEN_RE = re.compile(
+    r'"(?:[^"\\]|\\.)*"?|#.*|//.*|/\*|[\[\]{}()]|<<-?\s*([A-Za-z_]\w*)\s*$'
+)
+
+
+def index_assignments(lines):
+    """Find the top level variable assignments of a tfvars template
+
+    The parser tracks strings, comments, brackets and heredoc strings,
+    so that the assignments with a multi-line list, map or string value
+    are detected as a whole and the keys of a map are not taken as variables.
+    Commented out assignments are ignored.
+
+    Args:
+        lines (list of str): content of the template
+
+    Returns:
+        dict: for each variable name, a list of (first, last) line indexes
+              of each assignment. Usually a list of one element.
+    """
+    index = {}
+    depth = 0
+    block_comment = False
+    heredoc = None
+    current = None
+    for number, line in enumerate(lines):
+        if heredoc is not None:
+            if line.strip() == heredoc:
+                heredoc = None
+        else:
+            position = 0
+            if current is None and not block_comment:
+                match = ASSIGNMENT_RE.match(line)
+                if match:
+                    current = (match.group(1), number)
+                    position = match.end()
+            while True:
+                if block_comment:
+                    end = line.find("*/", position)
+                    if end < 0:
+                        break
+                    block_comment = False
+                    position = end + 2
+                    continue
+                token = TOKEN_RE.search(line, position)
+                if token is None:
+                    break
+                position = token.end()
+                text = token.group(0)
+                if text == "/*":
+                    block_comment = True
+                elif text in ("[", "{", "("):
+                    depth += 1
+                elif text in ("]", "}", ")"):
+                    depth = max(0, depth - 1)
+                elif token.group(1):
+                    heredoc = token.group(1)
+        if current is not None and not depth and heredoc is None and not block_comment:
+            index.setdefault(current[0], []).append((current[1], number))
+            current = None
+    if current is not None:
+        log.warning("Unterminated value of %s in the template", current[0])
+        index.setdefault(current[0], []).append((current[1], len(lines) - 1))
+    return index
+
+
+def merge(lines, entries):
+    """Merge variables in a tfvars template
+
+    Args:
+        lines (list of str): content of the template, each line with its EOL
+        entries (dict): for each variable name, the tfvars entry to use, like 'name = "value"'.
+                        It replaces the whole assignment of the same variable in the template,
+                        or it is appended at the end if the template does not have it.
+
+    Returns:
+        list of str: the merged content
+    """
+    index = index_assignments(lines)
+    spans = {}
+    for name, entry in entries.items():
+        for first, last in index.get(name, []):
+            log.debug(
+                "Replace template lines %d-%d with [%s]", first + 1, last + 1, entry
+            )
+            spans[first] = (last, entry)
+    content = []
+    number = 0
+    while number < len(lines):
+        if number in spans:
+            last, entry = spans[number]
+            content.append(f"{entry}\n")
+            number = last + 1
+        else:
+            content.append(lines[number])
+            number += 1
+    for name, entry in entries.items():
+        if name not in index:
+            log.debug("[%s] is not in the template, append it", entry)
+            content.append(f"{entry}\n")
+    return content
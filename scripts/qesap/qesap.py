@@ -6,12 +6,26 @@ import os
 import argparse
 import sys
 import logging
+import time
+from datetime import datetime, timezone
 
 import yaml
 from yaml.parser import ParserError
 from yaml.scanner import ScannerError
+from lib.config import get_config
 from lib.status import Status
-from lib.cmds import cmd_configure, cmd_deploy, cmd_destroy, cmd_terraform, cmd_ansible
+from lib.cmds import (
+    cmd_configure,
+    cmd_deploy,
+    cmd_destroy,
+    cmd_terraform,
+    cmd_terraform_workspaces,
+    cmd_ansible,
+    cmd_cache_prune,
+    cmd_report_timings,
+    cmd_validate,
+)
+from lib.process_manager import record_steps, write_run_report
 
 # Logging config
 logging.basicConfig(format="%(levelname)-8s %(message)s")
@@ -22,6 +36,16 @@ VERSION = "2.7"
 
 DESCRIBE = """qe-sap-deployment helper script"""
 
+# Report with timing and resource usage of all the executed commands.
+# It is written in the current directory, like the command log files.
+RUN_REPORT = "qesap.run.json"
+
+# Subcommands that do not use the global -c and -b
+NO_CONFIG_COMMANDS = ("report", "validate")
+
+# Subcommands that do not use the global -b: cache only needs the config file
+NO_BASEDIR_COMMANDS = NO_CONFIG_COMMANDS + ("cache",)
+
 
 def load_yaml(path):
     """argparser validator for YAML files and convert the file to a python data structure
@@ -68,6 +92,31 @@ def is_dir(path):
     raise argparse.ArgumentTypeError(f"is_dir:{path} is not a folder")
 
 
+def parallel_value(value):
+    """argparser validator for the terraform parallelism
+
+    Args:
+        value (str): a positive integer or 'auto'
+
+    Raises:
+        argparse.ArgumentTypeError: if the value is not valid
+
+    Returns:
+        int or str: the parallelism, or 'auto'
+    """
+    if value == "auto":
+        return value
+    try:
+        parallel = int(value)
+    except ValueError as exc:
+        raise argparse.ArgumentTypeError(
+            f"parallel_value:{value} is not a number or auto"
+        ) from exc
+    if parallel <= 0:
+        raise argparse.ArgumentTypeError(f"parallel_value:{value} is not positive")
+    return parallel
+
+
 def cli(command_line=None):
     """
     Command line argument parser
@@ -85,8 +134,10 @@ def cli(command_line=None):
         "--config-file",
         dest="configdata",
         type=load_yaml,
-        required=True,
-        help="""Input global configuration .yaml file""",
+        default=argparse.SUPPRESS,
+        help="""Input global configuration .yaml file.
+    Mandatory for all the subcommands but """
+        + ", ".join(NO_CONFIG_COMMANDS),
     )
 
     parser.add_argument(
@@ -94,8 +145,12 @@ def cli(command_line=None):
         "--base-dir",
         dest="basedir",
         type=is_dir,
-        required=True,
-        help="""Base project folder, used to figure out
+        default=argparse.SUPPRESS,
+        help="""Base project folder, mandatory for all the subcommands
+    but """
+        + ", ".join(NO_BASEDIR_COMMANDS)
+        + """.
+    Used to figure out
     where to write all the generated configuration files and
     where they are stored when it is time to call Terraform and Ansible.
     It has to be created in advance.
@@ -127,19 +182,48 @@ def cli(command_line=None):
     parser_terraform.add_argument(
         "-d", "--destroy", action="store_true", help="Call terraform destroy"
     )
-    parser_terraform.add_argument(
+    workspace_group = parser_terraform.add_mutually_exclusive_group()
+    workspace_group.add_argument(
         "-w",
         "--workspace",
         dest="workspace",
         default="default",
         help="""Workspace to use in terraform commands. Defaults to 'default'""",
     )
+    workspace_group.add_argument(
+        "--workspaces",
+        dest="workspaces",
+        type=lambda value: [ws for ws in value.split(",") if ws],
+        help="""Comma separated list of workspaces to deploy concurrently,
+        each one with its own terraform data folder and plan file""",
+    )
+    parser_terraform.add_argument(
+        "--max-concurrent",
+        type=int,
+        dest="max_concurrent",
+        help="""Max number of workspaces deployed at the same time with --workspaces.
+        Defaults to no limit""",
+    )
     parser_terraform.add_argument(
         "-p",
         "--parallel",
-        type=int,
+        type=parallel_value,
         dest="parallel",
-        help="""Set value for -parallelism for plan and apply""",
+        help="""Set value for -parallelism for plan and apply.
+        'auto' calculates it from the plan, using terraform:parallel_policy,
+        and reduces it when the cloud API throttles the requests""",
+    )
+    parser_terraform.add_argument(
+        "--force-init",
+        action="store_true",
+        dest="force_init",
+        help="""Run terraform init also if already done for the same providers, modules and terraform binary""",
+    )
+    parser_terraform.add_argument(
+        "--force-apply",
+        action="store_true",
+        dest="force_apply",
+        help="""Run terraform plan and apply also if nothing changed since the last successful apply""",
     )
     parser_ansible = subparsers.add_parser(
         "ansible", help="Run the Ansible part of the deployment"
@@ -167,7 +251,98 @@ def cli(command_line=None):
         help="Only execute a playbook sequence from a specific Ansible `sequence` section",
     )
 
+    parser_ansible.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip the playbooks already completed by the previous run of the same sequence",
+    )
+
+    parser_ansible.add_argument(
+        "--retry-failed",
+        dest="retry_failed",
+        action="store_true",
+        help="""Like --resume, and only run the playbooks with retry_limit
+        on the hosts that failed in the previous run""",
+    )
+
+    parser_ansible.add_argument(
+        "--timings",
+        action="store_true",
+        help="Write the timing of each task on each host in ansible.<PLAYBOOK>.timing.jsonl files",
+    )
+
+    parser_cache = subparsers.add_parser(
+        "cache", help="Manage the Terraform provider plugin cache"
+    )
+    cache_subparsers = parser_cache.add_subparsers(dest="cache_command", required=True)
+    parser_cache_prune = cache_subparsers.add_parser(
+        "prune",
+        help="Remove the least recently used providers from terraform:plugin_cache_dir",
+    )
+    parser_cache_prune.add_argument(
+        "--max-size",
+        dest="max_size",
+        help="""Max cache size, like 500M or 10G.
+        Defaults to terraform:plugin_cache_max_size from the config file""",
+    )
+
+    parser_validate = subparsers.add_parser(
+        "validate",
+        help="Validate conf.yaml files, reporting all the problems of each of them",
+    )
+    parser_validate.add_argument(
+        "--max-concurrent",
+        type=int,
+        dest="max_concurrent",
+        help="""Max number of files validated at the same time.
+        Defaults to the number of CPUs""",
+    )
+    parser_validate.add_argument(
+        "paths",
+        nargs="+",
+        help="""conf.yaml files to validate""",
+    )
+
+    parser_report = subparsers.add_parser(
+        "report", help="Reports about the previous executions"
+    )
+    report_subparsers = parser_report.add_subparsers(
+        dest="report_command", required=True
+    )
+    parser_report_timings = report_subparsers.add_parser(
+        "timings",
+        help="Slowest Ansible tasks and per-host comparison, from ansible --timings",
+    )
+    parser_report_timings.add_argument(
+        "--top",
+        type=int,
+        default=20,
+        help="Number of tasks in the slowest tasks table",
+    )
+    parser_report_timings.add_argument(
+        "paths",
+        nargs="*",
+        default=["."],
+        help="""Timing files, or folders where to look for them.
+        Default is the current directory""",
+    )
+
     parsed_args = parser.parse_args(command_line)
+    # Not given options are not in parsed_args at all:
+    # an empty config file is loaded as None
+    missing = [
+        option
+        for option, dest, optional_for in [
+            ("-c/--config-file", "configdata", NO_CONFIG_COMMANDS),
+            ("-b/--base-dir", "basedir", NO_BASEDIR_COMMANDS),
+        ]
+        if dest not in parsed_args and parsed_args.command not in optional_for
+    ]
+    if missing:
+        parser.error(f"the following arguments are required: {', '.join(missing)}")
+    for dest in ["configdata", "basedir"]:
+        if dest not in parsed_args:
+            setattr(parsed_args, dest, None)
     return parsed_args
 
 
@@ -175,36 +350,65 @@ def run_subcommand(args):
     """
     Helper functio to run subcomand and return result
     """
+    if args.command == "report":
+        log.info("Reporting the Ansible task timings...")
+        return cmd_report_timings(args.paths, top=args.top)
+    if args.command == "validate":
+        log.info("Validating %d configuration files...", len(args.paths))
+        return cmd_validate(args.paths, max_concurrent=args.max_concurrent)
+    # Validated once and shared by all the steps of the subcommand
+    configdata = get_config(args.configdata)
     if args.command == "configure":
         log.info("Configuring...")
-        return cmd_configure(args.configdata, args.basedir, args.dryrun)
+        return cmd_configure(configdata, args.basedir, args.dryrun)
     if args.command == "deploy":
         log.info("Deploying...")
-        return cmd_deploy(args.configdata, args.basedir, args.dryrun)
+        return cmd_deploy(configdata, args.basedir, args.dryrun)
     if args.command == "destroy":
         log.info("Destroying...")
-        return cmd_destroy(args.configdata, args.basedir, args.dryrun)
+        return cmd_destroy(configdata, args.basedir, args.dryrun)
+    if args.command == "terraform" and args.workspaces:
+        log.info("Running Terraform on workspaces %s...", args.workspaces)
+        return cmd_terraform_workspaces(
+            configdata,
+            args.basedir,
+            args.dryrun,
+            args.workspaces,
+            max_concurrent=args.max_concurrent,
+            destroy=args.destroy,
+            parallel=args.parallel,
+            force_init=args.force_init,
+            force_apply=args.force_apply,
+        )
     if args.command == "terraform":
         log.info("Running Terraform...")
         return cmd_terraform(
-            args.configdata,
+            configdata,
             args.basedir,
             args.dryrun,
             workspace=args.workspace,
             destroy=args.destroy,
             parallel=args.parallel,
+            force_init=args.force_init,
+            force_apply=args.force_apply,
         )
     if args.command == "ansible":
         log.info("Running Ansible...")
         return cmd_ansible(
-            args.configdata,
+            configdata,
             args.basedir,
             args.dryrun,
             destroy=args.destroy,
             profile=args.profile,
             junit=args.junit,
             sequence=args.sequence,
+            resume=args.resume,
+            timings=args.timings,
+            retry_failed=args.retry_failed,
         )
+    if args.command == "cache":
+        log.info("Pruning the plugin cache...")
+        return cmd_cache_prune(configdata, args.dryrun, max_size=args.max_size)
     return Status(f"Unknown command: {args.command}")
 
 
@@ -236,9 +440,25 @@ def main(command_line=None):  # pylint: disable=too-many-return-statements
         log.error("Ansible subcommand do not support --sequence and -d at same time.")
         return Status(1)
 
-    res = run_subcommand(parsed_args)
+    start = time.monotonic()
+    start_time = datetime.now(timezone.utc)
+    with record_steps() as steps:
+        res = run_subcommand(parsed_args)
     if res != 0:
         log.error(res.msg)
+    if steps:
+        write_run_report(
+            RUN_REPORT,
+            {
+                "command": parsed_args.command,
+                "rc": int(res),
+                "msg": res.msg,
+                "start": start_time.isoformat(),
+                "end": datetime.now(timezone.utc).isoformat(),
+                "wall_time": round(time.monotonic() - start, 3),
+            },
+            steps,
+        )
     return res
 
 
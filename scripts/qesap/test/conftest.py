@@ -236,11 +236,18 @@ def mock_call_ansibleplaybook():
     """
     create a mock.call with some default elements
     ```
-    mock.call('ansible-playbook -i inventory, playbook', env={'ANSIBLE_PIPELINING', 'True'})
+    mock.call('ansible-playbook -i inventory, playbook', env={'ANSIBLE_PIPELINING', 'True'}, log_file='ansible.playbook.log.txt')
     ```
     """
 
-    def _callback(inventory, playbook, verbosity="-vv", arguments=None, env=None):
+    def _callback(
+        inventory,
+        playbook,
+        verbosity="-vv",
+        arguments=None,
+        env=None,
+    ):
+        playbook_name = os.path.splitext(os.path.basename(playbook))[0]
         playbook_cmd = [ANSIBLEPB_EXE, verbosity, "-i", inventory, playbook]
         if arguments is not None:
             playbook_cmd += arguments
@@ -250,7 +257,27 @@ def mock_call_ansibleplaybook():
             original_env["ANSIBLE_TIMEOUT"] = "20"
         else:
             original_env = env
-        return mock.call(cmd=" ".join(playbook_cmd), env=original_env)
+        return mock.call(
+            cmd=" ".join(playbook_cmd),
+            env=original_env,
+            log_file=f"ansible.{playbook_name}.log.txt",
+        )
+
+    return _callback
+
+
+@pytest.fixture
+def mock_call_terraform():
+    """
+    create a mock.call for one terraform command
+    ```
+    mock.call('terraform -chdir=... init -no-color', log_file='terraform.init.log.txt')
+    ```
+    """
+
+    def _callback(terraform_cmd):
+        log_file = f"terraform.{terraform_cmd.split()[2]}.log.txt"
+        return mock.call(terraform_cmd, log_file=log_file)
 
     return _callback
 
@@ -160,8 +160,9 @@ QESAP_CFG=test_3.yaml
 test_step "[${QESAP_CFG}] test stdout with verbosity for terraform PASS"
 THIS_LOG="${QESAPROOT}/test_terraform_verbose.txt"
 rm "${THIS_LOG}" || echo "No ${THIS_LOG} to delete"
-# now repeat exactly the same in --verbose mode
-qesap.py --verbose -b ${QESAPROOT} -c ${QESAP_CFG} terraform |& tee "${THIS_LOG}"
+# now repeat exactly the same in --verbose mode,
+# forcing plan and apply as nothing changed since the previous run
+qesap.py --verbose -b ${QESAPROOT} -c ${QESAP_CFG} terraform --force-apply |& tee "${THIS_LOG}"
 
 set +e
 grep -qE "^DEBUG" "${THIS_LOG}"
@@ -185,6 +186,9 @@ test_step "[${QESAP_CFG}] test .log.txt file redirection"
 
 # run in non verbose mode
 rm terraform.*.log.txt || echo "No terraform.*.log.txt to delete"
+# start from a not initialized folder, so that terraform init is not skipped
+reset_root
+touch "${TEST_PROVIDER}/main.tf"
 qesap.py -b ${QESAPROOT} -c ${QESAP_CFG} terraform || test_die "Error in terraform execution"
 
 find . -type f -name "terraform.*.log.txt" | grep . || test_die "No generated terraform .log.txt"
@@ -196,6 +200,8 @@ rm terraform.*.log.txt
 QESAP_CFG=test_3.yaml
 test_step "[${QESAP_CFG}] test .log.txt file redirection with verbosity"
 # now repeat exactly the same in --verbose mode
+reset_root
+touch "${TEST_PROVIDER}/main.tf"
 qesap.py --verbose -b ${QESAPROOT} -c ${QESAP_CFG} terraform
 
 find . -type f -name "terraform.*.log.txt" | grep . || test_die "No generated terraform .log.txt"
@@ -262,3 +268,100 @@ count=$(grep -rhE "^@.*foo@" "${TEST_PROVIDER}" | sort -u | wc -l)
 [[ $count -ne 1 ]] || test_die "All the generated files has the same content. Count:${count}"
 rm ${THIS_LOG}
 
+#######################################################################
+QESAP_CFG=test_3.yaml
+for tf_fixture in main_local.tf main_local_many.tf; do
+  test_step "[${QESAP_CFG}] test terraform init cache with ${tf_fixture}"
+  # terraform init is skipped when already executed for the same
+  # providers, modules and terraform binary, unless --force-init is used
+  THIS_LOG="${QESAPROOT}/test_init_cache.txt"
+  reset_root
+  cp "${tf_fixture}" "${TEST_PROVIDER}/main.tf"
+  rm terraform.*.log.txt || echo "No terraform.*.log.txt to delete"
+  qesap.py --verbose -b ${QESAPROOT} -c ${QESAP_CFG} terraform || test_die "${QESAP_CFG} fail on first terraform"
+  test_file terraform.init.log.txt
+  test_file "${TEST_PROVIDER}/.terraform/qesap.init.sha256"
+
+  test_split
+  rm terraform.*.log.txt
+  qesap.py --verbose -b ${QESAPROOT} -c ${QESAP_CFG} terraform --force-apply |& tee "${THIS_LOG}"
+  grep -q "Skip terraform init" "${THIS_LOG}" || test_die "terraform init not skipped"
+  [[ ! -f terraform.init.log.txt ]] || test_die "terraform init executed also if cached"
+  test_file terraform.apply.log.txt
+
+  test_split
+  rm terraform.*.log.txt
+  qesap.py --verbose -b ${QESAPROOT} -c ${QESAP_CFG} terraform --force-init --force-apply || test_die "${QESAP_CFG} fail on terraform --force-init"
+  test_file terraform.init.log.txt
+
+  qesap.py --verbose -b ${QESAPROOT} -c ${QESAP_CFG} terraform -d
+  rm terraform.*.log.txt
+  rm "${THIS_LOG}"
+done
+
+#######################################################################
+QESAP_CFG=test_3.yaml
+test_step "[${QESAP_CFG}] test terraform apply skipped if nothing changed"
+# terraform plan and apply are skipped when nothing changed since
+# the last successful apply, unless --force-apply is used
+THIS_LOG="${QESAPROOT}/test_apply_cache.txt"
+reset_root
+cp main_local.tf "${TEST_PROVIDER}/main.tf"
+rm terraform.*.log.txt || echo "No terraform.*.log.txt to delete"
+qesap.py --verbose -b ${QESAPROOT} -c ${QESAP_CFG} terraform || test_die "${QESAP_CFG} fail on first terraform"
+test_file terraform.apply.log.txt
+
+test_split
+rm terraform.*.log.txt
+qesap.py --verbose -b ${QESAPROOT} -c ${QESAP_CFG} terraform |& tee "${THIS_LOG}"
+grep -q "Skip terraform, nothing changed" "${THIS_LOG}" || test_die "terraform apply not skipped"
+[[ ! -f terraform.apply.log.txt ]] || test_die "terraform apply executed also if nothing changed"
+
+test_split
+qesap.py --verbose -b ${QESAPROOT} -c ${QESAP_CFG} terraform --force-apply || test_die "${QESAP_CFG} fail on terraform --force-apply"
+test_file terraform.apply.log.txt
+
+test_split
+rm terraform.*.log.txt
+echo "# a change" >> "${TEST_PROVIDER}/main.tf"
+qesap.py --verbose -b ${QESAPROOT} -c ${QESAP_CFG} terraform || test_die "${QESAP_CFG} fail on terraform after a change"
+test_file terraform.apply.log.txt
+
+qesap.py --verbose -b ${QESAPROOT} -c ${QESAP_CFG} terraform -d
+test_split
+rm terraform.*.log.txt
+qesap.py --verbose -b ${QESAPROOT} -c ${QESAP_CFG} terraform || test_die "${QESAP_CFG} fail on terraform after destroy"
+test_file terraform.apply.log.txt
+qesap.py --verbose -b ${QESAPROOT} -c ${QESAP_CFG} terraform -d
+rm terraform.*.log.txt
+rm "${THIS_LOG}"
+
+#######################################################################
+QESAP_CFG=test_3.yaml
+test_step "[${QESAP_CFG}] Run many Terraform workspaces concurrently"
+# each workspace has its own data folder, plan file and state
+reset_root
+cp main_local.tf "${TEST_PROVIDER}/main.tf"
+rm terraform.*.log.txt || echo "No terraform.*.log.txt to delete"
+qesap.py --verbose -b ${QESAPROOT} -c ${QESAP_CFG} terraform --workspaces DONALDUCK,MICKEYMOUSE --max-concurrent 2 || test_die "${QESAP_CFG} fail on terraform with workspaces"
+for ws in DONALDUCK MICKEYMOUSE; do
+  test_file "${TEST_PROVIDER}/terraform.tfstate.d/${ws}/terraform.tfstate"
+  test_file "${TEST_PROVIDER}/plan.${ws}.zip"
+  test_file "terraform.${ws}.apply.log.txt"
+done
+qesap.py --verbose -b ${QESAPROOT} -c ${QESAP_CFG} terraform --workspaces DONALDUCK,MICKEYMOUSE -d || test_die "${QESAP_CFG} fail on terraform destroy with workspaces"
+rm terraform.*.log.txt
+
+#######################################################################
+QESAP_CFG=test_3.yaml
+test_step "[${QESAP_CFG}] test parallel auto"
+# the parallelism of apply is calculated from the plan:
+# main_local_many.tf has many resources that can be created concurrently
+THIS_LOG="${QESAPROOT}/test_parallel_auto.txt"
+reset_root
+cp main_local_many.tf "${TEST_PROVIDER}/main.tf"
+qesap.py --verbose -b ${QESAPROOT} -c ${QESAP_CFG} terraform --parallel auto |& tee "${THIS_LOG}"
+grep -E "show -json plan.zip" ${THIS_LOG} || test_die "Missing terraform show"
+grep -E "apply -parallelism=[0-9]+ " ${THIS_LOG} || test_die "Missing argument -parallelism in terraform apply"
+qesap.py --verbose -b ${QESAPROOT} -c ${QESAP_CFG} terraform -d
+rm ${THIS_LOG}
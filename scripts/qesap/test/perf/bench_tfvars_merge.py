@@ -0,0 +1,79 @@
+"""
+Benchmark of the tfvars template merge, compared with the previous implementation
+that searched each variable in each template line with an uncompiled regex.
+
+Run from scripts/qesap:
+
+    PYTHONPATH=. python test/perf/bench_tfvars_merge.py [--lines 5000] [--variables 500]
+"""
+
+import argparse
+import re
+import time
+
+from lib.tfvars import merge
+
+
+def template(lines):
+    """Synthetic template of single line and multi-line assignments with comments"""
+    content = []
+    number = 0
+    while len(content) < lines:
+        content.extend(
+            [
+                f"# variable {number}\n",
+                f"var_{number} = {number}\n",
+                f"var_{number}_list = [\n",
+                f'  "{number}", # item\n',
+                "]\n",
+            ]
+        )
+        number += 1
+    return content[:lines]
+
+
+def per_key_merge(lines, entries):
+    """The previous implementation: O(variables x lines) regex searches"""
+    content = list(lines)
+    for key, entry in entries.items():
+        key_replace = False
+        for index, line in enumerate(content):
+            if re.search(rf"{key}\s*=.*", line):
+                content[index] = entry + "\n"
+                key_replace = True
+        if not key_replace:
+            content.append(f"{entry}\n")
+    return content
+
+
+def measure(function, lines, entries, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(lines, entries)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--lines", type=int, default=5000)
+    parser.add_argument("--variables", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    lines = template(args.lines)
+    entries = {
+        f"var_{number}": f"var_{number} = 0"
+        for number in range(0, args.variables * 2, 2)
+    }
+    for name, function in (("per key", per_key_merge), ("single pass", merge)):
+        print(
+            f"{name:<12} {args.lines} lines, {len(entries)} variables: "
+            f"{measure(function, lines, entries, args.repeat) * 1000:9.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+"""
+Test of the qesap_download Ansible module, against a local HTTP server
+"""
+
+import hashlib
+import importlib.util
+import json
+import os
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+MODULE_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "..",
+    "..",
+    "..",
+    "..",
+    "ansible",
+    "playbooks",
+    "library",
+    "qesap_download.py",
+)
+spec = importlib.util.spec_from_file_location("qesap_download", MODULE_PATH)
+qesap_download = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(qesap_download)
+
+CONTENT = {
+    "/container/SAPCAR.EXE": b"sapcar" * 100,
+    "/container/sub/IMDB_SERVER.SAR": bytes(range(256)) * 40,
+}
+
+
+class BlobHandler(BaseHTTPRequestHandler):
+    """Serve CONTENT with HEAD and range requests, like a blob storage"""
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+    def _send(self, body):
+        data = CONTENT.get(self.path.split("?")[0])
+        self.server.requests.append(
+            (self.command, self.path, self.headers.get("Range"))
+        )
+        if data is None:
+            self.send_error(404)
+            return
+        match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range") or "")
+        if match and self.server.ranges:
+            start = int(match.group(1))
+            end = int(match.group(2)) if match.group(2) else len(data) - 1
+            stop = end + 1
+            data = data[start:stop]
+            self.send_response(206)
+            self.send_header(
+                "Content-Range",
+                f"bytes {start}-{end}/{len(CONTENT[self.path.split('?')[0]])}",
+            )
+        else:
+            self.send_response(200)
+        if self.server.ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        if body or self.server.head_size:
+            self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if body:
+            self.wfile.write(data)
+
+    def do_HEAD(self):  # pylint: disable=invalid-name
+        self._send(False)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        self._send(True)
+
+
+@pytest.fixture
+def blob_server():
+    """Run the local HTTP server, recording the requests in server.requests"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), BlobHandler)
+    server.requests = []
+    server.ranges = True
+    server.head_size = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def url(server, name):
+    return f"http://127.0.0.1:{server.server_address[1]}/container/{name}?sv=token"
+
+
+def download(server, name, dest, **kwargs):
+    options = {"chunk_size": 1000, "retries": 0, "retry_delay": 0}
+    options.update(kwargs)
+    return qesap_download.Download(url(server, name), dest, **options).run()
+
+
+def gets(server):
+    return [request for request in server.requests if request[0] == "GET"]
+
+
+def test_download_chunked(blob_server, tmp_path):
+    """
+    A file bigger than the chunk size is downloaded in chunks
+    and its checksum verified
+    """
+    data = CONTENT["/container/sub/IMDB_SERVER.SAR"]
+    dest = str(tmp_path / "IMDB_SERVER.SAR")
+
+    result = download(
+        blob_server,
+        "sub/IMDB_SERVER.SAR",
+        dest,
+        checksum="sha256:" + hashlib.sha256(data).hexdigest(),
+    )
+
+    assert result["changed"]
+    assert result["size"] == len(data)
+    with open(dest, "rb") as file:
+        assert file.read() == data
+    assert len(gets(blob_server)) == 11
+    assert all(request[2] is not None for request in gets(blob_server))
+    assert not os.path.exists(dest + ".part")
+    assert not os.path.exists(dest + ".part.json")
+
+
+def test_download_stream(blob_server, tmp_path):
+    """
+    A file smaller than the chunk size, or from a server without
+    range requests, is downloaded in one request
+    """
+    blob_server.ranges = False
+    data = CONTENT["/container/sub/IMDB_SERVER.SAR"]
+    dest = str(tmp_path / "IMDB_SERVER.SAR")
+
+    result = download(
+        blob_server,
+        "sub/IMDB_SERVER.SAR",
+        dest,
+        checksum="md5:" + hashlib.md5(data).hexdigest(),
+    )
+
+    assert result["changed"]
+    with open(dest, "rb") as file:
+        assert file.read() == data
+    assert len(gets(blob_server)) == 1
+
+
+def test_download_already_present(blob_server, tmp_path):
+    """
+    A file already present, with the same size and checksum, is not downloaded
+    """
+    data = CONTENT["/container/SAPCAR.EXE"]
+    dest = tmp_path / "SAPCAR.EXE"
+    dest.write_bytes(data)
+
+    result = download(
+        blob_server,
+        "SAPCAR.EXE",
+        str(dest),
+        checksum="sha256:" + hashlib.sha256(data).hexdigest(),
+    )
+
+    assert not result["changed"]
+    assert gets(blob_server) == []
+
+
+def test_download_present_unknown_size(blob_server, tmp_path):
+    """
+    If the server does not tell the size, a file already present
+    is only trusted if its checksum is right, otherwise it is downloaded again
+    """
+    blob_server.head_size = False
+    data = CONTENT["/container/SAPCAR.EXE"]
+    dest = tmp_path / "SAPCAR.EXE"
+    dest.write_bytes(b"stale")
+
+    result = download(blob_server, "SAPCAR.EXE", str(dest))
+
+    assert result["changed"]
+    assert dest.read_bytes() == data
+
+    blob_server.requests.clear()
+    result = download(
+        blob_server,
+        "SAPCAR.EXE",
+        str(dest),
+        checksum="sha256:" + hashlib.sha256(data).hexdigest(),
+    )
+
+    assert not result["changed"]
+    assert gets(blob_server) == []
+
+
+def test_download_resume_stream(blob_server, tmp_path):
+    """
+    A partial download is resumed with a range request
+    """
+    data = CONTENT["/container/SAPCAR.EXE"]
+    dest = tmp_path / "SAPCAR.EXE"
+    (tmp_path / "SAPCAR.EXE.part").write_bytes(data[:250])
+
+    result = download(
+        blob_server,
+        "SAPCAR.EXE",
+        str(dest),
+        checksum="sha256:" + hashlib.sha256(data).hexdigest(),
+    )
+
+    assert result["resumed"] == 250
+    assert dest.read_bytes() == data
+    assert [request[2] for request in gets(blob_server)] == ["bytes=250-"]
+
+
+def test_download_resume_chunked(blob_server, tmp_path):
+    """
+    Only the chunks not completed by a previous download are requested
+    """
+    data = CONTENT["/container/sub/IMDB_SERVER.SAR"]
+    dest = tmp_path / "IMDB_SERVER.SAR"
+    part = bytearray(len(data))
+    part[0:2000] = data[0:2000]
+    part[5000:6000] = data[5000:6000]
+    (tmp_path / "IMDB_SERVER.SAR.part").write_bytes(bytes(part))
+    (tmp_path / "IMDB_SERVER.SAR.part.json").write_text(
+        json.dumps({"size": len(data), "chunk_size": 1000, "done": [0, 1, 5]})
+    )
+
+    result = download(
+        blob_server,
+        "sub/IMDB_SERVER.SAR",
+        str(dest),
+        checksum="sha256:" + hashlib.sha256(data).hexdigest(),
+    )
+
+    assert result["resumed"] == 3000
+    assert dest.read_bytes() == data
+    assert sorted(request[2] for request in gets(blob_server)) == sorted(
+        [
+            f"bytes={start}-{start + 999}"
+            for start in (2000, 3000, 4000, 6000, 7000, 8000, 9000)
+        ]
+        + ["bytes=10000-10239"]
+    )
+
+
+def test_download_wrong_checksum(blob_server, tmp_path):
+    """
+    A file with a wrong checksum is deleted and the download fails
+    """
+    dest = tmp_path / "IMDB_SERVER.SAR"
+
+    with pytest.raises(qesap_download.DownloadError, match="checksum"):
+        download(blob_server, "sub/IMDB_SERVER.SAR", str(dest), checksum="sha256:0123")
+
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_download_not_found(blob_server, tmp_path):
+    """
+    Client errors are not retried, and the URL with the token is not in the error
+    """
+    with pytest.raises(qesap_download.DownloadError) as exc:
+        download(blob_server, "MISSING.SAR", str(tmp_path / "MISSING.SAR"), retries=3)
+
+    assert "404" in str(exc.value)
+    assert "token" not in str(exc.value)
+    assert len(blob_server.requests) == 1
@@ -0,0 +1,213 @@
+import asyncio
+import tempfile
+import time
+
+from lib.process_manager import (
+    async_subprocess_run,
+    run_many,
+    subprocess_run,
+    TIMEOUT_RC,
+    INTERRUPTED_RC,
+    record_steps,
+)
+
+
+def test_async_echo():
+    """
+    Run async_subprocess_run in an event loop.
+    It has the same interface and result of subprocess_run
+    """
+    test_text = "Banana"
+    exit_code, stdout_list = asyncio.run(async_subprocess_run(f'echo "{test_text}"'))
+    assert exit_code == 0
+    assert stdout_list == [test_text]
+
+
+def test_async_long_line():
+    """
+    There's no limit on the length of one output line
+    """
+    exit_code, stdout_list = asyncio.run(
+        async_subprocess_run("python3 -c 'print(\"a\" * 200000)'")
+    )
+    assert exit_code == 0
+    assert stdout_list == ["a" * 200000]
+
+
+def test_run_many_order():
+    """
+    Results are in the same order of the commands,
+    also if they do not complete in the same order
+    """
+    results = run_many(
+        [
+            {"cmd": "sh -c 'sleep 0.3; echo first'"},
+            {"cmd": "sh -c 'echo second'"},
+            {"cmd": "sh -c 'sleep 0.1; exit 3'"},
+        ]
+    )
+    assert results == [(0, ["first"]), (0, ["second"]), (3, [])]
+
+
+def test_run_many_env():
+    """
+    Each command has its own environment
+    """
+    results = run_many(
+        [
+            {"cmd": "printenv BANANA_VALUE", "env": {"BANANA_VALUE": "1234"}},
+            {"cmd": "printenv BANANA_VALUE", "env": {"BANANA_VALUE": "5678"}},
+        ]
+    )
+    assert results == [(0, ["1234"]), (0, ["5678"])]
+
+
+def test_run_many_concurrent():
+    """
+    Commands run at the same time
+    """
+    start = time.monotonic()
+    results = run_many([{"cmd": "sleep 0.5"}] * 4)
+    elapsed = time.monotonic() - start
+    assert all(rc == 0 for rc, _ in results)
+    assert elapsed < 1.5
+
+
+def test_run_many_max_concurrent():
+    """
+    Commands run at the same time, but no more than max_concurrent
+    """
+    start = time.monotonic()
+    results = run_many([{"cmd": "sleep 0.3"}] * 4, max_concurrent=2)
+    elapsed = time.monotonic() - start
+    assert all(rc == 0 for rc, _ in results)
+    assert elapsed >= 0.6
+
+
+def _is_running(pid):
+    """
+    True if the process exists and it is not a zombie
+    """
+    try:
+        with open(f"/proc/{pid}/stat", "r", encoding="utf-8") as stat:
+            state = stat.read().rsplit(")", 1)[1].split()[0]
+    except FileNotFoundError:
+        return False
+    return state != "Z"
+
+
+def test_timeout():
+    """
+    A process running longer than the timeout is killed
+    and the exit code is TIMEOUT_RC
+    """
+    start = time.monotonic()
+    exit_code, _ = subprocess_run("sleep 30", timeout=0.5)
+    assert exit_code == TIMEOUT_RC
+    assert time.monotonic() - start < 10
+
+
+def test_timeout_process_group():
+    """
+    The timeout terminates the whole process group,
+    also the processes started by the main one
+    """
+    exit_code, stdout_list = subprocess_run(
+        "sh -c 'sleep 30 & echo $!; wait'", timeout=0.5
+    )
+    assert exit_code == TIMEOUT_RC
+    child_pid = int(stdout_list[0])
+    time.sleep(0.2)
+    assert not _is_running(child_pid)
+
+
+def test_timeout_not_expired():
+    """
+    A timeout has no effect on a process completed in time
+    """
+    exit_code, stdout_list = subprocess_run("echo Banana", timeout=10)
+    assert exit_code == 0
+    assert stdout_list == ["Banana"]
+
+
+def test_cancel():
+    """
+    Cancelling async_subprocess_run terminates the process group
+    """
+
+    async def _cancel_it(log_file):
+        task = asyncio.ensure_future(
+            async_subprocess_run("sh -c 'sleep 30 & echo $!; wait'", log_file=log_file)
+        )
+        await asyncio.sleep(0.5)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            return True
+        return False
+
+    with tempfile.NamedTemporaryFile() as log_file:
+        assert asyncio.run(_cancel_it(log_file.name))
+        child_pid = int(log_file.read().decode().split()[0])
+    time.sleep(0.2)
+    assert not _is_running(child_pid)
+
+
+def test_sigterm():
+    """
+    SIGTERM received by qesap.py terminates the running process group.
+    The process itself send the SIGTERM to its parent.
+    """
+    start = time.monotonic()
+    exit_code, _ = subprocess_run("sh -c 'kill -TERM $PPID; sleep 30'")
+    assert exit_code == INTERRUPTED_RC
+    assert time.monotonic() - start < 10
+
+
+def test_accounting():
+    """
+    Each process get its timing and resource usage recorded
+    in the list of the record_steps context
+    """
+    with record_steps() as steps:
+        exit_code, _ = subprocess_run(
+            "python3 -c 'b = bytearray(64 * 1024 * 1024); sum(range(3000000))'"
+        )
+    assert exit_code == 0
+    assert len(steps) == 1
+    step = steps[0]
+    assert step["rc"] == 0
+    assert step["cmd"].startswith("python3")
+    assert step["wall_time"] > 0
+    assert step["user_cpu"] + step["sys_cpu"] > 0
+    assert step["max_rss_kb"] > 64 * 1024
+
+    # Out of the context, nothing is recorded
+    subprocess_run("true")
+    assert len(steps) == 1
+
+
+def test_accounting_timeout():
+    """
+    Process killed for timeout are also recorded
+    """
+    with record_steps() as steps:
+        subprocess_run("sleep 30", timeout=0.2)
+    assert [step["rc"] for step in steps] == [TIMEOUT_RC]
+
+
+def test_accounting_concurrent():
+    """
+    Resource usage of concurrent processes is recorded for each of them
+    """
+    with record_steps() as steps:
+        run_many(
+            [
+                {"cmd": "python3 -c 'b = bytearray(96 * 1024 * 1024)'"},
+                {"cmd": "sleep 0.2"},
+            ]
+        )
+    max_rss = {step["cmd"]: step["max_rss_kb"] for step in steps}
+    assert max_rss["sleep 0.2"] < 96 * 1024
+    assert max_rss["python3 -c 'b = bytearray(96 * 1024 * 1024)'"] > 96 * 1024
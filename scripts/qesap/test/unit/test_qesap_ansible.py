@@ -1,9 +1,16 @@
+import asyncio
 import os
 from unittest import mock
 import pytest
 import logging
+import shutil
+import socket
 
 from qesap import main
+from lib.process_manager import TIMEOUT_RC
+import lib.fact_cache
+import lib.process_manager
+import lib.ssh_multiplex
 
 
 log = logging.getLogger(__name__)
@@ -797,7 +804,7 @@ def test_ansible_create_logs(
 ):
     """
     Test that config.yml with playbook named `<SOMETHING>.yaml`
-    result in the generation of a log file named `<SOMETHING>.log.txt`
+    result in the output streamed to a log file named `ansible.<SOMETHING>.log.txt`
     """
     provider = "grilloparlante"
     playbooks = {"create": ["get_cherry_wood", "made_pinocchio_head"]}
@@ -817,8 +824,9 @@ def test_ansible_create_logs(
 
     assert main(args) == 0
 
-    assert os.path.isfile("ansible.get_cherry_wood.log.txt")
-    assert os.path.isfile("ansible.made_pinocchio_head.log.txt")
+    log_files = [kwargs.get("log_file") for _, kwargs in run.call_args_list]
+    assert "ansible.get_cherry_wood.log.txt" in log_files
+    assert "ansible.made_pinocchio_head.log.txt" in log_files
 
 
 @pytest.mark.parametrize("seq", ["create", "destroy"])
@@ -1032,3 +1040,545 @@ terraform:
     for c in calls:
         if "ssh-extra-args" in str(c[1]["cmd"]):
             assert "donalduck" in str(c[1]["cmd"])
+
+
+@mock.patch("shutil.which", side_effect=lambda x: fake_ansible_path(x))
+@mock.patch("lib.process_manager.subprocess_run")
+def test_ansible_command_timeout(
+    run, _, tmpdir, base_args, create_inventory, create_playbooks, ansible_config
+):
+    """
+    ansible::command_timeout is used as timeout for each command.
+    A playbook killed for timeout stop the sequence with an explicit error.
+    """
+    provider = "grilloparlante"
+    playbooks = {"create": ["get_cherry_wood", "made_pinocchio_head"]}
+    config_content = ansible_config(provider, playbooks)
+    config_content += "\n    command_timeout: 600"
+    config_file_name = str(tmpdir / "config.yaml")
+    with open(config_file_name, "w", encoding="utf-8") as file:
+        file.write(config_content)
+
+    args = base_args(None, config_file_name, False)
+    args.append("ansible")
+    create_inventory(provider)
+    create_playbooks(playbooks["create"])
+    run.side_effect = [(0, []), (0, []), (TIMEOUT_RC, [])]
+
+    res = main(args)
+
+    assert res != 0
+    assert "command timeout of 600s expired" in res.msg
+    assert "get_cherry_wood" in res.msg
+    assert run.call_count == 3
+    for _, kwargs in run.call_args_list:
+        assert kwargs["timeout"] == 600
+
+
+@mock.patch("shutil.which", side_effect=lambda x: fake_ansible_path(x))
+@mock.patch("lib.process_manager.subprocess_run")
+def test_ansible_ssh_control_persist(
+    run, _, tmpdir, base_args, create_inventory, create_playbooks, ansible_config
+):
+    """
+    ansible::ssh_control_persist enables persistent SSH connections:
+    all the Ansible commands use the same ControlPath,
+    and the master connections are closed at the end
+    """
+    provider = "grilloparlante"
+    playbooks = {"create": ["get_cherry_wood", "made_pinocchio_head"]}
+    config_content = ansible_config(provider, playbooks)
+    config_content += "\n    ssh_control_persist: 10m"
+    config_file_name = str(tmpdir / "config.yaml")
+    with open(config_file_name, "w", encoding="utf-8") as file:
+        file.write(config_content)
+
+    args = base_args(None, config_file_name, False)
+    args.append("ansible")
+    create_inventory(provider)
+    create_playbooks(playbooks["create"])
+    run.return_value = (0, [])
+
+    control_dir = lib.ssh_multiplex.control_dir(str(tmpdir))
+    os.makedirs(control_dir, exist_ok=True)
+    master = socket.socket(socket.AF_UNIX)
+    try:
+        master.bind(os.path.join(control_dir, "0123456789abcdef"))
+
+        assert main(args) == 0
+    finally:
+        master.close()
+        shutil.rmtree(control_dir)
+
+    ansible_calls = run.call_args_list[:-1]
+    assert len(ansible_calls) == 4
+    for call in ansible_calls:
+        ssh_args = call.kwargs["env"]["ANSIBLE_SSH_ARGS"]
+        assert "-o ControlPersist=10m" in ssh_args
+        assert f"-o ControlPath={control_dir}/%C" in ssh_args
+    teardown = run.call_args_list[-1]
+    assert teardown.args == ()
+    assert teardown.kwargs["cmd"].endswith(" -O exit qesap")
+    assert f"-o ControlPath={control_dir}/0123456789abcdef" in teardown.kwargs["cmd"]
+
+
+@mock.patch("shutil.which", side_effect=lambda x: fake_ansible_path(x))
+@mock.patch("lib.process_manager.subprocess_run")
+def test_ansible_ssh_control_persist_teardown_on_error(
+    run, _, tmpdir, base_args, create_inventory, create_playbooks, ansible_config
+):
+    """
+    The SSH master connections are closed also if
+    running the Ansible commands raises an exception
+    """
+    provider = "grilloparlante"
+    playbooks = {"create": ["get_cherry_wood"]}
+    config_content = ansible_config(provider, playbooks)
+    config_content += "\n    ssh_control_persist: 10m"
+    config_file_name = str(tmpdir / "config.yaml")
+    with open(config_file_name, "w", encoding="utf-8") as file:
+        file.write(config_content)
+
+    args = base_args(None, config_file_name, False)
+    args.append("ansible")
+    create_inventory(provider)
+    create_playbooks(playbooks["create"])
+
+    def fake_run(**kwargs):
+        if kwargs["cmd"].endswith(" -O exit qesap"):
+            return (0, [])
+        raise RuntimeError("Pinocchio nose is too long")
+
+    run.side_effect = fake_run
+
+    control_dir = lib.ssh_multiplex.control_dir(str(tmpdir))
+    os.makedirs(control_dir, exist_ok=True)
+    master = socket.socket(socket.AF_UNIX)
+    try:
+        master.bind(os.path.join(control_dir, "0123456789abcdef"))
+
+        with pytest.raises(RuntimeError):
+            main(args)
+    finally:
+        master.close()
+        shutil.rmtree(control_dir)
+
+    assert run.call_args_list[-1].kwargs["cmd"].endswith(" -O exit qesap")
+
+
+def test_ssh_control_dir(tmpdir):
+    """
+    The SSH control folder is within the base project folder,
+    unless the path is too long to be used for unix sockets
+    """
+    assert lib.ssh_multiplex.control_dir("/b") == "/b/.qesap/ssh"
+    long_dir = lib.ssh_multiplex.control_dir("/b" * 100)
+    assert len(long_dir) <= lib.ssh_multiplex.MAX_CONTROL_DIR_LEN
+    assert long_dir != lib.ssh_multiplex.control_dir("/c" * 100)
+
+
+@mock.patch("shutil.which", side_effect=lambda x: fake_ansible_path(x))
+@mock.patch("lib.readiness.wait_hosts")
+@mock.patch("lib.process_manager.subprocess_run")
+@pytest.mark.parametrize("ready", [True, False])
+def test_ansible_readiness_probe(
+    run,
+    wait_hosts,
+    _,
+    ready,
+    tmpdir,
+    base_args,
+    create_inventory,
+    create_playbooks,
+    ansible_config,
+):
+    """
+    ansible::readiness_probe replaces the two ad-hoc ansible commands
+    with the built-in probe. Playbooks only run if all the hosts are ready.
+    """
+    provider = "grilloparlante"
+    playbooks = {"create": ["get_cherry_wood", "made_pinocchio_head"]}
+    config_content = ansible_config(provider, playbooks)
+    config_content += "\n    readiness_probe:\n        timeout: 42"
+    config_file_name = str(tmpdir / "config.yaml")
+    with open(config_file_name, "w", encoding="utf-8") as file:
+        file.write(config_content)
+
+    args = base_args(None, config_file_name, False)
+    args.append("ansible")
+    inventory = create_inventory(provider)
+    create_playbooks(playbooks["create"])
+    run.return_value = (0, [])
+    wait_hosts.return_value = [
+        {"host": "vmhana01", "ready": True, "failed_at": None, "tcp": 1},
+        {"host": "vmhana02", "ready": ready, "failed_at": None if ready else "ssh"},
+    ]
+
+    res = main(args)
+
+    wait_hosts.assert_called_once_with(
+        inventory, "cloudadmin", timeout=42, ssh_args=None
+    )
+    if ready:
+        assert res == 0
+        assert run.call_count == 2
+        for call in run.call_args_list:
+            assert "ansible-playbook" in call.kwargs["cmd"]
+    else:
+        assert res != 0
+        assert "vmhana02 (ssh)" in res.msg
+        run.assert_not_called()
+
+
+@mock.patch("shutil.which", side_effect=lambda x: fake_ansible_path(x))
+@mock.patch("lib.process_manager.async_subprocess_run", new_callable=mock.AsyncMock)
+@pytest.mark.parametrize("fail", [None, "cut_legs"])
+def test_ansible_sequence_dag(
+    run, _, fail, tmpdir, base_args, create_inventory, create_playbooks, ansible_config
+):
+    """
+    Playbooks declaring their dependencies with 'after' run concurrently,
+    each one as soon as the ones it depends on are completed.
+    After a failure, the steps depending on the failed one are skipped.
+    """
+    provider = "grilloparlante"
+    playbooks = ["get_cherry_wood", "cut_legs", "made_pinocchio_head", "assemble"]
+    config_content = ansible_config(provider, {})
+    config_content += """
+    create:
+        - get_cherry_wood.yaml
+        - playbook: cut_legs.yaml
+          hosts: hana
+        - playbook: made_pinocchio_head.yaml -e nose=long
+          name: head
+          after: get_cherry_wood
+        - playbook: assemble.yaml
+          after: [cut_legs, head]"""
+    config_file_name = str(tmpdir / "config.yaml")
+    with open(config_file_name, "w", encoding="utf-8") as file:
+        file.write(config_content)
+
+    args = base_args(None, config_file_name, False)
+    args.append("ansible")
+    create_inventory(provider)
+    create_playbooks(playbooks)
+
+    events = []
+
+    async def _fake_run(cmd, **kwargs):
+        name = next((p for p in playbooks if f"{p}.yaml" in cmd), cmd)
+        events.append(("start", name))
+        await asyncio.sleep(0.01)
+        events.append(("end", name))
+        return (1 if name == fail else 0, [])
+
+    run.side_effect = _fake_run
+
+    res = main(args)
+
+    # cut_legs and made_pinocchio_head both only wait for get_cherry_wood
+    assert events.index(("end", "get_cherry_wood")) < events.index(
+        ("start", "cut_legs")
+    )
+    assert events.index(("start", "made_pinocchio_head")) < events.index(
+        ("end", "cut_legs")
+    )
+    cmds = [call.kwargs["cmd"] for call in run.call_args_list]
+    assert any("cut_legs.yaml --limit hana" in cmd for cmd in cmds)
+    logs = [call.kwargs.get("log_file") for call in run.call_args_list]
+    assert "ansible.head.log.txt" in logs
+    if fail:
+        assert res != 0
+        assert "cut_legs.yaml" in res.msg
+        assert ("start", "assemble") not in events
+    else:
+        assert res == 0
+        assert events.index(("end", "made_pinocchio_head")) < events.index(
+            ("start", "assemble")
+        )
+        assert events[-1] == ("end", "assemble")
+
+
+@mock.patch("shutil.which", side_effect=lambda x: fake_ansible_path(x))
+@mock.patch("lib.process_manager.subprocess_run")
+def test_ansible_resume(
+    run, _, tmpdir, base_args, create_inventory, create_playbooks, ansible_config
+):
+    """
+    qesap.py ansible --resume skips the playbooks
+    completed by the previous run of the same sequence
+    """
+    provider = "grilloparlante"
+    playbooks = {"create": ["get_cherry_wood", "made_pinocchio_head", "cut_legs"]}
+    config_content = ansible_config(provider, playbooks)
+    config_file_name = str(tmpdir / "config.yaml")
+    with open(config_file_name, "w", encoding="utf-8") as file:
+        file.write(config_content)
+
+    args = base_args(None, config_file_name, False)
+    args.append("ansible")
+    create_inventory(provider)
+    create_playbooks(playbooks["create"])
+
+    def _fail_on_head(cmd, **kwargs):
+        return (1 if "made_pinocchio_head" in cmd else 0, [])
+
+    run.side_effect = _fail_on_head
+    assert main(args) != 0
+    assert run.call_count == 4
+
+    run.reset_mock()
+    run.side_effect = None
+    run.return_value = (0, [])
+    assert main(args + ["--resume"]) == 0
+    cmds = [call.kwargs["cmd"] for call in run.call_args_list]
+    # the two ad-hoc ansible commands always run
+    assert len(cmds) == 4
+    assert not any("get_cherry_wood" in cmd for cmd in cmds)
+
+    run.reset_mock()
+    assert main(args + ["--resume"]) == 0
+    assert run.call_count == 2
+
+    run.reset_mock()
+    assert main(args) == 0
+    assert run.call_count == 5
+
+
+@mock.patch("shutil.which", side_effect=lambda x: fake_ansible_path(x))
+@mock.patch("lib.process_manager.subprocess_run")
+def test_ansible_fact_cache(
+    run, _, tmpdir, base_args, create_inventory, create_playbooks, ansible_config
+):
+    """
+    ansible::fact_cache configures a facts cache shared by all the playbooks,
+    flushed by the playbook after the one patching the hosts
+    """
+    provider = "grilloparlante"
+    playbooks = {"create": ["get_cherry_wood", "fully-patch-system", "cut_legs"]}
+    config_content = ansible_config(provider, playbooks)
+    config_content += "\n    fact_cache: true"
+    config_file_name = str(tmpdir / "config.yaml")
+    with open(config_file_name, "w", encoding="utf-8") as file:
+        file.write(config_content)
+
+    args = base_args(None, config_file_name, False)
+    args.append("ansible")
+    create_inventory(provider)
+    create_playbooks(playbooks["create"])
+    cache_dir = lib.fact_cache.cache_dir(str(tmpdir))
+    os.makedirs(cache_dir)
+    with open(os.path.join(cache_dir, "vmhana01"), "w", encoding="utf-8") as file:
+        file.write("{}")
+    run.return_value = (0, [])
+
+    assert main(args) == 0
+
+    assert not os.path.exists(cache_dir)
+    playbook_calls = run.call_args_list[2:]
+    assert len(playbook_calls) == 3
+    for call in playbook_calls:
+        env = call.kwargs["env"]
+        assert env["ANSIBLE_CACHE_PLUGIN"] == "jsonfile"
+        assert env["ANSIBLE_CACHE_PLUGIN_CONNECTION"] == cache_dir
+        assert env["ANSIBLE_GATHERING"] == "smart"
+    flushing = [
+        call for call in playbook_calls if "--flush-cache" in call.kwargs["cmd"]
+    ]
+    assert len(flushing) == 1
+    assert "cut_legs.yaml --flush-cache" in flushing[0].kwargs["cmd"]
+
+
+@mock.patch("shutil.which", side_effect=lambda x: fake_ansible_path(x))
+@mock.patch("importlib.util.find_spec", return_value=None)
+@mock.patch("lib.process_manager.subprocess_run")
+def test_ansible_execution_profiles(
+    run, _, __, tmpdir, base_args, create_inventory, create_playbooks, ansible_config
+):
+    """
+    Each playbook runs with the environment of its execution profile.
+    Mitogen strategies fall back to the Ansible ones if Mitogen is not installed.
+    """
+    provider = "grilloparlante"
+    config_content = ansible_config(provider, {})
+    config_content += """
+    execution_profiles:
+        fast:
+            forks: 30
+            strategy: mitogen_free
+            timeout: 60
+            env:
+                ANSIBLE_NOCOLOR: 1
+    create:
+        - playbook: get_cherry_wood.yaml
+          profile: fast
+        - made_pinocchio_head.yaml"""
+    config_file_name = str(tmpdir / "config.yaml")
+    with open(config_file_name, "w", encoding="utf-8") as file:
+        file.write(config_content)
+
+    args = base_args(None, config_file_name, False)
+    args.append("ansible")
+    create_inventory(provider)
+    create_playbooks(["get_cherry_wood", "made_pinocchio_head"])
+    run.return_value = (0, [])
+
+    assert main(args) == 0
+
+    fast, linear = [call.kwargs["env"] for call in run.call_args_list[2:]]
+    assert fast["ANSIBLE_FORKS"] == "30"
+    assert fast["ANSIBLE_STRATEGY"] == "free"
+    assert fast["ANSIBLE_TIMEOUT"] == "60"
+    assert fast["ANSIBLE_NOCOLOR"] == "1"
+    assert fast["ANSIBLE_PIPELINING"] == "True"
+    assert "ANSIBLE_STRATEGY_PLUGINS" not in fast
+    assert "ANSIBLE_STRATEGY" not in linear
+    assert linear["ANSIBLE_TIMEOUT"] == "20"
+
+
+@mock.patch("shutil.which", side_effect=lambda x: fake_ansible_path(x))
+@mock.patch("lib.process_manager.subprocess_run")
+def test_ansible_timings(
+    run, _, tmpdir, base_args, create_inventory, create_playbooks, ansible_config
+):
+    """
+    ansible --timings enables the qesap_timings callback,
+    writing a timing file for each playbook
+    """
+    provider = "grilloparlante"
+    playbooks = {"create": ["get_cherry_wood", "made_pinocchio_head"]}
+    config_content = ansible_config(provider, playbooks)
+    config_file_name = str(tmpdir / "config.yaml")
+    with open(config_file_name, "w", encoding="utf-8") as file:
+        file.write(config_content)
+
+    args = base_args(None, config_file_name, False)
+    args.extend(["ansible", "--timings"])
+    create_inventory(provider)
+    create_playbooks(playbooks["create"])
+    run.return_value = (0, [])
+
+    assert main(args) == 0
+
+    playbook_calls = run.call_args_list[2:]
+    for call, playbook in zip(playbook_calls, playbooks["create"]):
+        env = call.kwargs["env"]
+        assert env["ANSIBLE_CALLBACKS_ENABLED"] == "qesap_timings"
+        assert env["QESAP_TIMINGS_FILE"] == f"ansible.{playbook}.timing.jsonl"
+
+
+@mock.patch("shutil.which", side_effect=lambda x: fake_ansible_path(x))
+@mock.patch("lib.process_manager.async_subprocess_run", new_callable=mock.AsyncMock)
+def test_ansible_fail_fast(
+    run, _, tmpdir, base_args, create_inventory, create_playbooks, ansible_config
+):
+    """
+    ansible::fail_fast terminates the sequence as soon as a playbook output
+    matches a pattern, also stopping the playbooks running concurrently
+    """
+    provider = "grilloparlante"
+    config_content = ansible_config(provider, {})
+    config_content += """
+    fail_fast: true
+    create:
+        - get_cherry_wood.yaml
+        - playbook: cut_legs.yaml
+          after: get_cherry_wood
+        - playbook: made_pinocchio_head.yaml
+          after: get_cherry_wood
+        - assemble.yaml"""
+    config_file_name = str(tmpdir / "config.yaml")
+    with open(config_file_name, "w", encoding="utf-8") as file:
+        file.write(config_content)
+
+    args = base_args(None, config_file_name, False)
+    args.append("ansible")
+    create_inventory(provider)
+    create_playbooks(["get_cherry_wood", "cut_legs", "made_pinocchio_head", "assemble"])
+
+    async def _fake_run(cmd, line_handler=None, **kwargs):
+        if "cut_legs" in cmd:
+            await asyncio.sleep(0.01)
+            for line in ["TASK [saw] ***", "fatal: [vmhana01]: UNREACHABLE! => {}"]:
+                if line_handler(line):
+                    return (lib.process_manager.ABORTED_RC, [])
+        if "made_pinocchio_head" in cmd:
+            await asyncio.sleep(60)
+        return (0, [])
+
+    run.side_effect = _fake_run
+
+    res = main(args)
+
+    assert res != 0
+    assert "cut_legs.yaml: [saw] fatal: [vmhana01]: UNREACHABLE!" in res.msg
+    cmds = [call.kwargs["cmd"] for call in run.call_args_list]
+    assert not any("assemble" in cmd for cmd in cmds)
+
+
+@mock.patch("shutil.which", side_effect=lambda x: fake_ansible_path(x))
+@mock.patch("lib.process_manager.subprocess_run")
+def test_ansible_retry_failed(
+    run, _, tmpdir, base_args, create_inventory, create_playbooks, ansible_config
+):
+    """
+    ansible --retry-failed resumes the sequence, only running
+    the playbooks with retry_limit on the hosts that failed
+    """
+    provider = "grilloparlante"
+    config_content = ansible_config(provider, {})
+    config_content += """
+    create:
+        - get_cherry_wood.yaml
+        - playbook: made_pinocchio_head.yaml
+          retry_limit: true
+        - playbook: cut_legs.yaml
+          retry_limit: true
+        - assemble.yaml"""
+    config_file_name = str(tmpdir / "config.yaml")
+    with open(config_file_name, "w", encoding="utf-8") as file:
+        file.write(config_content)
+
+    args = base_args(None, config_file_name, False)
+    args.append("ansible")
+    create_inventory(provider)
+    create_playbooks(["get_cherry_wood", "made_pinocchio_head", "cut_legs", "assemble"])
+
+    def _fail_on_head(cmd, env=None, **kwargs):
+        if "made_pinocchio_head" not in cmd:
+            return (0, [])
+        retry_path = env["ANSIBLE_RETRY_FILES_SAVE_PATH"]
+        os.makedirs(retry_path, exist_ok=True)
+        retry_file = os.path.join(retry_path, "made_pinocchio_head.retry")
+        with open(retry_file, "w", encoding="utf-8") as file:
+            file.write("vmhana02\n")
+        return (2, [])
+
+    run.side_effect = _fail_on_head
+    assert main(args) != 0
+
+    run.reset_mock()
+    run.side_effect = None
+    run.return_value = (0, [])
+    assert main(args + ["--retry-failed"]) == 0
+
+    limit_file = str(
+        tmpdir
+        / ".qesap"
+        / "retry"
+        / "create"
+        / "qesap.made_pinocchio_head.failed_hosts"
+    )
+    with open(limit_file, "r", encoding="utf-8") as file:
+        assert file.read() == "vmhana02\n"
+    cmds = [call.kwargs["cmd"] for call in run.call_args_list[2:]]
+    assert len(cmds) == 3
+    assert cmds[0].endswith(f"made_pinocchio_head.yaml --limit @{limit_file}")
+    # Never started in the failed run: it has to run on all the hosts
+    assert cmds[1].endswith("cut_legs.yaml")
+    assert cmds[2].endswith("assemble.yaml")
+
+    run.reset_mock()
+    assert main(args) == 0
+    assert not os.path.exists(limit_file)
+    assert "--limit" not in str(run.call_args_list)
@@ -0,0 +1,124 @@
+import os
+from unittest import mock
+
+import pytest
+
+from qesap import main
+
+
+def create_cache_entry(cache_dir, version, size):
+    path = os.path.join(cache_dir, "registry.terraform.io", "h", "null", version)
+    os.makedirs(path)
+    with open(os.path.join(path, "provider"), "w", encoding="utf-8") as file:
+        file.write("x" * size)
+    return path
+
+
+@mock.patch("lib.process_manager.subprocess_run")
+def test_terraform_plugin_cache(subprocess_run, args_helper, tmpdir):
+    """
+    terraform::plugin_cache_dir is created and
+    exported as TF_PLUGIN_CACHE_DIR to all terraform commands
+    """
+    cache_dir = str(tmpdir / "plugin_cache")
+    conf = f"""---
+apiver: 3
+provider: mangiafuoco
+terraform:
+  plugin_cache_dir: {cache_dir}
+  variables:
+    az_region: "westeurope"
+"""
+    args, *_ = args_helper("mangiafuoco", conf)
+    args.append("terraform")
+    subprocess_run.return_value = (0, [])
+
+    assert main(args) == 0
+
+    assert os.path.isdir(cache_dir)
+    assert subprocess_run.call_count == 3
+    for _, kwargs in subprocess_run.call_args_list:
+        assert kwargs["env"]["TF_PLUGIN_CACHE_DIR"] == cache_dir
+        assert kwargs["env"]["PATH"] == os.environ["PATH"]
+
+
+def test_cache_prune(args_helper, tmpdir):
+    """
+    cache prune sub-command remove the oldest entries
+    to fit in terraform::plugin_cache_max_size
+    """
+    cache_dir = str(tmpdir / "plugin_cache")
+    old = create_cache_entry(cache_dir, "1.0.0", 2048)
+    os.utime(old, (1, 1))
+    new = create_cache_entry(cache_dir, "2.0.0", 2048)
+    conf = f"""---
+apiver: 3
+provider: mangiafuoco
+terraform:
+  plugin_cache_dir: {cache_dir}
+  plugin_cache_max_size: 3K
+"""
+    args, *_ = args_helper("mangiafuoco", conf)
+    args.extend(["cache", "prune"])
+
+    assert main(args) == 0
+
+    assert not os.path.exists(old)
+    assert os.path.isdir(new)
+
+
+def test_cache_prune_max_size_arg(args_helper, tmpdir):
+    """
+    --max-size has priority on the conf.yaml
+    """
+    cache_dir = str(tmpdir / "plugin_cache")
+    entry = create_cache_entry(cache_dir, "1.0.0", 2048)
+    conf = f"""---
+apiver: 3
+provider: mangiafuoco
+terraform:
+  plugin_cache_dir: {cache_dir}
+  plugin_cache_max_size: 1K
+"""
+    args, *_ = args_helper("mangiafuoco", conf)
+    args.extend(["cache", "prune", "--max-size", "1M"])
+
+    assert main(args) == 0
+
+    assert os.path.isdir(entry)
+
+
+def test_cache_prune_no_base_dir(tmpdir):
+    """
+    cache prune only needs the config file, not the -b base folder
+    """
+    cache_dir = str(tmpdir / "plugin_cache")
+    entry = create_cache_entry(cache_dir, "1.0.0", 2048)
+    config_file_name = str(tmpdir / "config.yaml")
+    with open(config_file_name, "w", encoding="utf-8") as file:
+        file.write(
+            f"""---
+apiver: 3
+provider: mangiafuoco
+terraform:
+  plugin_cache_dir: {cache_dir}
+  plugin_cache_max_size: 1K
+"""
+        )
+
+    assert main(["-c", config_file_name, "cache", "prune"]) == 0
+
+    assert not os.path.exists(entry)
+    # The config file is still needed
+    with pytest.raises(SystemExit):
+        main(["cache", "prune"])
+
+
+def test_cache_prune_no_cache(args_helper, config_yaml_sample):
+    """
+    cache prune fails if there's no cache configured
+    """
+    args, *_ = args_helper("mangiafuoco", config_yaml_sample("mangiafuoco"))
+    args.extend(["cache", "prune", "--max-size", "1G"])
+
+    assert main(args) != 0
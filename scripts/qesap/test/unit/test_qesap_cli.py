@@ -198,3 +198,52 @@ def test_cli_ansible_junit(base_args):
     args.append("--junit")
     args.append("/somefolder/")
     cli(args)
+
+
+def test_cli_terraform_workspaces(base_args):
+    """
+    Test terraform with --workspaces to deploy many workspaces concurrently
+    """
+    args = base_args()
+    args.extend(["terraform", "--workspaces", "a,b", "--max-concurrent", "2"])
+    cli_args = cli(args)
+    assert cli_args.workspaces == ["a", "b"]
+    assert cli_args.max_concurrent == 2
+
+
+def test_cli_terraform_workspace_and_workspaces(base_args, capsys):
+    """
+    -w and --workspaces cannot be used together
+    """
+    args = base_args()
+    args.extend(["terraform", "-w", "a", "--workspaces", "a,b"])
+    try:
+        cli(args)
+        assert False, "cli is expected to exit"
+    except SystemExit:
+        pass
+    captured = capsys.readouterr()
+    assert "not allowed with argument" in captured.err
+
+
+def test_cli_terraform_parallel(base_args, capsys):
+    """
+    -p is a positive integer or auto
+    """
+    args = base_args()
+    args.extend(["terraform", "-p", "auto"])
+    assert cli(args).parallel == "auto"
+
+    args = base_args()
+    args.extend(["terraform", "-p", "3"])
+    assert cli(args).parallel == 3
+
+    for invalid in ["banana", "0"]:
+        args = base_args()
+        args.extend(["terraform", "-p", invalid])
+        try:
+            cli(args)
+            assert False, "cli is expected to exit"
+        except SystemExit:
+            pass
+        assert "parallel_value" in capsys.readouterr().err
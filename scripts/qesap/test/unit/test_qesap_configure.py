@@ -1,5 +1,8 @@
 import os
 
+import yaml
+
+from lib.cmds import cmd_configure
 from qesap import main
 
 
@@ -269,3 +272,47 @@ terraform:
     args = base_args(base_dir=tmpdir, config_file=config_file_name)
     args.append("configure")
     assert main(args) == 0
+
+
+def test_configure_unchanged_files(configure_helper, config_yaml_sample, tmpdir):
+    """
+    Running 'configure' twice with the same conf.yaml does not rewrite
+    the generated files, so their mtime is preserved
+    """
+    provider = "pinocchio"
+    conf = config_yaml_sample(provider)
+    args, tfvar_file, hana_media, hana_vars = configure_helper(provider, conf)
+    assert main(args) == 0
+    for path in (tfvar_file, hana_media, hana_vars):
+        os.utime(path, (1000, 1000))
+
+    assert main(args) == 0
+
+    for path in (tfvar_file, hana_media, hana_vars):
+        assert os.path.getmtime(path) == 1000
+
+
+def test_configure_changed_files(configure_helper, config_yaml_sample, tmpdir):
+    """
+    Only the files with a different content are written.
+    A change in the Ansible variables removes the journals of the previous runs.
+    """
+    provider = "pinocchio"
+    conf = config_yaml_sample(provider)
+    _, tfvar_file, hana_media, hana_vars = configure_helper(provider, conf)
+    config = yaml.safe_load(conf)
+    assert cmd_configure(config, str(tmpdir), False) == 0
+    for path in (tfvar_file, hana_media, hana_vars):
+        os.utime(path, (1000, 1000))
+    journal = os.path.join(str(tmpdir), ".qesap", "ansible.create.journal")
+    os.makedirs(os.path.dirname(journal), exist_ok=True)
+    with open(journal, "w", encoding="utf-8") as file:
+        file.write("{}\n")
+
+    config["ansible"]["hana_media"].append("ANOTHER.SAR")
+    assert cmd_configure(config, str(tmpdir), False) == 0
+
+    assert os.path.getmtime(hana_media) != 1000
+    assert os.path.getmtime(tfvar_file) == 1000
+    assert os.path.getmtime(hana_vars) == 1000
+    assert not os.path.exists(journal)
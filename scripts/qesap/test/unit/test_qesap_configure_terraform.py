@@ -1,3 +1,4 @@
+import json
 import os
 import re
 import logging
@@ -292,3 +293,147 @@ terraform:
     with open(tfvar_path, "r", encoding="utf-8") as file:
         data = [line for line in file.readlines() if line != "\n"]
         assert expected_tfvars == data
+
+
+def test_configure_tfvars_json(config_yaml_sample_for_terraform, configure_helper):
+    """
+    With tfvars_format json, 'configure' writes terraform.tfvars.json
+    preserving the type of all the values, also nested ones.
+    A terraform.tfvars not written by 'configure' is not removed.
+    """
+    provider = "pinocchio"
+    terraform_section = """terraform:
+  tfvars_format: json
+  variables:
+    region : eu1
+    hana_count : 2
+    ratio : 0.5
+    enabled : true
+    zones : [1, "b"]
+    tags :
+      owner : 'me "quoted"'
+      nested : {a: [1, 2]}
+"""
+    conf = config_yaml_sample_for_terraform(terraform_section, provider)
+    args, tfvar_path, *_ = configure_helper(provider, conf)
+    with open(tfvar_path, "w", encoding="utf-8") as file:
+        file.write("region = old\n")
+
+    assert main(args) == 0
+
+    with open(tfvar_path, "r", encoding="utf-8") as file:
+        assert file.read() == "region = old\n"
+    with open(tfvar_path + ".json", "r", encoding="utf-8") as file:
+        assert json.load(file) == {
+            "region": "eu1",
+            "hana_count": 2,
+            "ratio": 0.5,
+            "enabled": True,
+            "zones": [1, "b"],
+            "tags": {"owner": 'me "quoted"', "nested": {"a": [1, 2]}},
+        }
+
+
+def test_configure_tfvars_format_switch(
+    config_yaml_sample_for_terraform, configure_helper
+):
+    """
+    Changing tfvars_format, 'configure' removes the file written
+    by a previous run with the other format, if it has not been modified since then
+    """
+    provider = "pinocchio"
+    hcl = config_yaml_sample_for_terraform(
+        "terraform:\n  variables:\n    region : eu1\n", provider
+    )
+    json_format = config_yaml_sample_for_terraform(
+        "terraform:\n  tfvars_format: json\n  variables:\n    region : eu1\n",
+        provider,
+    )
+    args, tfvar_path, *_ = configure_helper(provider, hcl)
+    assert main(args) == 0
+    assert os.path.isfile(tfvar_path)
+
+    args, *_ = configure_helper(provider, json_format)
+    assert main(args) == 0
+    assert not os.path.exists(tfvar_path)
+    assert os.path.isfile(tfvar_path + ".json")
+
+    args, *_ = configure_helper(provider, hcl)
+    assert main(args) == 0
+    assert not os.path.exists(tfvar_path + ".json")
+
+    # Modified after the configure: it is not the generated one anymore
+    with open(tfvar_path, "a", encoding="utf-8") as file:
+        file.write('zone = "b"\n')
+    args, *_ = configure_helper(provider, json_format)
+    assert main(args) == 0
+    assert os.path.isfile(tfvar_path)
+    assert os.path.isfile(tfvar_path + ".json")
+
+
+def test_configure_tfvars_json_template(
+    config_yaml_sample_for_terraform, configure_helper, tmpdir
+):
+    """
+    With tfvars_format json, the variables are merged
+    in a .tfvars.json template and the YAML content win
+    """
+    provider = "pinocchio"
+    tfvar_template = {}
+    tfvar_template["file"] = tmpdir / "terraform.template.tfvars.json"
+    tfvar_template["data"] = ['{"something": "static", "region": "eu9", "count": 1}']
+    terraform_section = f"""terraform:
+  tfvars_format: json
+  tfvars_template: {tfvar_template["file"]}
+  variables:
+    region : eu1
+"""
+    conf = config_yaml_sample_for_terraform(terraform_section, provider)
+    args, tfvar_path, *_ = configure_helper(provider, conf, tfvar_template)
+
+    assert main(args) == 0
+
+    with open(tfvar_path + ".json", "r", encoding="utf-8") as file:
+        assert json.load(file) == {"something": "static", "region": "eu1", "count": 1}
+
+
+def test_configure_tfvars_json_hcl_template(
+    config_yaml_sample_for_terraform, configure_helper, tmpdir
+):
+    """
+    With tfvars_format json, a HCL template is an error
+    """
+    provider = "pinocchio"
+    tfvar_template = {}
+    tfvar_template["file"] = tmpdir / "terraform.template.tfvar"
+    tfvar_template["data"] = ["something = static\n"]
+    terraform_section = f"""terraform:
+  tfvars_format: json
+  tfvars_template: {tfvar_template["file"]}
+  variables:
+    region : eu1
+"""
+    conf = config_yaml_sample_for_terraform(terraform_section, provider)
+    args, tfvar_path, *_ = configure_helper(provider, conf, tfvar_template)
+
+    assert main(args) != 0
+
+    assert not os.path.exists(tfvar_path + ".json")
+
+
+def test_configure_tfvars_format_invalid(
+    config_yaml_sample_for_terraform, configure_helper
+):
+    """
+    Only hcl and json are valid tfvars_format
+    """
+    provider = "pinocchio"
+    terraform_section = """terraform:
+  tfvars_format: yaml
+  variables:
+    region : eu1
+"""
+    conf = config_yaml_sample_for_terraform(terraform_section, provider)
+    args, *_ = configure_helper(provider, conf)
+
+    assert main(args) != 0
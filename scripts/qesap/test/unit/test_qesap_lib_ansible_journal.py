@@ -0,0 +1,59 @@
+import os
+
+from lib.ansible_journal import AnsibleJournal, journal_file
+
+
+def test_journal_resume(tmpdir):
+    """
+    A command completed in a previous run is skipped on resume,
+    only if the command line and the inventory are the same
+    """
+    inventory = str(tmpdir / "inventory.yaml")
+    with open(inventory, "w", encoding="utf-8") as file:
+        file.write("all:\n  hosts:\n    vmhana01:\n")
+    filename = journal_file(str(tmpdir), "create")
+    commands = [{"cmd": "ansible-playbook a.yaml"}, {"cmd": "ansible-playbook b.yaml"}]
+    ping = {"cmd": "ansible all -a true"}
+
+    journal = AnsibleJournal(filename, inventory, commands)
+    journal.record(ping)
+    journal.record(commands[0])
+    assert os.path.isfile(filename)
+
+    commands = [{"cmd": "ansible-playbook a.yaml"}, {"cmd": "ansible-playbook b.yaml"}]
+    journal = AnsibleJournal(filename, inventory, commands, resume=True)
+    assert journal.done(commands[0])
+    assert not journal.done(commands[1])
+    assert not journal.done(ping)
+
+    changed = [{"cmd": "ansible-playbook a.yaml -e foo=bar"}]
+    assert not AnsibleJournal(filename, inventory, changed, resume=True).done(
+        changed[0]
+    )
+
+    with open(inventory, "a", encoding="utf-8") as file:
+        file.write("    vmhana02:\n")
+    assert not AnsibleJournal(filename, inventory, commands, resume=True).done(
+        commands[0]
+    )
+
+
+def test_journal_reset(tmpdir):
+    """
+    Without resume the journal of the previous runs is discarded
+    """
+    inventory = str(tmpdir / "inventory.yaml")
+    with open(inventory, "w", encoding="utf-8") as file:
+        file.write("all:\n")
+    filename = journal_file(str(tmpdir), "create")
+    commands = [{"cmd": "ansible-playbook a.yaml"}]
+    AnsibleJournal(filename, inventory, commands).record(commands[0])
+    with open(filename, "a", encoding="utf-8") as file:
+        file.write('{"fingerpr')
+
+    assert AnsibleJournal(filename, inventory, commands, resume=True).done(commands[0])
+    assert not AnsibleJournal(filename, inventory, commands).done(commands[0])
+    assert not os.path.exists(filename)
+    assert not AnsibleJournal(filename, inventory, commands, resume=True).done(
+        commands[0]
+    )
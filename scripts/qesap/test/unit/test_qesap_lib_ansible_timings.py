@@ -0,0 +1,114 @@
+import json
+import os
+
+from qesap import main
+from lib.ansible_timings import format_report, host_totals, load, slowest_tasks
+
+
+def record(playbook, task, host, duration, role=None, status="ok"):
+    return {
+        "playbook": playbook,
+        "play": "all",
+        "role": role,
+        "task": task,
+        "action": "shell",
+        "host": host,
+        "start": 0,
+        "end": duration,
+        "duration": duration,
+        "status": status,
+    }
+
+
+RECORDS = [
+    record(
+        "sap-hana-install.yaml", "Install HANA", "vmhana01", 600, "sap_hana_install"
+    ),
+    record(
+        "sap-hana-install.yaml", "Install HANA", "vmhana02", 900, "sap_hana_install"
+    ),
+    record("sap-hana-storage.yaml", "Create LV", "vmhana01", 30, "qe_sap_storage"),
+    record("sap-hana-storage.yaml", "Create LV", "vmhana02", 10, "qe_sap_storage"),
+    record("registration.yaml", "Register", "vmhana02", 60, status="failed"),
+]
+
+
+def write_timings(folder, records):
+    os.makedirs(folder, exist_ok=True)
+    filename = os.path.join(folder, "ansible.sap-hana-install.timing.jsonl")
+    with open(filename, "w", encoding="utf-8") as file:
+        for item in records:
+            file.write(json.dumps(item) + "\n")
+        file.write("not json\n")
+    return filename
+
+
+def test_load(tmpdir):
+    """
+    Timing files are loaded from files and from folders, also nested,
+    skipping invalid lines
+    """
+    filename = write_timings(str(tmpdir / "run1"), RECORDS[:2])
+    write_timings(str(tmpdir / "run2"), RECORDS[2:])
+
+    assert load([filename]) == RECORDS[:2]
+    assert len(load([str(tmpdir)])) == len(RECORDS)
+
+
+def test_slowest_tasks():
+    """
+    Executions of the same task are aggregated, the slowest task is the first
+    """
+    tasks = slowest_tasks(RECORDS, top=2)
+    assert [task["task"] for task in tasks] == ["Install HANA", "Register"]
+    assert tasks[0]["count"] == 2
+    assert tasks[0]["mean"] == 750
+    assert tasks[0]["max"] == 900
+
+
+def test_host_totals():
+    """
+    Per-host comparison of the time spent in each playbook
+    """
+    hosts = host_totals(RECORDS)
+    assert [host["host"] for host in hosts] == ["vmhana01", "vmhana02"]
+    assert hosts[1]["tasks"] == 3
+    assert hosts[1]["failed"] == 1
+    assert hosts[1]["total"] == 970
+    assert hosts[0]["playbooks"] == {
+        "sap-hana-install.yaml": 600,
+        "sap-hana-storage.yaml": 30,
+    }
+
+
+def test_format_report():
+    report = format_report(RECORDS, top=1).splitlines()
+    assert report[0].split() == ["TASK", "COUNT", "MEAN", "MAX"]
+    assert "sap-hana-install.yaml: sap_hana_install : Install HANA" in report[1]
+    assert report[1].split()[-3:] == ["2", "750.0s", "900.0s"]
+    assert report[2] == ""
+    assert report[3].split()[:4] == ["HOST", "TASKS", "FAILED", "TOTAL"]
+    assert report[5].split()[:4] == ["vmhana02", "3", "1", "970.0s"]
+
+
+def test_cli_report_timings(capsys, args_helper, tmpdir):
+    """
+    report timings sub-command prints the report of the files in the given folders
+    """
+    args, *_ = args_helper("mangiafuoco", "---\napiver: 3\nprovider: mangiafuoco\n")
+    write_timings(str(tmpdir / "run1"), RECORDS)
+
+    assert main(args + ["report", "timings", "--top", "3", str(tmpdir)]) == 0
+    assert "Install HANA" in capsys.readouterr().out
+
+    assert main(args + ["report", "timings", str(tmpdir / "empty")]) != 0
+
+
+def test_cli_report_timings_no_config(capsys, tmpdir):
+    """
+    report timings sub-command does not need -c and -b
+    """
+    write_timings(str(tmpdir / "run1"), RECORDS)
+
+    assert main(["report", "timings", str(tmpdir)]) == 0
+    assert "Install HANA" in capsys.readouterr().out
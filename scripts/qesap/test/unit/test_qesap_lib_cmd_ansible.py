@@ -1,10 +1,9 @@
 from unittest import mock
 import logging
-import os
 import yaml
 import re
 
-from lib.cmds import ansible_export_output, cmd_ansible
+from lib.cmds import ansible_log_filename, cmd_ansible
 
 log = logging.getLogger(__name__)
 FAKE_BIN_PATH = "/paese/della/cuccagna/"
@@ -14,26 +13,15 @@ def fake_ansible_path(x):
     return FAKE_BIN_PATH + x
 
 
-def test_export_ansible_output():
+def test_ansible_log_filename():
     """
-    Utility function that get the ansible command line and the command output.
-    Function calculate the log name by extracting the ansible playbook name from the command line.
-    Function take the content of stdout and write it to a file in the current directory
+    Utility function that get the ansible playbook path.
+    Function calculate the log name from the ansible playbook name.
+    The log file is in the current directory.
     """
+    playbook = "/some/immaginary/path/ansible/playbooks/testAll.yaml"
 
-    test_dir = os.getcwd()
-    test_file = os.path.join(test_dir, "ansible.testAll.log.txt")
-
-    command_to_sent = "/tmp/exec_venv/bin/ansible-playbok -vvvv -i /root/qe-sap-deployment/terraform/aws/inventory.yaml /some/immaginary/path/ansible/playbooks/testAll.yaml -e something=somevalue"
-    ansible_output = """whatever multiline string
-    produced by Ansible"""
-
-    ansible_export_output(command_to_sent, ansible_output)
-
-    assert os.path.isfile(test_file), (
-        f"Ansible output file {test_file} was not created."
-    )
-    os.remove(test_file)
+    assert ansible_log_filename(playbook) == "ansible.testAll.log.txt"
 
 
 @mock.patch("shutil.which", side_effect=lambda x: fake_ansible_path(x))
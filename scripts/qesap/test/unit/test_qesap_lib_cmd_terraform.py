@@ -150,7 +150,7 @@ terraform:
 
 
 @mock.patch("lib.process_manager.subprocess_run")
-def test_cmd_terraform(subprocess_run, tmpdir):
+def test_cmd_terraform(subprocess_run, tmpdir, mock_call_terraform):
     """
     This test coverage overlap with tests from
     scripts/qesap/test/unit/test_qesap_terraform.py
@@ -181,5 +181,5 @@ terraform:
     assert ret == 0
     # init just test one of them
     subprocess_run.assert_has_calls(
-        [mock.call(f"terraform -chdir={provider_folder} init -no-color")]
+        [mock_call_terraform(f"terraform -chdir={provider_folder} init -no-color")]
     )
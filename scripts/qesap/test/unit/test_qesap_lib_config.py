@@ -1,5 +1,9 @@
+import copy
 import re
-from lib.config import CONF
+
+import pytest
+
+from lib.config import CONF, get_config, parse_size
 
 
 def test_tfvars_yaml_string():
@@ -80,3 +84,272 @@ def test_tfvars_yaml_dict(config_data_sample):
     c = CONF(config_data_sample(hana_disk_configuration))
     actual_result = c.yaml_to_tfvars()
     assert re.search(expected_result, actual_result)
+
+
+def test_parse_size():
+    """
+    Sizes are integer bytes or strings with K, M, G, T suffixes
+    """
+    assert parse_size(1000) == 1000
+    assert parse_size("1000") == 1000
+    assert parse_size("1K") == 1024
+    assert parse_size("1.5G") == 1536 * 1024 * 1024
+    assert parse_size("10MiB") == 10 * 1024 * 1024
+    assert parse_size("many") is None
+    assert parse_size(-1) is None
+    assert parse_size(True) is None
+
+
+def test_parallel_policy():
+    """
+    terraform:parallel_policy overwrites only some of the defaults
+    and it is validated
+    """
+    conf = {
+        "apiver": 3,
+        "provider": "azure",
+        "terraform": {"parallel_policy": {"max": 20, "provider_max": {"azurerm": 8}}},
+    }
+    config = CONF(conf)
+    assert config.validate()
+    policy = config.get_parallel_policy()
+    assert policy["max"] == 20
+    assert policy["min"] == 10
+    assert policy["provider_max"] == {"azurerm": 8}
+
+    for invalid in [
+        {"max": 0},
+        {"min": 30, "max": 20},
+        {"banana": 1},
+        {"throttle_retries": -1},
+        {"provider_max": 3},
+        {"provider_max": {"aws": "many"}},
+    ]:
+        conf["terraform"]["parallel_policy"] = invalid
+        assert not CONF(conf).validate(), invalid
+
+
+def test_ansible_playbook_steps():
+    """
+    Sequence elements can be dictionaries declaring
+    the dependencies between the playbooks with 'after'
+    """
+    media = {
+        "az_storage_account_name": "pippo",
+        "az_container_name": "pippo",
+        "az_sas_token": "SECRET",
+        "hana_media": ["pippo"],
+    }
+    sequence = [
+        "registration.yaml -e reg_code=1234",
+        {"playbook": "sap-hana-preconfigure.yaml", "hosts": "hana"},
+        {"playbook": "cluster.yaml", "name": "cluster", "after": "registration"},
+        {"playbook": "hana.yaml", "after": ["cluster", "sap-hana-preconfigure"]},
+    ]
+    config = CONF({"apiver": 4, "ansible": dict(media, sequences={"create": sequence})})
+    assert config.validate_ansible_config("create")
+    assert config.has_ansible_dag("create")
+    steps = config.get_playbook_steps("create")
+    assert [step["name"] for step in steps] == [
+        "registration",
+        "sap-hana-preconfigure",
+        "cluster",
+        "hana",
+    ]
+    assert [step["after"] for step in steps] == [[], [0], [0], [2, 1]]
+    assert steps[1]["hosts"] == "hana"
+    assert steps[0]["playbook"] == "registration.yaml -e reg_code=1234"
+
+    config = CONF({"apiver": 4, "ansible": {"sequences": {"create": sequence[:2]}}})
+    assert not config.has_ansible_dag("create")
+
+    for invalid in [
+        [{"name": "nameless"}],
+        [{"playbook": "a.yaml", "banana": 1}],
+        [{"playbook": "a.yaml", "hosts": ""}],
+        [{"playbook": "a.yaml", "after": "b"}, {"playbook": "b.yaml"}],
+        [{"playbook": "a.yaml", "after": "a"}],
+        ["a.yaml", {"playbook": "b.yaml", "after": {"a": 1}}],
+        ["a.yaml", {"playbook": "b.yaml", "name": "a"}],
+        ["a.yaml", "a.yaml -e foo=bar", {"playbook": "b.yaml", "after": "a"}],
+        [42],
+    ]:
+        config = CONF(
+            {"apiver": 4, "ansible": dict(media, sequences={"create": invalid})}
+        )
+        assert not config.validate_ansible_config("create"), invalid
+
+
+def test_execution_profiles():
+    """
+    ansible:execution_profiles are validated
+    and can be selected by the playbooks of a sequence
+    """
+    media = {
+        "az_storage_account_name": "pippo",
+        "az_container_name": "pippo",
+        "az_sas_token": "SECRET",
+        "hana_media": ["pippo"],
+    }
+    profiles = {
+        "default": {"strategy": "linear"},
+        "fast": {"forks": 20, "strategy": "free", "env": {"ANSIBLE_NOCOLOR": "1"}},
+    }
+    sequence = [
+        {"playbook": "registration.yaml", "profile": "fast"},
+        "sap-hana-cluster.yaml",
+    ]
+    ansible = dict(media, execution_profiles=profiles, sequences={"create": sequence})
+    config = CONF({"apiver": 4, "ansible": ansible})
+    assert config.validate_ansible_config("create")
+    assert [step["profile"] for step in config.get_playbook_steps("create")] == [
+        "fast",
+        "default",
+    ]
+
+    for invalid in [
+        {"fast": {"forks": 0}},
+        {"fast": {"forks": True}},
+        {"fast": {"strategy": "banana"}},
+        {"fast": {"serial": 2}},
+        {"fast": {"env": "ANSIBLE_NOCOLOR=1"}},
+        {"fast": "free"},
+        {"slow": {"forks": 1}},
+    ]:
+        ansible["execution_profiles"] = invalid
+        config = CONF({"apiver": 4, "ansible": ansible})
+        assert not config.validate_ansible_config("create"), invalid
+
+
+def test_fail_fast_patterns():
+    """
+    ansible:fail_fast is true, for the default patterns, or a list
+    of regular expressions or of task names with optional pattern
+    """
+    assert CONF({"apiver": 4, "ansible": {}}).get_fail_fast_patterns() == []
+    config = CONF({"apiver": 4, "ansible": {"fail_fast": True}})
+    assert config.validate_fail_fast()
+    assert config.get_fail_fast_patterns() == [
+        {"pattern": "UNREACHABLE!", "task": None}
+    ]
+
+    fail_fast = ["UNREACHABLE!", {"task": "Wait for"}, {"task": "x", "pattern": "y"}]
+    config = CONF({"apiver": 4, "ansible": {"fail_fast": fail_fast}})
+    assert config.validate_fail_fast()
+    assert config.get_fail_fast_patterns() == [
+        {"pattern": "UNREACHABLE!", "task": None},
+        {"pattern": "^fatal: ", "task": "Wait for"},
+        {"pattern": "y", "task": "x"},
+    ]
+
+    for invalid in [
+        "UNREACHABLE!",
+        ["(unclosed"],
+        [{"pattern": "x"}],
+        [{"task": 1}],
+        [42],
+    ]:
+        assert not CONF(
+            {"apiver": 4, "ansible": {"fail_fast": invalid}}
+        ).validate_fail_fast(), invalid
+
+
+def test_validate_schema(caplog):
+    """
+    The configuration is validated with the schema of lib.schema,
+    all the errors are reported
+    """
+    media = {
+        "az_storage_account_name": "pippo",
+        "az_container_name": "pippo",
+        "az_sas_token": "SECRET",
+        "hana_media": ["pippo"],
+    }
+    conf = {
+        "apiver": 4,
+        "provider": "pinocchio",
+        "ansible": dict(media, ssh_control_persist=True, output_tail=10),
+    }
+    assert CONF(conf).validate()
+    assert CONF(conf).validate_ansible_config(None)
+
+    conf["terraform"] = {"output_tail": "x", "command_timeout": 0}
+    conf["ansible"] = dict(media, ssh_control_persist=False, output_tail=0)
+    config = CONF(conf)
+    assert not config.validate()
+    assert not config.validate_ansible_config(None)
+    errors = [record.getMessage() for record in caplog.records]
+    assert "terraform:output_tail: must be an integer, got: 'x'" in errors
+    assert "terraform:command_timeout: must be positive, got: 0" in errors
+    assert "ansible:output_tail: must be >= 1, got: 0" in errors
+    assert any(error.startswith("ansible:ssh_control_persist:") for error in errors)
+
+
+def test_frozen_config():
+    """
+    A frozen configuration has its own copy of the data,
+    it cannot be replaced and the method results are cached
+    """
+    data = {
+        "apiver": 4,
+        "provider": "pinocchio",
+        "ansible": {"sequences": {"create": ["a.yaml", "b.yaml"]}},
+    }
+    config = get_config(data)
+    assert get_config(config) is config
+    assert config.validate()
+    assert [step["playbook"] for step in config.get_playbook_steps("create")] == [
+        "a.yaml",
+        "b.yaml",
+    ]
+
+    # Changes to the original data, or to a returned value, are not seen
+    data["ansible"]["sequences"]["create"].append("c.yaml")
+    config.get_playbook_steps("create").pop()
+    assert len(config.get_playbook_steps("create")) == 2
+
+    with pytest.raises(AttributeError):
+        config.conf = {}
+
+    # The data is read-only at any level, a deep copy of it is not
+    with pytest.raises(TypeError):
+        config.conf["provider"] = "geppetto"
+    with pytest.raises(TypeError):
+        config.conf["ansible"]["sequences"]["create"].append("c.yaml")
+    thawed = copy.deepcopy(config.conf)
+    thawed["ansible"]["sequences"]["create"].append("c.yaml")
+    assert type(thawed["ansible"]) is dict
+    assert len(config.get_playbook_steps("create")) == 2
+
+
+def test_get_config_not_frozen():
+    """
+    get_config does not freeze a CONF given by the caller, it returns a new one
+    """
+    not_frozen = CONF({"apiver": 3, "provider": "pinocchio"})
+    config = get_config(not_frozen)
+
+    assert config is not not_frozen
+    assert config.frozen
+    assert not not_frozen.frozen
+    not_frozen.conf["provider"] = "geppetto"
+    assert config.conf["provider"] == "pinocchio"
+
+
+def test_frozen_config_memoized():
+    """
+    The methods of a frozen configuration reuse the cached result
+    for the same arguments, the not frozen ones always run
+    """
+    data = {"apiver": 3, "provider": "pinocchio"}
+    config = get_config(data)
+    assert config.get_timeouts("terraform") == (None, None)
+    assert config.memo[("get_timeouts", "terraform")] == (None, None)
+
+    config.memo[("get_timeouts", "terraform")] = (1, 2)
+    assert config.get_timeouts("terraform") == (1, 2)
+    assert config.get_timeouts("ansible") == (None, None)
+
+    not_frozen = CONF(data)
+    assert not_frozen.get_timeouts("terraform") == (None, None)
+    assert not_frozen.memo == {}
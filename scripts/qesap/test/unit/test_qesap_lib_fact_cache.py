@@ -0,0 +1,18 @@
+from lib.fact_cache import flush_after
+
+
+def test_flush_after():
+    """
+    Only the steps depending on a playbook that patches
+    or reboots the hosts flush the facts cache
+    """
+    steps = [
+        {"playbook": "registration.yaml -e reg_code=1234", "after": []},
+        {"playbook": "fully-patch-system.yaml", "after": [0]},
+        {"playbook": "pre-cluster.yaml", "after": [1]},
+        {"playbook": "sap-hana-storage.yaml", "after": [0]},
+        {"playbook": "sap-hana-install.yaml", "after": [2, 3]},
+    ]
+    assert flush_after(steps) == {2}
+    assert flush_after(steps, ["registration.yaml"]) == {1, 3}
+    assert flush_after(steps, []) == set()
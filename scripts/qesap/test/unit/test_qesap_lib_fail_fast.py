@@ -0,0 +1,44 @@
+from lib.fail_fast import FailFastDetector
+
+OUTPUT = [
+    "PLAY [hana] ****",
+    "TASK [Gathering Facts] ****",
+    "ok: [vmhana01]",
+    "TASK [sap_hana_install : Check free space] ****",
+    "fatal: [vmhana02]: FAILED! => {'msg': 'no space'}",
+    "TASK [Wait for the cluster] ****",
+    "fatal: [vmhana01]: UNREACHABLE! => {'msg': 'Connection timed out'}",
+]
+
+
+def detect(patterns):
+    detector = FailFastDetector(patterns)
+    for line in OUTPUT:
+        if detector(line):
+            return detector.matched
+    return None
+
+
+def test_fail_fast_pattern():
+    """
+    A pattern without task matches in any task
+    """
+    assert (
+        detect([{"pattern": "UNREACHABLE!", "task": None}])
+        == "[Wait for the cluster] fatal: [vmhana01]: UNREACHABLE! => {'msg': 'Connection timed out'}"
+    )
+    assert detect([{"pattern": "FAILED!", "task": None}]).startswith(
+        "[sap_hana_install : Check free space] fatal: [vmhana02]"
+    )
+    assert detect([{"pattern": "banana", "task": None}]) is None
+
+
+def test_fail_fast_task():
+    """
+    A pattern with task only matches within the tasks with a matching name
+    """
+    assert detect([{"pattern": "^fatal: ", "task": "Wait for"}]).startswith(
+        "[Wait for the cluster]"
+    )
+    assert detect([{"pattern": "FAILED!", "task": "Wait for"}]) is None
+    assert detect([{"pattern": "^fatal: ", "task": "^sap_hana_install : "}])
@@ -0,0 +1,83 @@
+import os
+
+from lib.file_writer import (
+    file_hash,
+    record_generated,
+    remove_generated,
+    write_if_changed,
+)
+
+
+def test_write_if_changed_new(tmpdir):
+    """
+    A new file is written
+    """
+    path = str(tmpdir / "new.txt")
+
+    assert write_if_changed(path, "banana\n")
+
+    with open(path, "r", encoding="utf-8") as file:
+        assert file.read() == "banana\n"
+    assert os.listdir(tmpdir) == ["new.txt"]
+
+
+def test_write_if_changed_same(tmpdir):
+    """
+    A file with the same content is not written and keeps its mtime
+    """
+    path = str(tmpdir / "same.txt")
+    with open(path, "w", encoding="utf-8") as file:
+        file.write("banana\n")
+    os.utime(path, (1000, 1000))
+
+    assert not write_if_changed(path, "banana\n")
+
+    assert os.path.getmtime(path) == 1000
+
+
+def test_write_if_changed_different(tmpdir):
+    """
+    A file with a different content is replaced, keeping its mode
+    """
+    path = str(tmpdir / "different.txt")
+    with open(path, "w", encoding="utf-8") as file:
+        file.write("banana\n")
+    os.chmod(path, 0o640)
+    old_hash = file_hash(path)
+
+    assert write_if_changed(path, "apple\n")
+
+    assert file_hash(path) != old_hash
+    with open(path, "r", encoding="utf-8") as file:
+        assert file.read() == "apple\n"
+    assert os.stat(path).st_mode & 0o777 == 0o640
+    assert os.listdir(tmpdir) == ["different.txt"]
+
+
+def test_file_hash_missing(tmpdir):
+    """
+    The hash of a missing file is None
+    """
+    assert file_hash(str(tmpdir / "missing.txt")) is None
+
+
+def test_remove_generated(tmpdir):
+    """
+    Only a recorded file, not modified since then, is removed
+    """
+    generated = str(tmpdir / "generated.txt")
+    by_hand = str(tmpdir / "by_hand.txt")
+    for path in (generated, by_hand):
+        write_if_changed(path, "banana\n")
+    record_generated(str(tmpdir), [generated])
+
+    assert not remove_generated(str(tmpdir), by_hand)
+    assert os.path.isfile(by_hand)
+    assert remove_generated(str(tmpdir), generated)
+    assert not os.path.exists(generated)
+
+    write_if_changed(generated, "banana\n")
+    record_generated(str(tmpdir), [generated])
+    write_if_changed(generated, "apple\n")
+    assert not remove_generated(str(tmpdir), generated)
+    assert os.path.isfile(generated)
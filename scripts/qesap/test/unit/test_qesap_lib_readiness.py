@@ -0,0 +1,147 @@
+import socket
+from unittest import mock
+
+import pytest
+
+import lib.readiness
+from lib.readiness import inventory_hosts, wait_hosts
+
+
+INVENTORY = """all:
+  vars:
+    ansible_user: cloudadmin
+  children:
+    hana:
+      vars:
+        ansible_port: 2222
+      hosts:
+        vmhana01:
+          ansible_host: 10.0.0.1
+        vmhana02:
+          ansible_host: 10.0.0.2
+          ansible_user: root
+    iscsi:
+      hosts:
+        vmiscsi01:
+  hosts: null
+"""
+
+
+@pytest.fixture
+def listening_port():
+    """A local TCP port that accept connections"""
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen()
+    yield server.getsockname()[1]
+    server.close()
+
+
+@pytest.fixture
+def inventory_file(tmpdir):
+    def _callback(content):
+        inventory = str(tmpdir / "inventory.yaml")
+        with open(inventory, "w", encoding="utf-8") as file:
+            file.write(content)
+        return inventory
+
+    return _callback
+
+
+def test_inventory_hosts(inventory_file):
+    """
+    All the hosts are found, with the variables inherited from their groups
+    """
+    hosts = inventory_hosts(inventory_file(INVENTORY))
+    assert sorted(hosts) == ["vmhana01", "vmhana02", "vmiscsi01"]
+    assert hosts["vmhana01"] == {
+        "ansible_user": "cloudadmin",
+        "ansible_port": 2222,
+        "ansible_host": "10.0.0.1",
+    }
+    assert hosts["vmhana02"]["ansible_user"] == "root"
+    assert hosts["vmiscsi01"] == {"ansible_user": "cloudadmin"}
+
+
+def local_inventory(port, hosts):
+    inventory = "all:\n  hosts:\n"
+    for host in hosts:
+        inventory += (
+            f"    {host}:\n      ansible_host: 127.0.0.1\n      ansible_port: {port}\n"
+        )
+    return inventory
+
+
+@mock.patch("lib.process_manager.async_subprocess_run", new_callable=mock.AsyncMock)
+def test_wait_hosts(async_subprocess_run, inventory_file, listening_port):
+    """
+    All the hosts are ready: TCP, ssh login and sudo are checked for each of them
+    """
+    async_subprocess_run.return_value = (0, [])
+    inventory = inventory_file(local_inventory(listening_port, ["h1", "h2"]))
+
+    reports = wait_hosts(inventory, "cloudadmin", timeout=5)
+
+    assert [r["host"] for r in reports] == ["h1", "h2"]
+    for report in reports:
+        assert report["ready"]
+        assert report["failed_at"] is None
+        assert report["tcp"] <= report["ssh"] <= report["sudo"]
+    cmds = [call.args[0] for call in async_subprocess_run.call_args_list]
+    assert len(cmds) == 4
+    assert all(f"-l cloudadmin -p {listening_port} 127.0.0.1" in cmd for cmd in cmds)
+    assert len([cmd for cmd in cmds if cmd.endswith(" sudo -n true")]) == 2
+
+
+@mock.patch("lib.process_manager.async_subprocess_run", new_callable=mock.AsyncMock)
+def test_wait_hosts_retry(
+    async_subprocess_run, inventory_file, listening_port, monkeypatch
+):
+    """
+    A failing probe is retried, until it pass
+    """
+    monkeypatch.setattr(lib.readiness, "BACKOFF_INITIAL", 0.01)
+    async_subprocess_run.side_effect = [(255, []), (255, []), (0, []), (0, [])]
+    inventory = inventory_file(local_inventory(listening_port, ["h1"]))
+
+    reports = wait_hosts(inventory, "cloudadmin", timeout=5)
+
+    assert reports[0]["ready"]
+    assert async_subprocess_run.call_count == 4
+
+
+@mock.patch("lib.process_manager.async_subprocess_run", new_callable=mock.AsyncMock)
+def test_wait_hosts_timeout(
+    async_subprocess_run, inventory_file, listening_port, monkeypatch
+):
+    """
+    A host not ready within the timeout is reported with the failed probe
+    """
+    monkeypatch.setattr(lib.readiness, "BACKOFF_INITIAL", 0.01)
+    async_subprocess_run.return_value = (1, [])
+    inventory = inventory_file(local_inventory(listening_port, ["h1"]))
+
+    reports = wait_hosts(inventory, "cloudadmin", timeout=0.2)
+
+    assert not reports[0]["ready"]
+    assert reports[0]["failed_at"] == "ssh"
+
+
+@mock.patch("lib.process_manager.async_subprocess_run", new_callable=mock.AsyncMock)
+def test_wait_hosts_global_deadline(
+    async_subprocess_run, inventory_file, listening_port, monkeypatch
+):
+    """
+    Each probe attempt is limited to the time left before the global deadline
+    and no attempt starts after it
+    """
+    monkeypatch.setattr(lib.readiness, "BACKOFF_INITIAL", 0.01)
+    async_subprocess_run.return_value = (1, [])
+    inventory = inventory_file(local_inventory(listening_port, ["h1"]))
+
+    reports = wait_hosts(inventory, "cloudadmin", timeout=0.2)
+
+    assert not reports[0]["ready"]
+    timeouts = [call.kwargs["timeout"] for call in async_subprocess_run.call_args_list]
+    assert timeouts
+    assert all(0 < timeout <= 0.2 for timeout in timeouts)
@@ -0,0 +1,176 @@
+from lib.schema import format_path, validate_config, validate_file
+from qesap import main
+
+VALID = """---
+apiver: 4
+provider: pinocchio
+terraform:
+  tfvars_format: json
+  variables:
+    region: eu1
+ansible:
+  az_storage_account_name: SOMEONE
+  az_container_name: SOMETHING
+  az_sas_token: SECRET
+  hana_media:
+    - SAPCAR_EXE
+  hana_vars:
+    sap_hana_install_software_directory: /hana/shared/install
+    sap_hana_install_master_password: 'DoNotUseThisPassw0rd'
+    sap_hana_install_sid: 'UT0'
+    sap_hana_install_instance_number: '00'
+    sap_domain: "qe-test.example.com"
+    primary_site: 'goofy'
+    secondary_site: 'miky'
+  fail_fast:
+    - UNREACHABLE!
+    - task: Wait for
+  execution_profiles:
+    fast:
+      forks: 50
+  sequences:
+    create:
+      - registration.yaml
+      - playbook: cluster.yaml
+        after: registration
+        profile: fast
+"""
+
+INVALID = """---
+apiver: 4
+provider: pinocchio
+terraform:
+  tfvars_format: yaml
+  command_timeout: -1
+  parallel_policy:
+    min: 20
+    max: 10
+ansible:
+  az_storage_account_name: SOMEONE
+  hana_media:
+    - https://somewhere/SAPCAR_EXE
+  hana_vars:
+    sap_hana_install_sid: 'TOOLONG'
+  verbosity: 9
+  fail_fast:
+    - "[unbalanced"
+  sequences:
+    create:
+      - registration.yaml
+      - playbook: cluster.yaml
+        after: banana
+        profile: slow
+        serial: 2
+"""
+
+
+def write(tmpdir, name, content):
+    path = str(tmpdir / name)
+    with open(path, "w", encoding="utf-8") as file:
+        file.write(content)
+    return path
+
+
+def test_schema_valid(tmpdir):
+    """
+    A valid configuration has no errors
+    """
+    assert validate_file(write(tmpdir, "valid.yaml", VALID)) == []
+
+
+def test_schema_all_errors(tmpdir):
+    """
+    All the errors are reported, each with its path and line
+    """
+    errors = validate_file(write(tmpdir, "invalid.yaml", INVALID))
+
+    found = {(format_path(error.path), error.line) for error in errors}
+    assert found == {
+        ("terraform:tfvars_format", 5),
+        ("terraform:command_timeout", 6),
+        ("terraform:parallel_policy", 7),
+        ("ansible", 10),
+        ("ansible:hana_media[0]", 13),
+        ("ansible:hana_vars", 14),
+        ("ansible:hana_vars:sap_hana_install_sid", 15),
+        ("ansible:verbosity", 16),
+        ("ansible:fail_fast[0]", 18),
+        ("ansible:sequences:create[1]:after", 23),
+        ("ansible:sequences:create[1]:profile", 24),
+        ("ansible:sequences:create[1]:serial", 25),
+    }
+    messages = [error.message for error in errors]
+    assert "missing mandatory 'az_container_name'" in messages
+    assert "at least one of az_sas_token, az_key_name is mandatory" in messages
+    assert "min is bigger than max" in messages
+    assert "'banana' does not refer to one previous step" in messages
+
+
+def test_schema_apiver():
+    """
+    The apiver is mandatory and the old ones are not supported
+    for the ansible section
+    """
+    assert [error.message for error in validate_config({"provider": "x"})] == [
+        "missing or invalid 'apiver'"
+    ]
+    assert [
+        error.message
+        for error in validate_config({"apiver": 2, "provider": "x", "ansible": {}})
+    ] == ["apiver 2 is no longer supported"]
+    assert validate_config({"apiver": 2, "provider": "x"}) == []
+    assert validate_config({"apiver": 3, "provider": "x"}) == []
+
+
+def test_schema_apiver3_sequences():
+    """
+    apiver 3 has the playbooks in ansible:create and ansible:destroy
+    """
+    ansible = {
+        "az_storage_account_name": "a",
+        "az_container_name": "b",
+        "az_key_name": "c",
+        "hana_media": ["d"],
+        "create": ["x.yaml", {"playbook": "y.yaml", "after": "z"}],
+    }
+    errors = validate_config({"apiver": 3, "provider": "x", "ansible": ansible})
+
+    assert [(error.path, error.line) for error in errors] == [
+        (("ansible", "create", 1, "after"), None)
+    ]
+
+
+def test_schema_invalid_yaml(tmpdir):
+    """
+    A file that is not valid YAML has one error with the line
+    """
+    errors = validate_file(write(tmpdir, "broken.yaml", "apiver: 4\nprovider: [\n"))
+
+    assert len(errors) == 1
+    assert errors[0].message.startswith("invalid YAML")
+    assert errors[0].line == 3
+
+
+def test_validate_subcommand(tmpdir, capsys):
+    """
+    'qesap.py validate' validates many files and prints all the errors,
+    without the global -c and -b
+    """
+    paths = [
+        write(tmpdir, "valid1.yaml", VALID),
+        write(tmpdir, "invalid.yaml", INVALID),
+        write(tmpdir, "valid2.yaml", VALID),
+    ]
+    args = ["validate", "--max-concurrent", "2"] + paths
+
+    assert main(args) != 0
+
+    output = capsys.readouterr().out.splitlines()
+    assert len(output) == len(validate_file(paths[1]))
+    assert all(line.startswith(paths[1] + ":") for line in output)
+    assert (
+        f"{paths[1]}:5: terraform:tfvars_format: must be one of ['hcl', 'json'], got: 'yaml'"
+        in output
+    )
+
+    assert main(["validate", paths[0], paths[2]]) == 0
@@ -0,0 +1,281 @@
+import os
+
+from lib.terraform_cache import (
+    apply_fingerprint,
+    apply_is_cached,
+    clear_apply_fingerprint,
+    save_apply_fingerprint,
+    init_fingerprint,
+    init_is_cached,
+    save_init_fingerprint,
+    module_dirs,
+    plugin_cache_entries,
+    prune_plugin_cache,
+    touch_plugin_cache,
+)
+
+
+def write_file(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as file:
+        file.write(content)
+
+
+def test_init_fingerprint_no_bin(tmpdir):
+    """
+    No fingerprint if the terraform binary does not exist
+    """
+    assert init_fingerprint(str(tmpdir), "this_terraform_does_not_exist") is None
+
+
+def test_init_fingerprint_lock(tmpdir):
+    """
+    The fingerprint change when the .terraform.lock.hcl change
+    """
+    write_file(str(tmpdir / ".terraform.lock.hcl"), 'provider "a" { version = "1" }')
+    before = init_fingerprint(str(tmpdir), "echo")
+    write_file(str(tmpdir / ".terraform.lock.hcl"), 'provider "a" { version = "2" }')
+    assert init_fingerprint(str(tmpdir), "echo") != before
+
+
+def test_init_fingerprint_module_source(tmpdir):
+    """
+    The fingerprint change when a module source change,
+    also in a module in a sub-folder,
+    but not when some other resource setting change
+    """
+    main_tf = str(tmpdir / "modules" / "vm" / "main.tf")
+    write_file(main_tf, 'module "a" {\n  source = "./a"\n}\nlocals {\n  b = 1\n}\n')
+    before = init_fingerprint(str(tmpdir), "echo")
+
+    write_file(main_tf, 'module "a" {\n  source = "./a"\n}\nlocals {\n  b = 2\n}\n')
+    assert init_fingerprint(str(tmpdir), "echo") == before
+
+    write_file(main_tf, 'module "a" {\n  source = "./c"\n}\nlocals {\n  b = 2\n}\n')
+    assert init_fingerprint(str(tmpdir), "echo") != before
+
+
+def test_init_fingerprint_skip_data_dir(tmpdir):
+    """
+    The .tf files downloaded by terraform init in .terraform are not considered
+    """
+    before = init_fingerprint(str(tmpdir), "echo")
+    write_file(str(tmpdir / ".terraform" / "modules" / "x" / "main.tf"), 'source = "a"')
+    assert init_fingerprint(str(tmpdir), "echo") == before
+
+
+def test_init_is_cached(tmpdir):
+    """
+    init is cached only after the fingerprint is saved
+    and only until the inputs change
+    """
+    assert not init_is_cached(str(tmpdir), "echo")
+    save_init_fingerprint(str(tmpdir), "echo")
+    assert init_is_cached(str(tmpdir), "echo")
+    assert os.path.isfile(str(tmpdir / ".terraform" / "qesap.init.sha256"))
+    write_file(str(tmpdir / "version.tf"), "terraform {}")
+    assert not init_is_cached(str(tmpdir), "echo")
+
+
+def create_cache_entry(cache_dir, address, version, size, last_used):
+    path = os.path.join(cache_dir, *address.split("/"), version)
+    write_file(os.path.join(path, "linux_amd64", "terraform-provider"), "x" * size)
+    os.utime(path, (last_used, last_used))
+    return path
+
+
+def test_plugin_cache_entries(tmpdir):
+    """
+    Each provider version in the cache is one entry
+    """
+    cache_dir = str(tmpdir / "cache")
+    create_cache_entry(
+        cache_dir, "registry.terraform.io/hashicorp/null", "3.1.0", 10, 1
+    )
+    create_cache_entry(
+        cache_dir, "registry.terraform.io/hashicorp/null", "3.2.0", 20, 2
+    )
+    create_cache_entry(cache_dir, "registry.terraform.io/hashicorp/aws", "5.0.0", 30, 3)
+
+    entries = plugin_cache_entries(cache_dir)
+
+    assert sorted((os.path.basename(e["path"]), e["size"]) for e in entries) == [
+        ("3.1.0", 10),
+        ("3.2.0", 20),
+        ("5.0.0", 30),
+    ]
+
+
+def test_prune_plugin_cache_lru(tmpdir):
+    """
+    Least recently used entries are removed first,
+    until the cache size is within the limit
+    """
+    cache_dir = str(tmpdir / "cache")
+    old = create_cache_entry(cache_dir, "registry.terraform.io/h/null", "1.0.0", 100, 1)
+    mid = create_cache_entry(cache_dir, "registry.terraform.io/h/null", "2.0.0", 100, 2)
+    new = create_cache_entry(cache_dir, "registry.terraform.io/h/aws", "1.0.0", 100, 3)
+
+    removed = prune_plugin_cache(cache_dir, 150)
+
+    assert removed == [old, mid]
+    assert not os.path.exists(old)
+    assert not os.path.exists(mid)
+    assert os.path.isdir(new)
+
+
+def test_prune_plugin_cache_dryrun(tmpdir):
+    """
+    In dryrun nothing is removed
+    """
+    cache_dir = str(tmpdir / "cache")
+    entry = create_cache_entry(
+        cache_dir, "registry.terraform.io/h/null", "1.0.0", 100, 1
+    )
+
+    assert prune_plugin_cache(cache_dir, 0, dryrun=True) == [entry]
+    assert os.path.isdir(entry)
+
+
+def test_touch_plugin_cache(tmpdir):
+    """
+    The providers in the .terraform.lock.hcl are marked as recently used
+    """
+    cache_dir = str(tmpdir / "cache")
+    used = create_cache_entry(cache_dir, "registry.terraform.io/h/null", "1.0.0", 1, 1)
+    unused = create_cache_entry(
+        cache_dir, "registry.terraform.io/h/null", "2.0.0", 1, 1
+    )
+    write_file(
+        str(tmpdir / "azure" / ".terraform.lock.hcl"),
+        'provider "registry.terraform.io/h/null" {\n  version     = "1.0.0"\n}\n',
+    )
+
+    touch_plugin_cache(cache_dir, str(tmpdir / "azure"))
+
+    assert os.stat(used).st_mtime > 1
+    assert os.stat(unused).st_mtime == 1
+
+
+def test_init_not_cached_broken_provider(tmpdir):
+    """
+    init is not cached if one of the installed providers
+    has been removed from the plugin cache
+    """
+    cache_entry = str(tmpdir / "cache" / "null")
+    os.makedirs(cache_entry)
+    providers = str(tmpdir / ".terraform" / "providers" / "h")
+    os.makedirs(providers)
+    os.symlink(cache_entry, os.path.join(providers, "null"))
+    save_init_fingerprint(str(tmpdir), "echo")
+    assert init_is_cached(str(tmpdir), "echo")
+
+    os.rmdir(cache_entry)
+    assert not init_is_cached(str(tmpdir), "echo")
+
+
+def test_apply_fingerprint(tmpdir):
+    """
+    The apply fingerprint change when the terraform.tfvars,
+    a template or the local state change, or for a different workspace,
+    but not for other files like the generated inventory
+    """
+    write_file(str(tmpdir / "main.tf"), 'resource "null_resource" "a" {}\n')
+    write_file(str(tmpdir / "terraform.tfvars"), 'az_region = "westeurope"\n')
+    before = apply_fingerprint(str(tmpdir), "default")
+
+    write_file(str(tmpdir / "inventory.yaml"), "all:\n")
+    write_file(str(tmpdir / ".terraform" / "terraform.tfstate"), "{}")
+    assert apply_fingerprint(str(tmpdir), "default") == before
+
+    assert apply_fingerprint(str(tmpdir), "paperino") != before
+
+    write_file(
+        str(tmpdir / "terraform.tfstate.d" / "paperino" / "terraform.tfstate"), "{}"
+    )
+    assert apply_fingerprint(str(tmpdir), "default") == before
+
+    write_file(str(tmpdir / "terraform.tfstate"), "{}")
+    assert apply_fingerprint(str(tmpdir), "default") != before
+
+    before = apply_fingerprint(str(tmpdir), "default")
+    write_file(str(tmpdir / "inventory.tmpl"), "all:\n")
+    assert apply_fingerprint(str(tmpdir), "default") != before
+
+    before = apply_fingerprint(str(tmpdir), "default")
+    write_file(str(tmpdir / "terraform.tfvars"), 'az_region = "northeurope"\n')
+    assert apply_fingerprint(str(tmpdir), "default") != before
+
+
+def test_module_dirs(tmpdir):
+    """
+    The local modules outside of the project folder are found, also
+    the ones used by other modules and the ones listed in modules.json
+    """
+    provider = tmpdir / "azure"
+    write_file(
+        str(provider / "main.tf"),
+        'module "common" {\n  source = "../generic_modules/common"\n}\n'
+        'module "vm" {\n  source = "./modules/vm"\n}\n',
+    )
+    write_file(
+        str(provider / "modules" / "vm" / "main.tf"),
+        'module "os" {\n  source = "../../../generic_modules/os"\n}\n',
+    )
+    write_file(str(tmpdir / "generic_modules" / "common" / "variables.tf"), "")
+    write_file(str(tmpdir / "generic_modules" / "os" / "main.tf"), "")
+    write_file(str(tmpdir / "shared" / "main.tf"), "")
+
+    assert module_dirs(str(provider)) == [
+        os.path.realpath(str(tmpdir / "generic_modules" / "common")),
+        os.path.realpath(str(tmpdir / "generic_modules" / "os")),
+    ]
+
+    write_file(
+        str(provider / ".terraform" / "modules" / "modules.json"),
+        '{"Modules": [{"Key": "", "Dir": "."}, {"Key": "s", "Dir": "../shared"}]}',
+    )
+    assert os.path.realpath(str(tmpdir / "shared")) in module_dirs(str(provider))
+
+
+def test_apply_fingerprint_outside_inputs(tmpdir, monkeypatch):
+    """
+    The apply fingerprint change when a local module outside of
+    the project folder, a TF_VAR_ variable or the terraform binary change
+    """
+    provider = tmpdir / "azure"
+    common = tmpdir / "generic_modules" / "common_variables" / "variables.tf"
+    write_file(
+        str(provider / "main.tf"),
+        'module "common_variables" {\n'
+        '  source = "../generic_modules/common_variables"\n}\n',
+    )
+    write_file(str(common), 'variable "a" {\n  default = 1\n}\n')
+    before = apply_fingerprint(str(provider), "default")
+
+    write_file(str(common), 'variable "a" {\n  default = 2\n}\n')
+    assert apply_fingerprint(str(provider), "default") != before
+
+    before = apply_fingerprint(str(provider), "default")
+    monkeypatch.setenv("NOT_A_TF_VAR", "pluto")
+    assert apply_fingerprint(str(provider), "default") == before
+    monkeypatch.setenv("TF_VAR_region", "westeurope")
+    assert apply_fingerprint(str(provider), "default") != before
+
+    before = apply_fingerprint(str(provider), "default", terraform_bin="echo")
+    assert apply_fingerprint(str(provider), "default", terraform_bin="true") != before
+
+
+def test_apply_is_cached(tmpdir):
+    """
+    apply is cached per workspace, until the fingerprint is cleared
+    """
+    write_file(str(tmpdir / "main.tf"), 'resource "null_resource" "a" {}\n')
+    assert not apply_is_cached(str(tmpdir), "default")
+
+    save_apply_fingerprint(str(tmpdir), "default")
+    assert apply_is_cached(str(tmpdir), "default")
+    assert not apply_is_cached(str(tmpdir), "paperino")
+
+    clear_apply_fingerprint(str(tmpdir), "default")
+    assert not apply_is_cached(str(tmpdir), "default")
@@ -0,0 +1,87 @@
+import json
+
+from lib.terraform_json import TerraformJsonProgress
+
+
+def event(event_type, **kwargs):
+    data = {"@level": "info", "@message": f"a {event_type}", "type": event_type}
+    data.update(kwargs)
+    return json.dumps(data)
+
+
+def hook(addr, action, elapsed=None):
+    data = {"resource": {"addr": addr}, "action": action}
+    if elapsed is not None:
+        data["elapsed_seconds"] = elapsed
+    return data
+
+
+def test_progress():
+    """
+    The number of planned changes come from the plan change_summary,
+    the completed ones from the apply_complete events
+    """
+    progress = TerraformJsonProgress()
+    progress(event("version", terraform="1.5.7"))
+    progress(
+        event(
+            "change_summary",
+            changes={"add": 2, "change": 1, "remove": 0, "operation": "plan"},
+        )
+    )
+    progress(event("apply_start", hook=hook("azurerm_resource_group.a", "create")))
+    progress(
+        event("apply_complete", hook=hook("azurerm_resource_group.a", "create", 3))
+    )
+    progress(
+        event(
+            "change_summary",
+            changes={"add": 1, "change": 0, "remove": 0, "operation": "apply"},
+        )
+    )
+
+    assert progress.planned == 3
+    assert progress.completed == 1
+
+
+def test_not_json():
+    """
+    Lines that are not JSON, or not a JSON object, are ignored
+    """
+    progress = TerraformJsonProgress()
+    progress("Terraform has been successfully initialized!")
+    progress("[1, 2]")
+    progress("")
+    assert progress.sorted_timings() == []
+
+
+def test_timings(tmpdir):
+    """
+    The timing report has the slowest resource first,
+    with also the errored ones
+    """
+    progress = TerraformJsonProgress()
+    for addr, elapsed in [("vm.a", 10), ("disk.b", 200), ("nic.c", 5)]:
+        progress(event("apply_start", hook=hook(addr, "create")))
+        progress(event("apply_complete", hook=hook(addr, "create", elapsed)))
+    progress(event("apply_start", hook=hook("vm.d", "create")))
+    progress(event("apply_errored", hook=hook("vm.d", "create", 50)))
+    progress(
+        event(
+            "diagnostic",
+            diagnostic={"severity": "error", "summary": "Quota", "address": "vm.d"},
+        )
+    )
+
+    timings = progress.sorted_timings()
+    assert [t["resource"] for t in timings] == ["disk.b", "vm.d", "vm.a", "nic.c"]
+    assert timings[1]["status"] == "errored"
+    assert progress.completed == 3
+
+    report = str(tmpdir / "timing.txt")
+    progress.write_timing_report(report)
+    with open(report, "r", encoding="utf-8") as file:
+        lines = file.read().splitlines()
+    assert lines[0].split() == ["RESOURCE", "ACTION", "STATUS", "ELAPSED"]
+    assert lines[1].split() == ["disk.b", "create", "complete", "200s"]
+    assert len(lines) == 5
@@ -0,0 +1,87 @@
+import json
+
+from lib.config import DEFAULT_PARALLEL_POLICY
+from lib.terraform_parallel import ThrottleDetector, auto_parallelism, count_changes
+
+
+def plan_json(changes):
+    resources = []
+    for provider, actions, count in changes:
+        for index in range(count):
+            resources.append(
+                {
+                    "address": f"{provider}_thing.t{index}",
+                    "provider_name": f"registry.terraform.io/hashicorp/{provider}",
+                    "change": {"actions": actions},
+                }
+            )
+    return json.dumps({"format_version": "1.2", "resource_changes": resources})
+
+
+def test_count_changes():
+    """
+    Only resources to create, update, replace or delete are counted
+    """
+    plan = plan_json(
+        [
+            ("azurerm", ["create"], 3),
+            ("azurerm", ["no-op"], 4),
+            ("azurerm", ["delete", "create"], 1),
+            ("null", ["update"], 2),
+            ("local", ["read"], 1),
+        ]
+    )
+    assert count_changes(plan) == {"azurerm": 4, "null": 2}
+
+
+def test_count_changes_invalid():
+    assert count_changes("this is not a plan") is None
+
+
+def test_auto_parallelism():
+    """
+    The parallelism grows with the number of changes,
+    between min and max, and limited by provider_max
+    """
+    policy = dict(DEFAULT_PARALLEL_POLICY)
+    policy.update({"min": 4, "max": 30, "resources_per_worker": 2})
+    assert auto_parallelism({}, policy) == 4
+    assert auto_parallelism({"azurerm": 3}, policy) == 4
+    assert auto_parallelism({"azurerm": 25}, policy) == 13
+    assert auto_parallelism({"azurerm": 500}, policy) == 30
+
+    policy["provider_max"] = {"azurerm": 8}
+    assert auto_parallelism({"azurerm": 25}, policy) == 8
+    assert auto_parallelism({"aws": 25}, policy) == 13
+
+
+def test_throttle_detector():
+    detector = ThrottleDetector()
+    detector("azurerm_linux_virtual_machine.vm: Creating...")
+    assert not detector.throttled
+    detector('Status=429 Code="TooManyRequests" Message="slow down"')
+    assert detector.throttled
+
+    for line in [
+        "StatusCode=429",
+        "api error: StatusCode: 429, RequestID: 1234",
+        "received HTTP/1.1 429 from the server",
+        "googleapi: Error 429: Quota exceeded",
+    ]:
+        detector = ThrottleDetector()
+        detector(line)
+        assert detector.throttled, line
+
+
+def test_throttle_detector_other_429():
+    """
+    A 429 that is not an HTTP status code is not throttling
+    """
+    detector = ThrottleDetector()
+    for line in [
+        "  + disk_size_gb = 429",
+        "azurerm_disk.data: Creation complete after 3s [id=/subscriptions/x/disks/429]",
+        "Error: Invalid reference on main.tf line 429:",
+    ]:
+        detector(line)
+    assert not detector.throttled
@@ -0,0 +1,109 @@
+from lib.tfvars import index_assignments, merge
+
+TEMPLATE = [
+    "# hana_count = 9\n",
+    "hana_count = 2\n",
+    "hana_count_max = 4\n",
+    "tags = {\n",
+    '  owner = "me"\n',
+    '  hana_count = "not a variable"\n',
+    "}\n",
+    "zones = [\n",
+    '  "1", # first\n',
+    '  "2",\n',
+    "]\n",
+    "/* os_image = old\n",
+    "   still a comment */\n",
+    "script = <<EOT\n",
+    "hana_count = 3 ]\n",
+    "EOT\n",
+    'name = "a ] # b"\n',
+]
+
+
+def test_index_assignments():
+    """
+    Only the top level assignments are indexed, with all their lines
+    """
+    assert index_assignments(TEMPLATE) == {
+        "hana_count": [(1, 1)],
+        "hana_count_max": [(2, 2)],
+        "tags": [(3, 6)],
+        "zones": [(7, 10)],
+        "script": [(13, 15)],
+        "name": [(16, 16)],
+    }
+
+
+def test_merge_exact_name():
+    """
+    A variable does not replace the ones with the same prefix,
+    the commented out ones or the keys of a map
+    """
+    content = merge(TEMPLATE, {"hana_count": "hana_count = 5"})
+
+    assert content == TEMPLATE[0:1] + ["hana_count = 5\n"] + TEMPLATE[2:]
+
+
+def test_merge_multiline():
+    """
+    The whole multi-line value is replaced
+    """
+    content = merge(
+        TEMPLATE,
+        {
+            "tags": 'tags = {\n\towner = "you"\n}',
+            "zones": 'zones = ["3"]',
+            "script": 'script = "true"',
+        },
+    )
+
+    assert content == (
+        TEMPLATE[0:3]
+        + ['tags = {\n\towner = "you"\n}\n', 'zones = ["3"]\n']
+        + TEMPLATE[11:13]
+        + ['script = "true"\n', TEMPLATE[16]]
+    )
+
+
+def test_merge_append():
+    """
+    The variables not in the template are appended in the same order
+    """
+    content = merge(["a = 1\n"], {"c": "c = 3", "a": "a = 0", "b": "b = 2"})
+
+    assert content == ["a = 0\n", "c = 3\n", "b = 2\n"]
+
+
+def test_merge_duplicated():
+    """
+    All the assignments of the same variable are replaced
+    """
+    content = merge(["a = 1\n", "b = 1\n", "a = [\n", "2]\n"], {"a": "a = 0"})
+
+    assert content == ["a = 0\n", "b = 1\n", "a = 0\n"]
+
+
+def test_merge_big_template():
+    """
+    A template with thousands of lines and hundreds of variables
+    """
+    template = []
+    for number in range(1000):
+        template.extend(
+            [
+                f"# variable {number}\n",
+                f"var_{number} = {number}\n",
+                f"var_{number}_list = [\n",
+                f'  "{number}",\n',
+                "]\n",
+            ]
+        )
+    entries = {f"var_{number}": f"var_{number} = 0" for number in range(0, 1000, 2)}
+
+    content = merge(template, entries)
+
+    assert len(content) == 5000
+    assert content[1] == "var_0 = 0\n"
+    assert content[6] == "var_1 = 1\n"
+    assert content[7] == "var_1_list = [\n"
@@ -1,20 +1,33 @@
 from unittest import mock
+import asyncio
+import json
 import os
 import logging
+import time
 import pytest
 
 from qesap import main
+from lib.process_manager import TIMEOUT_RC, INTERRUPTED_RC
 
 log = logging.getLogger(__name__)
 
 
-terraform_cmds = [("init"), ("plan -out=plan.zip"), ("apply -auto-approve plan.zip")]
+# Flags, -no-color included, are before the plan file
+terraform_cmds = [
+    ("init -no-color"),
+    ("plan -no-color -out=plan.zip"),
+    ("apply -no-color -auto-approve plan.zip"),
+]
 
 
 @mock.patch("lib.process_manager.subprocess_run")
 @pytest.mark.parametrize("terraform_cmd_args", terraform_cmds)
 def test_terraform_call_terraform(
-    subprocess_run, terraform_cmd_args, args_helper, config_yaml_sample
+    subprocess_run,
+    terraform_cmd_args,
+    args_helper,
+    config_yaml_sample,
+    mock_call_terraform,
 ):
     """
     Command terraform calls all these 3:
@@ -35,14 +48,16 @@ def test_terraform_call_terraform(
     assert main(args) == 0
     subprocess_run.assert_called()
     subprocess_run.assert_has_calls(
-        [mock.call(f"terraform -chdir={terraform_dir} {terraform_cmd_args} -no-color")]
+        [mock_call_terraform(f"terraform -chdir={terraform_dir} {terraform_cmd_args}")]
     )
 
 
 @mock.patch(
     "lib.process_manager.subprocess_run", side_effect=[(0, []), (1, []), (1, [])]
 )
-def test_terraform_stop_at_failure(subprocess_run, args_helper, config_yaml_sample):
+def test_terraform_stop_at_failure(
+    subprocess_run, args_helper, config_yaml_sample, mock_call_terraform
+):
     """
     Command stop at first subprocess(terraform) with not zero exit code.
     Simulate a failure at 'terraform plan'
@@ -55,11 +70,13 @@ def test_terraform_stop_at_failure(subprocess_run, args_helper, config_yaml_samp
 
     calls = []
     terraform_cmd_common = ["terraform", f"-chdir={terraform_dir}"]
-    for terraform_cmd_args in [["init"], ["plan", "-out=plan.zip"]]:
+    for terraform_cmd_args in [
+        ["init", "-no-color"],
+        ["plan", "-no-color", "-out=plan.zip"],
+    ]:
         terraform_cmd = terraform_cmd_common.copy()
         terraform_cmd += terraform_cmd_args
-        terraform_cmd.append("-no-color")
-        calls.append(mock.call(" ".join(terraform_cmd)))
+        calls.append(mock_call_terraform(" ".join(terraform_cmd)))
 
     assert main(args) == 1
 
@@ -76,7 +93,8 @@ def test_terraform_logs(
     subprocess_run, terraform_cmd_args, args_helper, config_yaml_sample, tmpdir
 ):
     """
-    Command terraform create one log file for each command:
+    Command terraform ask to stream the output of each command
+    to a different log file:
      - terraform.{cmd}.log.txt
     """
     provider = "mangiafuoco"
@@ -92,36 +110,68 @@ def test_terraform_logs(
     assert main(args) == 0
 
     cmd = terraform_cmd_args.split()[0]
-    assert os.path.isfile(f"terraform.{cmd}.log.txt")
+    log_files = [kwargs["log_file"] for _, kwargs in subprocess_run.call_args_list]
+    assert f"terraform.{cmd}.log.txt" in log_files
 
 
-@mock.patch("lib.process_manager.subprocess_run")
 @pytest.mark.parametrize("terraform_cmd_args", terraform_cmds)
-def test_terraform_logs_content(
-    subprocess_run, terraform_cmd_args, args_helper, config_yaml_sample, tmpdir
-):
+def test_terraform_logs_content(terraform_cmd_args, args_helper, tmpdir, monkeypatch):
     """
-    Each terraform log file contains terraform stdout
+    Each terraform log file contains terraform stdout.
+    Use 'echo' in place of the terraform binary,
+    so that the command line itself is the output to find in the log file.
     """
+    monkeypatch.chdir(tmpdir)
     provider = "mangiafuoco"
-    conf = config_yaml_sample(provider)
-
-    args, *_ = args_helper(provider, conf)
+    conf = """---
+apiver: 3
+provider: mangiafuoco
+terraform:
+  bin: echo
+  variables:
+    az_region: "westeurope"
+    """
+    args, terraform_dir, *_ = args_helper(provider, conf)
     args.append("terraform")
-    terraform_output = ["This is the terraform output", "Two lines of that"]
-    subprocess_run.return_value = (0, terraform_output)
 
     assert main(args) == 0
 
     cmd = terraform_cmd_args.split()[0]
     with open(f"terraform.{cmd}.log.txt", "r", encoding="utf-8") as log_file:
         log_lines = log_file.read().splitlines()
-    assert terraform_output == log_lines
+    assert log_lines == [f"-chdir={terraform_dir} {terraform_cmd_args}"]
+
+
+@mock.patch("lib.process_manager.subprocess_run")
+def test_terraform_output_tail(subprocess_run, args_helper):
+    """
+    terraform::output_tail in the conf.yaml configure
+    how many output lines are kept in memory for each command
+    """
+    provider = "mangiafuoco"
+    conf = """---
+apiver: 3
+provider: mangiafuoco
+terraform:
+  output_tail: 42
+  variables:
+    az_region: "westeurope"
+    """
+    args, *_ = args_helper(provider, conf)
+    args.append("terraform")
+    subprocess_run.return_value = (0, [])
+
+    assert main(args) == 0
+
+    for _, kwargs in subprocess_run.call_args_list:
+        assert kwargs["tail"] == 42
 
 
 @mock.patch("lib.process_manager.subprocess_run")
 @pytest.mark.parametrize("terraform_cmd_args", terraform_cmds)
-def test_terraform_call_custom_bin(subprocess_run, terraform_cmd_args, args_helper):
+def test_terraform_call_custom_bin(
+    subprocess_run, terraform_cmd_args, args_helper, mock_call_terraform
+):
     """
     Check that terraform commandslike:
      - 'terraform init'
@@ -147,8 +197,8 @@ terraform:
 
     calls = []
     calls.append(
-        mock.call(
-            f"one_special_terraform_exe -chdir={terraform_dir} {terraform_cmd_args} -no-color"
+        mock_call_terraform(
+            f"one_special_terraform_exe -chdir={terraform_dir} {terraform_cmd_args}"
         )
     )
 
@@ -207,7 +257,7 @@ def test_terraform_dryrun(subprocess_run, args_helper, config_yaml_sample):
 
 @mock.patch("lib.process_manager.subprocess_run")
 def test_terraform_call_terraform_destroy(
-    subprocess_run, args_helper, config_yaml_sample
+    subprocess_run, args_helper, config_yaml_sample, mock_call_terraform
 ):
     """
     Command terraform with -d calls 'terraform destroy'
@@ -222,7 +272,9 @@ def test_terraform_call_terraform_destroy(
     subprocess_run.return_value = (0, [])
     calls = []
     calls.append(
-        mock.call(f"terraform -chdir={terraform_dir} destroy -auto-approve -no-color")
+        mock_call_terraform(
+            f"terraform -chdir={terraform_dir} destroy -no-color -auto-approve"
+        )
     )
 
     assert main(args) == 0
@@ -232,7 +284,7 @@ def test_terraform_call_terraform_destroy(
 
 @mock.patch("lib.process_manager.subprocess_run")
 def test_terraform_call_terraform_workspace(
-    subprocess_run, args_helper, config_yaml_sample
+    subprocess_run, args_helper, config_yaml_sample, mock_call_terraform
 ):
     """
     Command terraform calls 'terraform workspace' if -w is used
@@ -248,7 +300,9 @@ def test_terraform_call_terraform_workspace(
 
     calls = []
     calls.append(
-        mock.call(f"terraform -chdir={terraform_dir} workspace new lucignolo -no-color")
+        mock_call_terraform(
+            f"terraform -chdir={terraform_dir} workspace new -no-color lucignolo"
+        )
     )
 
     subprocess_run.assert_has_calls(calls)
@@ -256,7 +310,7 @@ def test_terraform_call_terraform_workspace(
 
 @mock.patch("lib.process_manager.subprocess_run")
 def test_terraform_call_terraform_workspace_destroy(
-    subprocess_run, args_helper, config_yaml_sample
+    subprocess_run, args_helper, config_yaml_sample, mock_call_terraform
 ):
     """
     Command terraform calls 'terraform workspace' if -w is used
@@ -272,13 +326,13 @@ def test_terraform_call_terraform_workspace_destroy(
 
     calls = []
     calls.append(
-        mock.call(
-            f"terraform -chdir={terraform_dir} workspace select default -no-color"
+        mock_call_terraform(
+            f"terraform -chdir={terraform_dir} workspace select -no-color default"
         )
     )
     calls.append(
-        mock.call(
-            f"terraform -chdir={terraform_dir} workspace delete lucignolo -no-color"
+        mock_call_terraform(
+            f"terraform -chdir={terraform_dir} workspace delete -no-color lucignolo"
         )
     )
 
@@ -287,7 +341,7 @@ def test_terraform_call_terraform_workspace_destroy(
 
 @mock.patch("lib.process_manager.subprocess_run")
 def test_terraform_call_terraform_parallel(
-    subprocess_run, args_helper, config_yaml_sample
+    subprocess_run, args_helper, config_yaml_sample, mock_call_terraform
 ):
     """
     Command terraform calls 'terraform plan' and 'terraform apply' with -parallelism=n
@@ -303,14 +357,704 @@ def test_terraform_call_terraform_parallel(
 
     calls = []
     calls.append(
-        mock.call(
-            f"terraform -chdir={terraform_dir} plan -parallelism=5 -out=plan.zip -no-color"
+        mock_call_terraform(
+            f"terraform -chdir={terraform_dir} plan -no-color -parallelism=5 -out=plan.zip"
         )
     )
     calls.append(
-        mock.call(
-            f"terraform -chdir={terraform_dir} apply -parallelism=5 -auto-approve plan.zip -no-color"
+        mock_call_terraform(
+            f"terraform -chdir={terraform_dir} apply -no-color -parallelism=5 -auto-approve plan.zip"
         )
     )
 
     subprocess_run.assert_has_calls(calls)
+
+
+@mock.patch("lib.process_manager.subprocess_run")
+def test_terraform_command_timeout(subprocess_run, args_helper):
+    """
+    terraform::command_timeout is used as timeout for each terraform command.
+    A command killed for timeout stop the execution with an explicit error.
+    """
+    provider = "mangiafuoco"
+    conf = """---
+apiver: 3
+provider: mangiafuoco
+terraform:
+  command_timeout: 60
+  variables:
+    az_region: "westeurope"
+    """
+    args, *_ = args_helper(provider, conf)
+    args.append("terraform")
+    subprocess_run.side_effect = [(0, []), (TIMEOUT_RC, [])]
+
+    res = main(args)
+
+    assert res != 0
+    assert "command timeout of 60s expired" in res.msg
+    assert "plan" in res.msg
+    assert subprocess_run.call_count == 2
+    for _, kwargs in subprocess_run.call_args_list:
+        assert kwargs["timeout"] == 60
+
+
+@mock.patch("lib.process_manager.subprocess_run")
+def test_terraform_stage_timeout(subprocess_run, args_helper):
+    """
+    terraform::stage_timeout limits the time of all the terraform commands together.
+    """
+    provider = "mangiafuoco"
+    conf = """---
+apiver: 3
+provider: mangiafuoco
+terraform:
+  stage_timeout: 0.2
+  variables:
+    az_region: "westeurope"
+    """
+    args, *_ = args_helper(provider, conf)
+    args.append("terraform")
+
+    def slow_init(*_, **kwargs):
+        assert kwargs["timeout"] <= 0.2
+        time.sleep(0.3)
+        return (0, [])
+
+    subprocess_run.side_effect = slow_init
+
+    res = main(args)
+
+    assert res != 0
+    assert "stage timeout of 0.2s expired" in res.msg
+    subprocess_run.assert_called_once()
+
+
+@mock.patch("lib.process_manager.subprocess_run")
+def test_terraform_invalid_timeout(subprocess_run, args_helper):
+    """
+    Timeouts has to be positive numbers
+    """
+    provider = "mangiafuoco"
+    conf = """---
+apiver: 3
+provider: mangiafuoco
+terraform:
+  command_timeout: -1
+  variables:
+    az_region: "westeurope"
+    """
+    args, *_ = args_helper(provider, conf)
+    args.append("terraform")
+
+    assert main(args) != 0
+    subprocess_run.assert_not_called()
+
+
+@mock.patch("lib.process_manager.subprocess_run")
+def test_terraform_interrupted(subprocess_run, args_helper, config_yaml_sample):
+    """
+    A command interrupted by a signal stop the execution
+    """
+    provider = "mangiafuoco"
+    conf = config_yaml_sample(provider)
+    args, *_ = args_helper(provider, conf)
+    args.append("terraform")
+    subprocess_run.return_value = (INTERRUPTED_RC, [])
+
+    res = main(args)
+
+    assert res != 0
+    assert "Interrupted" in res.msg
+    subprocess_run.assert_called_once()
+
+
+def test_terraform_run_report(args_helper, tmpdir, monkeypatch):
+    """
+    qesap.py write a qesap.run.json report,
+    with timing and resource usage of each executed command.
+    Use 'echo' in place of the terraform binary.
+    """
+    provider = "mangiafuoco"
+    conf = """---
+apiver: 3
+provider: mangiafuoco
+terraform:
+  bin: echo
+  variables:
+    az_region: "westeurope"
+    """
+    args, *_ = args_helper(provider, conf)
+    args.append("terraform")
+    monkeypatch.chdir(tmpdir)
+
+    assert main(args) == 0
+
+    with open("qesap.run.json", "r", encoding="utf-8") as report_file:
+        report = json.load(report_file)
+    assert report["command"] == "terraform"
+    assert report["rc"] == 0
+    assert [step["log_file"] for step in report["steps"]] == [
+        "terraform.init.log.txt",
+        "terraform.plan.log.txt",
+        "terraform.apply.log.txt",
+    ]
+    for step in report["steps"]:
+        assert step["rc"] == 0
+        for field in ["start", "end", "wall_time", "user_cpu", "sys_cpu", "max_rss_kb"]:
+            assert step[field] is not None
+
+
+@mock.patch("lib.process_manager.subprocess_run")
+def test_terraform_no_run_report(
+    subprocess_run, args_helper, config_yaml_sample, tmpdir, monkeypatch
+):
+    """
+    qesap.py does not write any qesap.run.json report if no command is executed
+    """
+    provider = "mangiafuoco"
+    conf = config_yaml_sample(provider)
+    args, *_ = args_helper(provider, conf)
+    args.append("terraform")
+    monkeypatch.chdir(tmpdir)
+    subprocess_run.return_value = (0, [])
+
+    assert main(args) == 0
+
+    assert not os.path.isfile("qesap.run.json")
+
+
+@mock.patch("lib.process_manager.subprocess_run")
+def test_terraform_init_cached(subprocess_run, args_helper):
+    """
+    terraform init is skipped if already successfully executed
+    for the same providers, modules and terraform binary.
+    Use 'echo' in place of the terraform binary, as it has to exist.
+    """
+    provider = "mangiafuoco"
+    conf = """---
+apiver: 3
+provider: mangiafuoco
+terraform:
+  bin: echo
+  variables:
+    az_region: "westeurope"
+    """
+    args, terraform_dir, *_ = args_helper(provider, conf)
+    args.append("terraform")
+    subprocess_run.return_value = (0, [])
+
+    def init_called():
+        return any(" init " in call.args[0] for call in subprocess_run.call_args_list)
+
+    assert main(args) == 0
+    assert init_called()
+
+    subprocess_run.reset_mock()
+    assert main(args + ["--force-apply"]) == 0
+    assert not init_called()
+    assert subprocess_run.call_count == 2
+
+    subprocess_run.reset_mock()
+    assert main(args + ["--force-init", "--force-apply"]) == 0
+    assert init_called()
+
+    subprocess_run.reset_mock()
+    with open(os.path.join(terraform_dir, "version.tf"), "w", encoding="utf-8") as file:
+        file.write('terraform {\n  required_version = ">= 1.1.0"\n}\n')
+    assert main(args) == 0
+    assert init_called()
+
+
+@mock.patch("lib.process_manager.subprocess_run")
+def test_terraform_init_not_cached_on_failure(subprocess_run, args_helper):
+    """
+    A failed terraform init is not cached
+    """
+    provider = "mangiafuoco"
+    conf = """---
+apiver: 3
+provider: mangiafuoco
+terraform:
+  bin: echo
+  variables:
+    az_region: "westeurope"
+    """
+    args, *_ = args_helper(provider, conf)
+    args.append("terraform")
+    subprocess_run.return_value = (1, [])
+    assert main(args) != 0
+
+    subprocess_run.reset_mock()
+    assert main(args) != 0
+    assert " init " in subprocess_run.call_args.args[0]
+
+
+@mock.patch("lib.process_manager.subprocess_run")
+def test_terraform_apply_skipped_if_unchanged(subprocess_run, args_helper):
+    """
+    terraform plan and apply are skipped if nothing changed
+    in the Terraform files and in the terraform.tfvars
+    since the last successful apply
+    """
+    provider = "mangiafuoco"
+    conf = """---
+apiver: 3
+provider: mangiafuoco
+terraform:
+  variables:
+    az_region: "westeurope"
+    """
+    args, terraform_dir, *_ = args_helper(provider, conf)
+    args.append("terraform")
+    subprocess_run.return_value = (0, [])
+
+    assert main(args) == 0
+    assert subprocess_run.call_count == 3
+
+    subprocess_run.reset_mock()
+    assert main(args) == 0
+    subprocess_run.assert_not_called()
+
+    subprocess_run.reset_mock()
+    assert main(args + ["--force-apply"]) == 0
+    assert subprocess_run.call_count == 3
+
+    subprocess_run.reset_mock()
+    with open(
+        os.path.join(terraform_dir, "terraform.tfvars"), "a", encoding="utf-8"
+    ) as file:
+        file.write('deployment_name = "pinocchio"\n')
+    assert main(args) == 0
+    assert subprocess_run.call_count == 3
+
+
+@mock.patch("lib.process_manager.subprocess_run")
+def test_terraform_apply_generic_modules_changed(subprocess_run, args_helper, tmpdir):
+    """
+    terraform plan and apply run again if a module
+    outside of the provider folder, like the generic_modules, change
+    """
+    provider = "mangiafuoco"
+    conf = """---
+apiver: 3
+provider: mangiafuoco
+terraform:
+  variables:
+    az_region: "westeurope"
+    """
+    args, terraform_dir, *_ = args_helper(provider, conf)
+    args.append("terraform")
+    with open(os.path.join(terraform_dir, "main.tf"), "w", encoding="utf-8") as file:
+        file.write(
+            'module "common_variables" {\n'
+            '  source = "../generic_modules/common_variables"\n}\n'
+        )
+    common_dir = os.path.join(
+        tmpdir, "terraform", "generic_modules", "common_variables"
+    )
+    os.makedirs(common_dir)
+    variables_tf = os.path.join(common_dir, "variables.tf")
+    with open(variables_tf, "w", encoding="utf-8") as file:
+        file.write('variable "hana_count" {\n  default = 1\n}\n')
+    subprocess_run.return_value = (0, [])
+
+    assert main(args) == 0
+    assert subprocess_run.call_count == 3
+
+    subprocess_run.reset_mock()
+    assert main(args) == 0
+    subprocess_run.assert_not_called()
+
+    with open(variables_tf, "w", encoding="utf-8") as file:
+        file.write('variable "hana_count" {\n  default = 2\n}\n')
+    assert main(args) == 0
+    assert any(" apply " in call.args[0] for call in subprocess_run.call_args_list)
+
+
+@mock.patch("lib.process_manager.subprocess_run")
+def test_terraform_apply_not_skipped_after_destroy(subprocess_run, args_helper):
+    """
+    terraform destroy forgets about the last successful apply,
+    as well as a failed apply is not remembered
+    """
+    provider = "mangiafuoco"
+    conf = """---
+apiver: 3
+provider: mangiafuoco
+terraform:
+  variables:
+    az_region: "westeurope"
+    """
+    args, *_ = args_helper(provider, conf)
+    args.append("terraform")
+    subprocess_run.return_value = (0, [])
+
+    assert main(args) == 0
+    assert main(args + ["-d"]) == 0
+
+    subprocess_run.reset_mock()
+    assert main(args) == 0
+    assert subprocess_run.call_count == 3
+
+    assert main(args + ["-d"]) == 0
+    subprocess_run.side_effect = [(0, []), (0, []), (1, [])]
+    assert main(args) != 0
+
+    subprocess_run.reset_mock()
+    subprocess_run.side_effect = None
+    assert main(args) == 0
+    assert subprocess_run.call_count == 3
+
+
+@mock.patch("lib.process_manager.subprocess_run")
+def test_terraform_json_output(subprocess_run, args_helper, tmpdir, monkeypatch):
+    """
+    With terraform::json_output, plan and apply run with -json,
+    their output is parsed while running and a table with
+    the time spent on each resource is written
+    """
+    monkeypatch.chdir(tmpdir)
+    provider = "mangiafuoco"
+    conf = """---
+apiver: 3
+provider: mangiafuoco
+terraform:
+  json_output: true
+  variables:
+    az_region: "westeurope"
+    """
+    args, *_ = args_helper(provider, conf)
+    args.append("terraform")
+
+    def fake_run(cmd, **kwargs):
+        if " apply " in cmd:
+            for line in [
+                '{"type": "apply_start", "hook": {"resource": {"addr": "vm.a"}, "action": "create"}}',
+                '{"type": "apply_complete", "hook": {"resource": {"addr": "vm.a"}, "action": "create", "elapsed_seconds": 42}}',
+            ]:
+                kwargs["line_handler"](line)
+        return (0, [])
+
+    subprocess_run.side_effect = fake_run
+
+    assert main(args) == 0
+
+    calls = {call.args[0].split()[2]: call for call in subprocess_run.call_args_list}
+    assert not calls["init"].args[0].endswith("-json")
+    assert "line_handler" not in calls["init"].kwargs
+    for cmd in ["plan", "apply"]:
+        assert f" {cmd} -no-color -json " in calls[cmd].args[0]
+        assert "line_handler" in calls[cmd].kwargs
+    assert calls["apply"].args[0].endswith(" -auto-approve plan.zip")
+    with open("terraform.apply.timing.txt", "r", encoding="utf-8") as file:
+        lines = file.read().splitlines()
+    assert lines[1].split() == ["vm.a", "create", "complete", "42s"]
+
+
+def test_terraform_json_output_parallel_auto(args_helper, tmpdir, monkeypatch):
+    """
+    terraform::json_output together with '-p auto' run each command
+    with two line handlers: no one of them aborts the command.
+    Use a script in place of the terraform binary,
+    so that each command really prints many lines.
+    """
+    monkeypatch.chdir(tmpdir)
+    fake_terraform = str(tmpdir / "fake_terraform.sh")
+    with open(fake_terraform, "w", encoding="utf-8") as file:
+        file.write(
+            """#!/bin/sh
+if [ "$2" = "show" ]; then
+  echo '{"resource_changes": []}'
+  exit 0
+fi
+echo '{"type": "version"}'
+echo '{"type": "apply_start", "hook": {"resource": {"addr": "vm.a"}, "action": "create"}}'
+sleep 0.1
+echo '{"type": "apply_complete", "hook": {"resource": {"addr": "vm.a"}, "action": "create", "elapsed_seconds": 42}}'
+"""
+        )
+    os.chmod(fake_terraform, 0o755)
+    provider = "mangiafuoco"
+    conf = f"""---
+apiver: 3
+provider: mangiafuoco
+terraform:
+  bin: {fake_terraform}
+  json_output: true
+  variables:
+    az_region: "westeurope"
+    """
+    args, *_ = args_helper(provider, conf)
+    args.extend(["terraform", "-p", "auto"])
+
+    assert main(args) == 0
+
+    with open("terraform.apply.log.txt", "r", encoding="utf-8") as file:
+        assert len(file.read().splitlines()) == 3
+    with open("terraform.apply.timing.txt", "r", encoding="utf-8") as file:
+        lines = file.read().splitlines()
+    assert lines[1].split() == ["vm.a", "create", "complete", "42s"]
+
+
+@mock.patch("lib.process_manager.async_subprocess_run", new_callable=mock.AsyncMock)
+def test_terraform_workspaces(async_subprocess_run, args_helper, config_yaml_sample):
+    """
+    Command terraform with --workspaces runs init, workspace new, plan and apply
+    for each workspace, each one with its own data folder and plan file
+    """
+    provider = "mangiafuoco"
+    conf = config_yaml_sample(provider)
+    args, terraform_dir, *_ = args_helper(provider, conf)
+    args.extend(["terraform", "--workspaces", "geppetto,pinocchio"])
+    async_subprocess_run.return_value = (0, [])
+
+    assert main(args) == 0
+
+    for workspace in ["geppetto", "pinocchio"]:
+        calls = [
+            call
+            for call in async_subprocess_run.call_args_list
+            if call.kwargs["env"]["TF_DATA_DIR"] == f".terraform-{workspace}"
+        ]
+        assert [call.args[0] for call in calls] == [
+            f"terraform -chdir={terraform_dir} {cmd}"
+            for cmd in [
+                "init -no-color",
+                f"workspace new -no-color {workspace}",
+                f"plan -no-color -out=plan.{workspace}.zip",
+                f"apply -no-color -auto-approve plan.{workspace}.zip",
+            ]
+        ]
+        assert calls[2].kwargs["log_file"] == f"terraform.{workspace}.plan.log.txt"
+
+
+@mock.patch("lib.process_manager.async_subprocess_run", new_callable=mock.AsyncMock)
+def test_terraform_workspaces_failure(
+    async_subprocess_run, args_helper, config_yaml_sample
+):
+    """
+    A failure in one workspace does not stop the other ones,
+    the failing workspace is reported in the final status
+    """
+    provider = "mangiafuoco"
+    conf = config_yaml_sample(provider)
+    args, *_ = args_helper(provider, conf)
+    args.extend(["terraform", "--workspaces", "geppetto,pinocchio"])
+
+    async def fake_run(cmd, **kwargs):
+        if "plan.pinocchio.zip" in cmd and " apply " in cmd:
+            return (1, [])
+        return (0, [])
+
+    async_subprocess_run.side_effect = fake_run
+
+    assert main(args) != 0
+    applied = [
+        call.args[0]
+        for call in async_subprocess_run.call_args_list
+        if " apply " in call.args[0]
+    ]
+    assert len(applied) == 2
+
+
+@mock.patch("lib.process_manager.async_subprocess_run", new_callable=mock.AsyncMock)
+@pytest.mark.parametrize("max_concurrent", [None, 1, 2])
+def test_terraform_workspaces_max_concurrent(
+    async_subprocess_run, max_concurrent, args_helper, config_yaml_sample
+):
+    """
+    --max-concurrent limits how many workspaces are deployed at the same time,
+    terraform init is never executed concurrently
+    """
+    provider = "mangiafuoco"
+    conf = config_yaml_sample(provider)
+    args, *_ = args_helper(provider, conf)
+    args.extend(["terraform", "--workspaces", "a,b,c,d"])
+    if max_concurrent:
+        args.extend(["--max-concurrent", str(max_concurrent)])
+    running = {"all": set(), "init": 0}
+    peak = {"all": 0, "init": 0}
+
+    async def fake_run(cmd, **kwargs):
+        workspace = kwargs["env"]["TF_DATA_DIR"]
+        running["all"].add(workspace)
+        is_init = cmd.split()[2] == "init"
+        running["init"] += int(is_init)
+        peak["all"] = max(peak["all"], len(running["all"]))
+        peak["init"] = max(peak["init"], running["init"])
+        await asyncio.sleep(0.01)
+        running["init"] -= int(is_init)
+        if " apply " in cmd:
+            running["all"].discard(workspace)
+        return (0, [])
+
+    async_subprocess_run.side_effect = fake_run
+
+    assert main(args) == 0
+    assert peak["init"] == 1
+    assert peak["all"] == (max_concurrent or 4)
+
+
+@mock.patch("lib.process_manager.async_subprocess_run", new_callable=mock.AsyncMock)
+def test_terraform_workspaces_destroy(
+    async_subprocess_run, args_helper, config_yaml_sample
+):
+    """
+    Command terraform with --workspaces and -d destroy all the workspaces:
+    each one is initialized, if not already, and selected before the destroy
+    """
+    provider = "mangiafuoco"
+    conf = config_yaml_sample(provider)
+    args, terraform_dir, *_ = args_helper(provider, conf)
+    args.extend(["terraform", "--workspaces", "geppetto,pinocchio", "-d"])
+    async_subprocess_run.return_value = (0, [])
+
+    assert main(args) == 0
+
+    for workspace in ["geppetto", "pinocchio"]:
+        calls = [
+            call
+            for call in async_subprocess_run.call_args_list
+            if call.kwargs["env"]["TF_DATA_DIR"] == f".terraform-{workspace}"
+        ]
+        assert [call.args[0] for call in calls] == [
+            f"terraform -chdir={terraform_dir} {cmd}"
+            for cmd in [
+                "init -no-color",
+                f"workspace select -no-color {workspace}",
+                "destroy -no-color -auto-approve",
+                "workspace select -no-color default",
+                f"workspace delete -no-color {workspace}",
+            ]
+        ]
+
+
+def fake_terraform_auto(changes, throttled_applies=0, apply_rc=1):
+    """
+    Fake subprocess_run for terraform --parallel auto:
+    'terraform show' returns a plan with `changes` azurerm resources to create,
+    the first `throttled_applies` apply fail for throttling
+    """
+    plan = {
+        "resource_changes": [
+            {
+                "address": f"azurerm_thing.t{index}",
+                "provider_name": "registry.terraform.io/hashicorp/azurerm",
+                "change": {"actions": ["create"]},
+            }
+            for index in range(changes)
+        ]
+    }
+    applies = []
+
+    def fake_run(cmd, **kwargs):
+        if " show " in cmd:
+            return (0, [json.dumps(plan)])
+        if " apply " in cmd:
+            applies.append(cmd)
+            if len(applies) <= throttled_applies:
+                kwargs["line_handler"]("Error: Status=429 Code=TooManyRequests")
+                return (apply_rc, [])
+        return (0, [])
+
+    return fake_run
+
+
+@mock.patch("lib.process_manager.subprocess_run")
+def test_terraform_parallel_auto(subprocess_run, args_helper, config_yaml_sample):
+    """
+    With -p auto the parallelism of apply is calculated from the plan
+    """
+    provider = "mangiafuoco"
+    conf = config_yaml_sample(provider)
+    args, terraform_dir, *_ = args_helper(provider, conf)
+    args.extend(["terraform", "-p", "auto"])
+    subprocess_run.side_effect = fake_terraform_auto(60)
+
+    assert main(args) == 0
+
+    cmds = [call.args[0] for call in subprocess_run.call_args_list]
+    assert cmds[1:] == [
+        f"terraform -chdir={terraform_dir} plan -no-color -out=plan.zip",
+        f"terraform -chdir={terraform_dir} show -no-color -json plan.zip",
+        f"terraform -chdir={terraform_dir} apply -no-color -parallelism=30 -auto-approve plan.zip",
+    ]
+
+
+@mock.patch("lib.process_manager.subprocess_run")
+def test_terraform_parallel_auto_throttled(
+    subprocess_run, args_helper, config_yaml_sample
+):
+    """
+    With -p auto, an apply failed for API throttling is planned
+    and applied again with half of the parallelism
+    """
+    provider = "mangiafuoco"
+    conf = config_yaml_sample(provider)
+    args, terraform_dir, *_ = args_helper(provider, conf)
+    args.extend(["terraform", "-p", "auto"])
+    subprocess_run.side_effect = fake_terraform_auto(60, throttled_applies=2)
+
+    assert main(args) == 0
+
+    cmds = [call.args[0] for call in subprocess_run.call_args_list]
+    assert cmds[4:] == [
+        f"terraform -chdir={terraform_dir} plan -no-color -parallelism=15 -out=plan.zip",
+        f"terraform -chdir={terraform_dir} apply -no-color -parallelism=15 -auto-approve plan.zip",
+        f"terraform -chdir={terraform_dir} plan -no-color -parallelism=7 -out=plan.zip",
+        f"terraform -chdir={terraform_dir} apply -no-color -parallelism=7 -auto-approve plan.zip",
+    ]
+
+
+@mock.patch("lib.process_manager.subprocess_run")
+def test_terraform_parallel_auto_throttled_give_up(
+    subprocess_run, args_helper, config_yaml_sample
+):
+    """
+    With -p auto, the apply is retried at most throttle_retries times,
+    and not at all if interrupted
+    """
+    provider = "mangiafuoco"
+    conf = config_yaml_sample(provider)
+    args, *_ = args_helper(provider, conf)
+    args.extend(["terraform", "-p", "auto"])
+    subprocess_run.side_effect = fake_terraform_auto(60, throttled_applies=10)
+
+    assert main(args) != 0
+    applies = [
+        call for call in subprocess_run.call_args_list if " apply " in call.args[0]
+    ]
+    assert len(applies) == 3
+
+    subprocess_run.reset_mock()
+    subprocess_run.side_effect = fake_terraform_auto(
+        60, throttled_applies=10, apply_rc=INTERRUPTED_RC
+    )
+    assert main(args) != 0
+    applies = [
+        call for call in subprocess_run.call_args_list if " apply " in call.args[0]
+    ]
+    assert len(applies) == 1
+
+
+@mock.patch("lib.process_manager.subprocess_run")
+def test_terraform_parallel_fixed_not_retried(
+    subprocess_run, args_helper, config_yaml_sample
+):
+    """
+    With a fixed -p value, a throttled apply is not retried
+    """
+    provider = "mangiafuoco"
+    conf = config_yaml_sample(provider)
+    args, *_ = args_helper(provider, conf)
+    args.extend(["terraform", "-p", "5"])
+
+    def fake_run(cmd, **kwargs):
+        assert "line_handler" not in kwargs
+        return (1, ["Error: Status=429"]) if " apply " in cmd else (0, [])
+
+    subprocess_run.side_effect = fake_run
+
+    assert main(args) != 0
+    assert subprocess_run.call_count == 3
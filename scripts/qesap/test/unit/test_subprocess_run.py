@@ -1,4 +1,4 @@
-from lib.process_manager import subprocess_run
+from lib.process_manager import subprocess_run, ABORTED_RC, OUTPUT_TAIL_LINES
 
 
 def test_no_command():
@@ -67,3 +67,74 @@ def test_env():
     exit_code, stdout_list = subprocess_run("printenv", env={"BANANA_VALUE": "1234"})
     assert exit_code == 0
     assert "BANANA_VALUE=1234" in stdout_list
+
+
+def test_log_file(tmpdir):
+    """
+    Run subprocess_run with a log file:
+    the whole stdout is written in the log file
+    """
+    log_file = str(tmpdir / "banana.log.txt")
+    exit_code, stdout_list = subprocess_run('printf "a\\nb\\nc\\n"', log_file=log_file)
+    assert exit_code == 0
+    assert stdout_list == ["a", "b", "c"]
+    with open(log_file, "r", encoding="utf-8") as file:
+        assert file.read().splitlines() == ["a", "b", "c"]
+
+
+def test_tail(tmpdir):
+    """
+    Only the last 'tail' lines are returned,
+    but the log file has all of them
+    """
+    log_file = str(tmpdir / "banana.log.txt")
+    exit_code, stdout_list = subprocess_run("seq 1 1000", log_file=log_file, tail=3)
+    assert exit_code == 0
+    assert stdout_list == ["998", "999", "1000"]
+    with open(log_file, "r", encoding="utf-8") as file:
+        assert len(file.read().splitlines()) == 1000
+
+
+def test_tail_default(tmpdir):
+    """
+    When using a log file the number of lines kept in memory is limited by default
+    """
+    log_file = str(tmpdir / "banana.log.txt")
+    _, stdout_list = subprocess_run("seq 1 1000", log_file=log_file)
+    assert len(stdout_list) == OUTPUT_TAIL_LINES
+    assert stdout_list[-1] == "1000"
+
+
+def test_tail_err():
+    """
+    Output tail is also available for failing commands
+    """
+    exit_code, stdout_list = subprocess_run("ls /banana /ananas", tail=1)
+    assert exit_code != 0
+    assert len(stdout_list) == 1
+
+
+def test_line_handler():
+    """
+    The line handler get each output line,
+    also the ones not kept in the output tail
+    """
+    lines = []
+    exit_code, stdout_list = subprocess_run(
+        "seq 1 10", tail=1, line_handler=lines.append
+    )
+    assert exit_code == 0
+    assert stdout_list == ["10"]
+    assert lines == [str(i) for i in range(1, 11)]
+
+
+def test_line_handler_abort():
+    """
+    The process is terminated as soon as the line handler returns True
+    """
+    exit_code, stdout_list = subprocess_run(
+        "sh -c 'echo start; echo stop; sleep 30; echo never'",
+        line_handler=lambda line: line == "stop",
+    )
+    assert exit_code == ABORTED_RC
+    assert stdout_list == ["start", "stop"]